@@ -0,0 +1,75 @@
+"""
+Recall and speed of the approximate IVF-PQ nearest neighbor search against the exact blocked search, on a seeded
+synthetic feature bank (clustered float16 features, like the cached embeddings) or on a cached feature bank.
+
+Usage: `python -m benchmarks.knn_recall [--features-dir <embedding cache entry>]`
+"""
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+
+from eval.knn_engine import IVFPQIndex, exact_topk, knn_classify, recall_at_k
+from tests.utils import make_bank
+
+
+def main(
+    num_samples: int = 200_000,
+    num_queries: int = 1000,
+    dim: int = 512,
+    num_classes: int = 846,
+    k: int = 200,
+    features_dir: Path = None,
+):
+    if features_dir is None:
+        bank, bank_labels, queries, _ = make_bank(num_samples, num_queries, dim, num_classes)
+    else:
+        from eval.embedding_cache import EmbeddingDataset
+
+        dataset = EmbeddingDataset(features_dir)
+        bank, bank_labels = dataset.features[:, 0], dataset.labels
+        num_classes = int(np.max(bank_labels)) + 1
+        # the queries are a seeded sample of the bank itself
+        query_idx = np.sort(np.random.default_rng(0).choice(len(bank), num_queries, replace=False))
+        queries = np.asarray(bank[query_idx])
+    print(f"bank {bank.shape}, {len(queries)} queries, k={k}")
+
+    start = time.perf_counter()
+    _, exact_idx = exact_topk(bank, queries, k)
+    t_exact = time.perf_counter() - start
+    exact_pred = knn_classify(bank, bank_labels, queries, num_classes, k).argmax(axis=1)
+    print(f"{'exact':>24}: {t_exact / len(queries) * 1e3:8.2f} ms/query")
+
+    start = time.perf_counter()
+    index = IVFPQIndex.build(bank, nlist=int(min(4 * len(bank) ** 0.5, 4096)))
+    print(f"{'ivfpq build':>24}: {time.perf_counter() - start:8.2f} s")
+
+    for nprobe in [4, 16, 64]:
+        for rerank in [0, 4]:
+            start = time.perf_counter()
+            _, approx_idx = index.search(queries, k, nprobe=nprobe, bank=bank, rerank=rerank)
+            t_approx = time.perf_counter() - start
+            approx_pred = knn_classify(
+                bank, bank_labels, queries, num_classes, k, index=index, nprobe=nprobe, bank=bank, rerank=rerank
+            ).argmax(axis=1)
+            print(
+                f"{f'ivfpq nprobe={nprobe} rerank={rerank}':>24}: {t_approx / len(queries) * 1e3:8.2f} ms/query, "
+                f"recall@{k} {recall_at_k(approx_idx, exact_idx):.3f}, "
+                f"same prediction {np.mean(approx_pred == exact_pred):.3f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--features-dir", type=Path, default=None)
+    parser.add_argument("--num-samples", type=int, default=200_000)
+    parser.add_argument("--num-queries", type=int, default=1000)
+    parser.add_argument("--k", type=int, default=200)
+    cli_args = parser.parse_args()
+    main(
+        num_samples=cli_args.num_samples,
+        num_queries=cli_args.num_queries,
+        k=cli_args.k,
+        features_dir=cli_args.features_dir,
+    )
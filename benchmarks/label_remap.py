@@ -0,0 +1,33 @@
+"""
+Compares the lookup table based label remapping with the original per-class `np.where` loop.
+
+Usage: `python -m benchmarks.label_remap`
+"""
+import timeit
+
+import numpy as np
+
+from data.constants import LABEL_REMAP, NO_DATA_VAL, ori_input_size
+from data.label_remap import apply_label_lut, build_label_lut
+from tests.utils import remap_labels_loop
+
+
+def main(num_runs: int = 1000):
+    rng = np.random.default_rng(0)
+    for modality in LABEL_REMAP:
+        values = LABEL_REMAP[modality]["old"] + [NO_DATA_VAL[modality]]
+        data = rng.choice(values, size=(1, ori_input_size, ori_input_size)).astype(
+            np.uint8
+        )
+        lut = build_label_lut(modality)
+
+        t_loop = timeit.timeit(lambda: remap_labels_loop(data, modality), number=num_runs)
+        t_lut = timeit.timeit(lambda: apply_label_lut(data, lut), number=num_runs)
+        print(
+            f"{modality:>16}: loop {t_loop / num_runs * 1e6:8.1f} us/sample, "
+            f"lut {t_lut / num_runs * 1e6:8.1f} us/sample, speedup {t_loop / t_lut:5.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
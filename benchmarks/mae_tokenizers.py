@@ -0,0 +1,85 @@
+"""
+Tokens per sample and pretraining throughput of MAE with the tokenizers of `methods.modules.tokenizer`, on random
+Sentinel-2 sized inputs (12 channels, 112 pixels). The throughput is measured for a full training step (masking,
+encoder, decoder, loss and backward) without the data loading.
+
+Usage: `python -m benchmarks.mae_tokenizers [--backbone vit_small_patch16_224] [--batch-size 64]`
+"""
+import time
+from argparse import ArgumentParser
+
+import torch
+
+from data.constants import input_size
+from methods.modules import MAE
+
+TOKENIZERS = ["", "p8", "p28", "spectral_p16", "spectral_p28", "band_p28"]
+
+
+def measure(model: MAE, images: torch.Tensor, steps: int, warmup: int = 3) -> float:
+    """Returns the training steps (forward and backward) per second."""
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    autocast = torch.autocast(images.device.type, dtype=torch.bfloat16, enabled=images.is_cuda)
+    for step in range(warmup + steps):
+        if step == warmup:
+            if images.is_cuda:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        with autocast:
+            loss, _ = model.reconstruction_loss(images)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+    if images.is_cuda:
+        torch.cuda.synchronize()
+    return steps / (time.perf_counter() - start)
+
+
+def main(
+    backbone: str = "vit_small_patch16_224",
+    batch_size: int = 64,
+    steps: int = 10,
+    fast: bool = False,
+):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    images = torch.rand(batch_size, 12, input_size, input_size, device=device)
+    fast_config = dict(
+        decoder_embed_dim=256, decoder_depth=4, decoder_num_heads=8, fused_attention=True, predict_ratio=0.5
+    )
+    print(f"{backbone}, batch size {batch_size}, {device}{', fast decoder' if fast else ''}")
+    print(f"{'tokenizer':>14} | {'tokens/sample':>13} | {'encoded':>7} | {'samples/s':>9} | {'params (M)':>10}")
+    for tokenizer in TOKENIZERS:
+        model = MAE(
+            backbone=f"{backbone}:{tokenizer}" if tokenizer else backbone,
+            batch_size_per_device=batch_size,
+            in_channels=12,
+            img_size=input_size,
+            num_classes=0,
+            has_online_classifier=False,
+            train_transform=None,
+            **(fast_config if fast else {}),
+        ).to(device)
+        num_tokens = model.backbone.vit.patch_embed.num_patches
+        # visible tokens (with the class token) that go through the encoder
+        num_encoded = int(model.sequence_length * (1 - model.mask_ratio))
+        throughput = measure(model, images, steps) * batch_size
+        num_params = sum(p.numel() for p in model.parameters()) / 1e6
+        print(
+            f"{tokenizer or 'default':>14} | {num_tokens:>13} | {num_encoded:>7} | {throughput:>9.1f} | "
+            f"{num_params:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--backbone", type=str, default="vit_small_patch16_224")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--fast", action="store_true", help="Use the decoder of the mae_fast method.")
+    cli_args = parser.parse_args()
+    main(
+        backbone=cli_args.backbone,
+        batch_size=cli_args.batch_size,
+        steps=cli_args.steps,
+        fast=cli_args.fast,
+    )
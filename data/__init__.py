@@ -1,3 +1,4 @@
+from .dataloader_utils import get_num_samples
 from .geobench_dataset import GeobenchDataset, get_geobench_dataloaders
 from .mmearth_dataset import (
     get_mmearth_dataloaders,
@@ -10,5 +11,6 @@ __all__ = [
     "get_mmearth_dataloaders",
     "create_MMEearth_args",
     "GeobenchDataset",
-    "get_geobench_dataloaders"
+    "get_geobench_dataloaders",
+    "get_num_samples",
 ]
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import shutil
+from functools import lru_cache
+from pathlib import Path
+from typing import Union
+
+from lightly.utils.dist import print_rank_zero
+
+# bump this whenever the content of the converted files changes for the same inputs (e.g. new normalization)
+CACHE_VERSION = 2
+
+KEY_SUFFIX = ".key.json"
+
+
+@lru_cache(maxsize=None)
+def _file_digest(path: str, size: int, mtime_ns: int) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_digest(path: Union[str, Path]) -> str:
+    """sha256 of the file content, only recomputed if the size or modification time of the file changed."""
+    stat = os.stat(path)
+    return _file_digest(str(path), stat.st_size, stat.st_mtime_ns)
+
+
+def file_signature(path: Union[str, Path]) -> dict:
+    """Cheap identification of (large) files by name, size and modification time."""
+    stat = os.stat(path)
+    return {"name": Path(path).name, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def get_cache_key(**inputs) -> tuple[str, dict]:
+    """
+    Hashes all inputs of a conversion (they need to be json serializable) together with `CACHE_VERSION`.
+
+    Returns the (short) hex digest and the full key, which is stored next to the cache entry.
+    """
+    key = {"version": CACHE_VERSION, **inputs}
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+    return digest[:16], key
+
+
+def indices_digest(indices: Union[list[int], None]) -> Union[str, None]:
+    if indices is None:
+        return None
+    return hashlib.sha256(json.dumps(list(map(int, indices))).encode()).hexdigest()
+
+
+def _key_path(entry: Path) -> Path:
+    return entry.with_name(entry.name + KEY_SUFFIX)
+
+
+def is_cached(entry: Path) -> bool:
+    """
+    A cache entry (beton file or directory) is only valid if its key file exists, since the key file is written after
+    the entry is complete. A hit also marks the entry as recently used.
+    """
+    key_path = _key_path(entry)
+    if not (entry.exists() and key_path.exists()):
+        return False
+    key_path.touch()
+    return True
+
+
+def mark_cached(entry: Path, key: dict):
+    """Writes the key file of a completely written cache entry."""
+    with open(_key_path(entry), "w") as f:
+        json.dump(key, f, indent=1)
+
+
+def _entry_size(entry: Path) -> int:
+    if entry.is_dir():
+        return sum(f.stat().st_size for f in entry.rglob("*") if f.is_file())
+    return entry.stat().st_size
+
+
+def evict_cache(cache_dir: Path, max_bytes: int, keep: list[Path] = ()):
+    """
+    Deletes the least recently used cache entries in `cache_dir` until all entries together take at most `max_bytes`.
+
+    Only entries with a key file are considered, all other files in `cache_dir` are left untouched. Entries in `keep`
+    are never deleted.
+    """
+    keep = {Path(k).resolve() for k in keep}
+    entries = []
+    for key_path in cache_dir.glob(f"*{KEY_SUFFIX}"):
+        entry = key_path.with_name(key_path.name[: -len(KEY_SUFFIX)])
+        if entry.exists():
+            entries.append((key_path.stat().st_mtime, entry, key_path))
+
+    total = sum(_entry_size(entry) for _, entry, _ in entries)
+    # oldest first
+    for _, entry, key_path in sorted(entries, key=lambda e: e[0]):
+        if total <= max_bytes:
+            break
+        if entry.resolve() in keep:
+            continue
+        size = _entry_size(entry)
+        print_rank_zero(f"Evicting cached {entry} ({size / 1e9:.2f} GB)")
+        # remove the key first, so that a partially deleted entry is never considered valid
+        key_path.unlink()
+        if entry.is_dir():
+            shutil.rmtree(entry, ignore_errors=True)
+        else:
+            entry.unlink()
+        total -= size
@@ -0,0 +1,215 @@
+import json
+import multiprocessing
+import os
+import random
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+
+import numpy as np
+import torch
+from lightly.utils.dist import print_rank_zero
+from torch.utils.data import Dataset
+
+MANIFEST_NAME = "manifest.json"
+
+
+def split_into_shards(indices: list[int], num_shards: int) -> list[list[int]]:
+    """Splits the indices into `num_shards` contiguous shards of (almost) equal size."""
+    assert 0 < num_shards <= len(indices), (
+        f"cannot split {len(indices)} samples into {num_shards} shards"
+    )
+    return [shard.tolist() for shard in np.array_split(np.asarray(indices), num_shards)]
+
+
+def get_shard_path(shard_dir: Path, shard_id: int, num_shards: int) -> Path:
+    return shard_dir / f"shard_{shard_id:05d}-of-{num_shards:05d}.beton"
+
+
+def get_completed_shards(shard_dir: Path, num_shards: int) -> list[int]:
+    """Returns the ids of all shards that have been written completely (i.e. that have a completion record)."""
+    return [
+        shard_id
+        for shard_id in range(num_shards)
+        if get_shard_path(shard_dir, shard_id, num_shards).with_suffix(".json").exists()
+    ]
+
+
+def _write_manifest(shard_dir: Path, shards: list[list[int]]):
+    # the manifest fixes the split of the indices into shards, so that every job (and every restart) writes the same
+    # samples into the same shard
+    manifest = {"num_shards": len(shards), "indices": shards}
+    manifest_path = shard_dir / MANIFEST_NAME
+    if manifest_path.exists():
+        with open(manifest_path, "r") as f:
+            existing = json.load(f)
+        assert existing == manifest, (
+            f"{manifest_path} was written for a different shard layout, "
+            f"remove {shard_dir} to convert the dataset again"
+        )
+        return
+    tmp_path = manifest_path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+
+def _convert_shard(
+    convert_fn: Callable,
+    dataset: Dataset,
+    shard_path: Path,
+    shard_indices: list[int],
+    convert_kwargs: dict,
+):
+    # write to a temporary file first, so that a pre-empted job never leaves a truncated shard behind
+    tmp_path = shard_path.with_suffix(".beton.tmp")
+    convert_fn(dataset, tmp_path, indices=shard_indices, **convert_kwargs)
+    os.replace(tmp_path, shard_path)
+    # completion record, written last
+    with open(shard_path.with_suffix(".json"), "w") as f:
+        json.dump({"num_samples": len(shard_indices)}, f)
+
+
+def convert_to_beton_shards(
+    dataset: Dataset,
+    shard_dir: Path,
+    num_shards: int,
+    convert_fn: Callable,
+    indices: list[int] = None,
+    shard_ids: Iterable[int] = None,
+    num_processes: int = 1,
+    **convert_kwargs,
+) -> list[int]:
+    """
+    Converts a dataset into `num_shards` beton files, skipping all shards that have been completed before.
+
+    Parameters:
+    ----------
+    dataset : Dataset
+        The dataset to be converted.
+    shard_dir : Path
+        Directory for the shards and the manifest.
+    num_shards : int
+        Number of shards the (selected) indices are split into.
+    convert_fn : Callable
+        Function that writes a single beton file: `convert_fn(dataset, write_path, indices=..., **convert_kwargs)`.
+    indices : list[int], optional
+        Indices to select from the dataset. Default is None, meaning all samples are used.
+    shard_ids : Iterable[int], optional
+        Only convert these shards, e.g. to spread the conversion over several jobs. Default is None, meaning all shards.
+    num_processes : int, optional
+        Number of shards converted in parallel by separate processes. Default is 1.
+
+    Returns:
+    -------
+    list[int]
+        The ids of all completed shards (also the ones completed by other jobs).
+    """
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    if indices is None:
+        indices = list(range(len(dataset)))
+    shards = split_into_shards(list(indices), num_shards)
+    _write_manifest(shard_dir, shards)
+
+    shard_ids = range(num_shards) if shard_ids is None else shard_ids
+    completed = set(get_completed_shards(shard_dir, num_shards))
+    todo = [shard_id for shard_id in shard_ids if shard_id not in completed]
+    print_rank_zero(
+        f"Converting {len(todo)} of {num_shards} shards to {shard_dir} "
+        f"({len(completed)} already completed)."
+    )
+
+    def args(shard_id: int):
+        shard_path = get_shard_path(shard_dir, shard_id, num_shards)
+        return convert_fn, dataset, shard_path, shards[shard_id], convert_kwargs
+
+    if num_processes <= 1:
+        for shard_id in todo:
+            _convert_shard(*args(shard_id))
+    else:
+        # separate processes (not a pool), since the beton writer starts worker processes itself
+        ctx = multiprocessing.get_context("spawn")
+        running = []
+        failed = []
+        for shard_id in todo:
+            if len(running) >= num_processes:
+                failed += _wait_for_first(running)
+            process = ctx.Process(target=_convert_shard, args=args(shard_id))
+            process.start()
+            running.append((shard_id, process))
+        while running:
+            failed += _wait_for_first(running)
+        if failed:
+            raise RuntimeError(f"Conversion of shards {sorted(failed)} failed")
+
+    return get_completed_shards(shard_dir, num_shards)
+
+
+def _wait_for_first(running: list) -> list[int]:
+    shard_id, process = running.pop(0)
+    process.join()
+    return [] if process.exitcode == 0 else [shard_id]
+
+
+class ShardedLoader:
+    """
+    Combines the loaders of several beton shards into one loader.
+
+    Without shuffling, the shards are chained in order. For training, the shards are visited in a random order and the
+    batches of `num_interleaved` open shards at a time are interleaved randomly (the loaders shuffle within their
+    shard). The shard loaders should keep their incomplete last batch (`drop_last=False`): these are merged into full
+    batches of `batch_size` samples, so only the incomplete batch at the very end of the epoch is dropped.
+    """
+
+    def __init__(
+        self,
+        loaders: list,
+        shuffle: bool,
+        seed: Optional[int] = None,
+        batch_size: Optional[int] = None,
+        num_interleaved: int = 4,
+    ):
+        assert not shuffle or batch_size is not None, "training needs the batch size to merge incomplete batches"
+        self.loaders = loaders
+        self.shuffle = shuffle
+        self.rng = random.Random(seed)
+        self.batch_size = batch_size
+        self.num_interleaved = num_interleaved
+
+    def __len__(self):
+        if self.shuffle:
+            return sum(len(loader.indices) for loader in self.loaders) // self.batch_size
+        return sum(len(loader) for loader in self.loaders)
+
+    def __iter__(self):
+        if not self.shuffle:
+            for loader in self.loaders:
+                yield from loader
+            return
+
+        pending = list(self.loaders)
+        self.rng.shuffle(pending)
+        # [iterator, remaining batches] of the open shards, only a few are open since every ffcv loader allocates its
+        # own buffers
+        active = []
+        leftover = None
+        while pending or active:
+            while pending and len(active) < self.num_interleaved:
+                loader = pending.pop()
+                active.append([iter(loader), len(loader)])
+            i = self.rng.choices(range(len(active)), weights=[a[1] for a in active])[0]
+            batch = next(active[i][0])
+            active[i][1] -= 1
+            if active[i][1] == 0:
+                active.pop(i)
+
+            if len(batch[0]) == self.batch_size:
+                yield batch
+                continue
+            # incomplete last batch of a shard, merged with the next ones
+            if leftover is None:
+                leftover = tuple(batch)
+            else:
+                leftover = tuple(torch.cat([a, b]) for a, b in zip(leftover, batch))
+            if len(leftover[0]) >= self.batch_size:
+                yield tuple(x[: self.batch_size] for x in leftover)
+                leftover = tuple(x[self.batch_size :] for x in leftover)
@@ -0,0 +1,111 @@
+import math
+import random
+from collections import defaultdict
+from typing import Iterator, Optional
+
+import torch.distributed as dist
+from torch.utils.data import DistributedSampler
+
+
+def _get_rank_and_world_size() -> tuple[int, int]:
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+class ChunkAwareSampler(DistributedSampler):
+    """
+    Random order of the samples of an h5 file that reads the file chunk by chunk.
+
+    The samples are grouped by the chunk of the h5 file their row belongs to. In every epoch, the order of the chunks
+    is shuffled and the samples of each chunk are added (in row order) to a shuffle buffer of `shuffle_buffer_size`
+    samples, from which they are drawn at random. Only the chunks in the buffer are read at the same time (about
+    `shuffle_buffer_size / chunk_rows` chunks), so each chunk is decompressed once if the chunk cache can hold them,
+    instead of once for every sample.
+
+    With several ranks, all ranks shuffle the chunks the same way (the seed is shared) and each rank takes a
+    contiguous part of the samples in chunk order, so the ranks read different chunks. As the `DistributedSampler`,
+    the samples are padded by repeating the first ones, so that every rank gets the same number of samples. The
+    number of ranks and the rank are taken from the process group when the sampler is iterated (the loaders are
+    built before Lightning starts it). The sampler subclasses `DistributedSampler`, so Lightning keeps it instead of
+    replacing it with its own distributed sampler; it has to be passed as `sampler` (not inside a `batch_sampler`)
+    of the `DataLoader`. The order only depends on the seed and the epoch, Lightning calls `set_epoch` before every
+    epoch.
+
+    Parameters:
+    ----------
+    rows : list[int]
+        Row in the h5 file of each sample of the dataset, e.g. `MMEarthDataset.indices`.
+    chunk_rows : int
+        Number of rows per chunk of the h5 datasets, e.g. from `MMEarthDataset.get_chunk_rows`.
+    shuffle_buffer_size : int, optional
+        Number of samples the random order is drawn from. Larger buffers are more random, but need a larger chunk
+        cache. Default is 1024.
+    seed : int, optional
+        Seed of the random order, which is combined with the epoch. It needs to be the same on all ranks. Default is 0.
+    num_replicas : int, optional
+        Number of ranks. Default is None (world size of the process group, 1 without process group).
+    rank : int, optional
+        Rank of this process. Default is None (rank in the process group, 0 without process group).
+    """
+
+    def __init__(
+        self,
+        rows: list[int],
+        chunk_rows: int,
+        shuffle_buffer_size: int = 1024,
+        seed: int = 0,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+    ):
+        assert chunk_rows > 0, f"chunk_rows must be positive, got {chunk_rows}"
+        assert (num_replicas is None) == (rank is None), "num_replicas and rank need to be given together"
+        # without the process group (yet), one rank is assumed until the sampler is iterated
+        self.fixed_ranks = num_replicas is not None
+        if not self.fixed_ranks:
+            rank, num_replicas = _get_rank_and_world_size()
+        super().__init__(rows, num_replicas=num_replicas, rank=rank, shuffle=True, seed=seed, drop_last=False)
+        self.chunk_rows = chunk_rows
+        self.shuffle_buffer_size = shuffle_buffer_size
+
+        chunks = defaultdict(list)
+        for idx, row in enumerate(rows):
+            chunks[row // chunk_rows].append((row, idx))
+        # samples of each chunk in row order
+        self.chunks = [[idx for _, idx in sorted(chunk)] for chunk in chunks.values()]
+
+    def _update_ranks(self):
+        # the process group is usually started after the loaders are built
+        if not self.fixed_ranks:
+            self.rank, self.num_replicas = _get_rank_and_world_size()
+        self.num_samples = math.ceil(len(self.dataset) / self.num_replicas)
+        self.total_size = self.num_samples * self.num_replicas
+
+    def __len__(self):
+        self._update_ranks()
+        return self.num_samples
+
+    def __iter__(self) -> Iterator[int]:
+        self._update_ranks()
+        # same order of the chunks on all ranks
+        rng = random.Random(self.seed + self.epoch)
+
+        chunks = list(self.chunks)
+        rng.shuffle(chunks)
+        order = [idx for chunk in chunks for idx in chunk]
+        # pad to the same number of samples on every rank, then take a contiguous part
+        padding = self.total_size - len(order)
+        order += (order * math.ceil(padding / max(len(order), 1)))[:padding]
+        order = order[self.rank * self.num_samples : (self.rank + 1) * self.num_samples]
+
+        buffer = []
+        for idx in order:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(idx)
+                continue
+            # emit a random sample of the buffer and put the new one in its place
+            i = rng.randrange(len(buffer))
+            buffer[i], idx = idx, buffer[i]
+            yield idx
+        rng.shuffle(buffer)
+        yield from buffer
@@ -54,6 +54,34 @@ NO_DATA_VAL = {
     "eco_region": 65535,
 }
 
+# Label remapping for the segmentation modalities: raw value in the h5 file -> class index.
+# Raw values that are not listed here (including the no data value) are mapped to nan.
+# dynamic_world: 1, 2, 3, 4, 5, 6, 7, 8, 9 -> 0, 1, 2, 3, 4, 5, 6, 7, 8
+# esa_worldcover: 10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 100 -> 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10
+LABEL_REMAP = {
+    "dynamic_world": {
+        "old": [1, 2, 3, 4, 5, 6, 7, 8, 9],
+        "new": [0, 1, 2, 3, 4, 5, 6, 7, 8],
+    },
+    "esa_worldcover": {
+        "old": [10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 100],
+        "new": [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10],
+    },
+}
+
+# How sentinel2 is stored in the beton files -> dtype of the stored array
+# float32: normalized (default)
+# float16: normalized, half the size
+# uint16: raw reflectance (stored bit-wise as int16) plus l2a flag, normalized when loading, half the size
+SENTINEL2_STORAGE = {
+    "float32": "float32",
+    "float16": "float16",
+    "uint16": "int16",
+}
+
+# Backends for loading the MMEarth data, see get_mmearth_dataloaders
+DATA_BACKENDS = ["ffcv", "hdf5", "stream", "memmap"]
+
 # Input modalities for training
 INP_MODALITIES = {
     "sentinel2": [
@@ -0,0 +1,24 @@
+import ffcv
+from torch.utils.data import DataLoader
+
+from .beton_shards import ShardedLoader
+from .sentinel2_storage import Sentinel2NormalizingLoader
+
+
+def get_num_samples(dataloader) -> int:
+    """
+    Number of samples of the data behind a dataloader of any backend (the selected indices of an `ffcv.Loader`, the
+    dataset of a `DataLoader`, the sum over the shards of a `ShardedLoader`), including the samples of an incomplete
+    last batch, even if the loader drops it.
+
+    With a `DataLoader` of a `StreamShardDataset`, these are the samples of the current rank.
+    """
+    if isinstance(dataloader, Sentinel2NormalizingLoader):
+        return get_num_samples(dataloader.loader)
+    if isinstance(dataloader, ShardedLoader):
+        return sum(get_num_samples(loader) for loader in dataloader.loaders)
+    if isinstance(dataloader, DataLoader):
+        return len(dataloader.dataset)
+    if isinstance(dataloader, ffcv.Loader):
+        return len(dataloader.indices)
+    raise TypeError(f"cannot determine the number of samples of {type(dataloader).__name__}")
@@ -1,4 +1,5 @@
 import json
+import os
 from pathlib import Path
 from typing import Union, Tuple
 
@@ -76,6 +77,17 @@ class GeobenchDataset(Dataset):
         self.norm_stats = self.dataset.normalization_stats()
         self.in_channels = len(self.tmp_band_indices)
 
+        mean = np.array(self.norm_stats[0])
+        std = np.array(self.norm_stats[1])
+        if self.dataset_name == "m-so2sat":
+            # the mean and std are multiplied by 10000 only for the so2sat dataset, while the
+            # data values are in decimal range between 0 and 1. Hence, we need to divide the mean and std by 10000
+            mean = mean / 10000
+            std = std / 10000
+        # computed once instead of for every sample
+        self.mean = mean.astype(np.dtype("float32"))
+        self.std = std.astype(np.dtype("float32"))
+
     @staticmethod
     def get_task(dataset_name: str) -> Tuple[TaskSpecifications, str]:
 
@@ -98,31 +110,16 @@ class GeobenchDataset(Dataset):
         return len(self.dataset)
 
     def __getitem__(self, idx):
+        # loading a sample reads and parses its file, so it is only done once
+        sample = self.dataset[idx]
+        label = sample.label
+        bands = sample.bands
 
-        label = self.dataset[idx].label
-        x = []
-
-        for band_idx in self.tmp_band_indices:
-            x.append(self.dataset[idx].bands[band_idx].data)
+        x = np.stack([bands[band_idx].data for band_idx in self.tmp_band_indices], axis=0)
 
-        x = np.stack(x, axis=0)
-
-        mean = np.array(self.norm_stats[0])
-        std = np.array(self.norm_stats[1])
-
-        if self.dataset_name == "m-so2sat":
-            # the mean and std are multiplied by 10000 only for the so2sat dataset, while the
-            # data values are in decimal range between 0 and 1. Hence, we need to divide the mean and std by 10000
-            mean = mean / 10000
-            std = std / 10000
-
-        # normalize each band with its mean and std
-        x = (x - mean[:, None, None]) / std[:, None, None]
-
-        # cast to float32
-        x = x.astype(np.dtype("float32"))
-        mean = mean.astype(np.dtype("float32"))
-        std = std.astype(np.dtype("float32"))
+        # normalize each band with its mean and std and cast to float32
+        x = np.subtract(x, self.mean[:, None, None], dtype=np.dtype("float32"))
+        x /= self.std[:, None, None]
 
         # check if label is an object or a number
         if not (isinstance(label, int) or isinstance(label, list)):
@@ -131,9 +128,34 @@ class GeobenchDataset(Dataset):
             label = np.array(list(label), dtype=np.dtype("int64"))
 
         if self.transform is not None:
-            self.transform(x)
+            x = self.transform(x)
+
+        # the mean and std are the same for all samples, see `GeobenchDataset.mean` and `GeobenchDataset.std`
+        return x, label
 
-        return x, label, mean, std
+
+def list_geobench_partitions(dataset_dir: Path) -> list[str]:
+    """Names of all partitions of a geobench dataset, e.g. "default", "0.01x_train", ..., "1.00x_train"."""
+    return sorted(p.name[: -len("_partition.json")] for p in dataset_dir.glob("*_partition.json"))
+
+
+def get_partition_indices(dataset_dir: Path, partition: str, split: str) -> list[int]:
+    """
+    Returns the indices of the samples of a partition within the same split of the "default" partition, which
+    contains all samples of the split. The samples are in the order of the partition.
+    """
+    if split == "val":
+        split = "valid"
+    with open(dataset_dir / "default_partition.json", "r") as f:
+        full = json.load(f)[split]
+    with open(dataset_dir / f"{partition}_partition.json", "r") as f:
+        names = json.load(f)[split]
+    position = {name: i for i, name in enumerate(full)}
+    missing = [name for name in names if name not in position]
+    assert not missing, (
+        f"{len(missing)} samples of partition '{partition}' ({split}) are not part of the default partition"
+    )
+    return [position[name] for name in names]
 
 
 def get_geobench_dataloaders(
@@ -145,6 +167,8 @@ def get_geobench_dataloaders(
     partition: str = "default",
     no_ffcv: bool = False,
     indices: list[list[int]] = None,
+    partition_views: bool = True,
+    sequential: bool = False,
 ) -> Tuple[list[Union[ffcv.Loader, DataLoader]], TaskSpecifications]:
     """
     Creates and returns data loaders for the GeobenchDataset dataset. If the processed beton file does not exist,
@@ -168,6 +192,14 @@ def get_geobench_dataloaders(
         Disables the creation of beton files and returns PyTorch DataLoader instead. Default is False.
     indices : list[list[int]], optional
         Select indices to use for each split (starting at 0). Default is None, meaning all samples are used. Only applicable with FFCV enabled.
+    partition_views : bool, optional
+        Only one beton file of the full split is written and shared by all partitions and subsets, which are loaded
+        as index views (`ffcv.Loader(indices=...)`). The index lists of the partitions are cached next to the beton
+        files, see `load_partition_indices`. If False, a separate beton file is written for every partition and
+        subset. Default is True.
+    sequential : bool, optional
+        Loads all splits (also "train") in order and without dropping the last batch, e.g. to compute the features
+        of every sample once. Default is False.
 
     Returns:
     -------
@@ -197,6 +229,7 @@ def get_geobench_dataloaders(
     -----
     - The function checks if the processed beton file exists for each split. If it doesn't exist, it processes the data
       and creates the beton file.
+    - With `partition_views`, sweeping over partitions converts each split only once.
     - The `convert_geobench_to_beton` function is used to convert the dataset into beton format.
     - The `ffcv.Loader` is used to create the data loaders with appropriate pipelines for training and validation.
     """
@@ -216,10 +249,16 @@ def get_geobench_dataloaders(
     task, _ = GeobenchDataset.get_task(dataset_name)
     for i, split in enumerate(splits):
         is_train = split == "train"
-        subset = "" if indices is None else "_subset"
-        beton_file = processed_dir / f"{split}_{dataset_name}_{partition}{subset}.beton"
+        # only the training split is shuffled (and drops the last incomplete batch)
+        shuffle = is_train and not sequential
+        if partition_views:
+            # the partition and subset are selected when loading
+            beton_file = processed_dir / f"{split}_{dataset_name}_default.beton"
+        else:
+            subset = "" if indices is None else "_subset"
+            beton_file = processed_dir / f"{split}_{dataset_name}_{partition}{subset}.beton"
 
-        if not beton_file.exists() or no_ffcv:
+        if not is_converted(beton_file) or no_ffcv:
             if not no_ffcv:
                 print_rank_zero(
                     f"Processed file {beton_file} does not exist, trying to create it now."
@@ -231,7 +270,8 @@ def get_geobench_dataloaders(
                 dataset_name=dataset_name,
                 split=split,
                 transform=transform,
-                partition=partition,
+                # for conversion, the partition is selected with its index list from the full split
+                partition=partition if no_ffcv else "default",
             )
 
             if len(dataset) == 0:
@@ -246,20 +286,38 @@ def get_geobench_dataloaders(
                 dataloader = DataLoader(
                     dataset,
                     batch_size=batch_size_per_device,
-                    shuffle=is_train,
+                    shuffle=shuffle,
                     num_workers=num_workers,
-                    drop_last=is_train,
+                    drop_last=shuffle,
                     persistent_workers=num_workers > 0,
                 )
+                # dataset level constants are attributes of the loader instead of being part of every batch
+                dataloader.mean, dataloader.std = dataset.mean, dataset.std
                 dataloaders.append(dataloader)
                 continue
+            elif partition_views:
+                write_geobench_beton(dataset, beton_file, num_workers)
             else:
-                idx = None if indices is None else indices[i]
-                convert_geobench_to_beton(
-                    dataset,
-                    beton_file,
-                    num_workers=num_workers,
-                    indices=idx,
+                idx = None
+                if partition != "default":
+                    idx = get_partition_indices(dataset.dataset_dir, partition, split)
+                if indices is not None:
+                    # indices select from the samples of the partition
+                    idx = indices[i] if idx is None else [idx[j] for j in indices[i]]
+                write_geobench_beton(dataset, beton_file, num_workers, idx)
+
+        loader_indices = None
+        if partition_views:
+            if partition != "default":
+                loader_indices = load_partition_indices(
+                    processed_dir, task.get_dataset_dir(), dataset_name, partition, split
+                )
+            if indices is not None:
+                # indices select from the samples of the partition
+                loader_indices = (
+                    np.asarray(indices[i])
+                    if loader_indices is None
+                    else loader_indices[np.asarray(indices[i])]
                 )
 
         # Data decoding and augmentation
@@ -287,28 +345,172 @@ def get_geobench_dataloaders(
                     ],
                 }
             )
-        pipelines.update(
-            {
-                "mean": [NDArrayDecoder(), ToTensor()],
-                "std": [NDArrayDecoder(), ToTensor()],
-            }
-        )
-
         # Replaces PyTorch data loader (`torch.utils.data.Dataloader`)
         dataloader = ffcv.Loader(
             beton_file,
             batch_size=batch_size_per_device,
             num_workers=num_workers,
-            order=OrderOption.QUASI_RANDOM if is_train else OrderOption.SEQUENTIAL,
+            order=OrderOption.QUASI_RANDOM if shuffle else OrderOption.SEQUENTIAL,
             pipelines=pipelines,
-            drop_last=is_train,
+            drop_last=shuffle,
+            indices=loader_indices,
         )
+        # dataset level constants are attributes of the loader instead of being part of every record
+        metadata = load_geobench_metadata(beton_file)
+        dataloader.mean = np.array(metadata["mean"], dtype=np.dtype("float32"))
+        dataloader.std = np.array(metadata["std"], dtype=np.dtype("float32"))
 
         dataloaders.append(dataloader)
 
     return dataloaders, task
 
 
+def get_partition_indices_path(
+    processed_dir: Path, dataset_name: str, partition: str, split: str
+) -> Path:
+    return processed_dir / f"{split}_{dataset_name}_{partition}.indices.npy"
+
+
+def load_partition_indices(
+    processed_dir: Path, dataset_dir: Path, dataset_name: str, partition: str, split: str
+) -> np.ndarray:
+    """
+    Returns the indices of a partition within the full split (see `get_partition_indices`), cached as a small npy file
+    next to the beton files.
+    """
+    path = get_partition_indices_path(processed_dir, dataset_name, partition, split)
+    if not path.exists():
+        idx = np.asarray(get_partition_indices(dataset_dir, partition, split), dtype=np.int64)
+        # np.save appends .npy to names without that suffix
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp.npy")
+        np.save(tmp_path, idx)
+        os.replace(tmp_path, path)
+    return np.load(path)
+
+
+def get_metadata_path(beton_file: Path) -> Path:
+    return beton_file.with_suffix(".meta.json")
+
+
+def write_geobench_metadata(dataset: GeobenchDataset, beton_file: Path):
+    """Stores the dataset level constants (normalization stats) next to a beton file."""
+    metadata = {
+        "dataset_name": dataset.dataset_name,
+        "mean": dataset.mean.tolist(),
+        "std": dataset.std.tolist(),
+    }
+    with open(get_metadata_path(beton_file), "w") as f:
+        json.dump(metadata, f)
+
+
+def load_geobench_metadata(beton_file: Path) -> dict:
+    with open(get_metadata_path(beton_file), "r") as f:
+        return json.load(f)
+
+
+def is_converted(beton_file: Path) -> bool:
+    # beton files without metadata are incomplete or from an older version (with mean and std in every record)
+    return beton_file.exists() and get_metadata_path(beton_file).exists()
+
+
+def write_geobench_beton(
+    dataset: GeobenchDataset,
+    write_path: Path,
+    num_workers: int = -1,
+    indices: list[int] = None,
+):
+    """
+    Like `convert_geobench_to_beton`, but writes to a temporary file first so that a beton is always complete. The
+    metadata file (see `write_geobench_metadata`) is written last.
+    """
+    tmp_path = write_path.with_suffix(".beton.tmp")
+    convert_geobench_to_beton(dataset, tmp_path, num_workers=num_workers, indices=indices)
+    os.replace(tmp_path, write_path)
+    write_geobench_metadata(dataset, write_path)
+
+
+def convert_geobench_partitions(
+    dataset_name: str,
+    processed_dir: Path,
+    splits: list[str] = None,
+    partitions: list[str] = None,
+    num_workers: int = -1,
+    partition_views: bool = True,
+) -> list[Path]:
+    """
+    Converts the splits of a geobench dataset for several partitions in one pass, such that
+    `get_geobench_dataloaders(..., partition=partition)` finds the beton files.
+
+    Per split, the dataset is opened once with the "default" partition (all samples of the split) and its beton is
+    written. With `partition_views`, only the index lists of the other partitions are stored (see
+    `load_partition_indices`). Otherwise, the betons of the other partitions are written from the same dataset with
+    the index list of the partition (see `get_partition_indices`), partitions that contain the whole split share the
+    beton file of the full split. Existing files are skipped. The samples are loaded, normalized and written by the `num_workers` processes
+    of the beton writer.
+
+    Parameters:
+    ----------
+    dataset_name : str
+        The name of the dataset from Geobench.
+    processed_dir : Path
+        The directory where the processed beton files will be saved.
+    splits : list[str], optional
+        The dataset splits to be converted. Default is ["train", "val", "test"].
+    partitions : list[str], optional
+        The partitions to be converted. Default is None, meaning all partitions of the dataset.
+    num_workers : int, optional
+        The number of processes used for writing each beton file. Default is -1 (all cores).
+    partition_views : bool, optional
+        Whether the partitions are loaded as index views of the full split, see `get_geobench_dataloaders`. Default
+        is True.
+
+    Returns:
+    -------
+    list[Path]
+        The beton files of all splits (and partitions if not `partition_views`).
+    """
+    if splits is None:
+        splits = ["train", "val", "test"]
+    processed_dir.mkdir(exist_ok=True)
+
+    beton_files = []
+    for split in splits:
+        dataset = GeobenchDataset(dataset_name=dataset_name, split=split, partition="default")
+        if partitions is None:
+            partitions = list_geobench_partitions(dataset.dataset_dir)
+
+        full_file = processed_dir / f"{split}_{dataset_name}_default.beton"
+        if not is_converted(full_file):
+            print_rank_zero(f"Converting {split} split of {dataset_name} to {full_file}.")
+            write_geobench_beton(dataset, full_file, num_workers)
+
+        if partition_views:
+            beton_files.append(full_file)
+            for partition in partitions:
+                if partition != "default":
+                    load_partition_indices(
+                        processed_dir, dataset.dataset_dir, dataset_name, partition, split
+                    )
+            continue
+
+        for partition in partitions:
+            beton_file = processed_dir / f"{split}_{dataset_name}_{partition}.beton"
+            beton_files.append(beton_file)
+            if is_converted(beton_file):
+                continue
+            idx = get_partition_indices(dataset.dataset_dir, partition, split)
+            if idx == list(range(len(dataset))):
+                # same samples as the full split
+                beton_file.unlink(missing_ok=True)
+                os.link(full_file, beton_file)
+                write_geobench_metadata(dataset, beton_file)
+                continue
+            print_rank_zero(f"Converting {len(idx)} samples of partition '{partition}' to {beton_file}.")
+            write_geobench_beton(dataset, beton_file, num_workers, idx)
+
+    return beton_files
+
+
 def convert_geobench_to_beton(
     dataset: GeobenchDataset,
     write_path: Path,
@@ -369,6 +571,7 @@ def convert_geobench_to_beton(
     - The `convert_geobench_to_beton` function facilitates the conversion of a GeobenchDataset into a beton format optimized for machine learning tasks.
     - The function initializes appropriate fields based on the dataset type (classification, multi-label classification, segmentation) and writes the dataset to the specified path.
     - The `from_indexed_dataset` method of `DatasetWriter` is used to handle the actual writing process.
+    - The mean and std of the dataset are the same for every sample and are not stored, see `write_geobench_metadata`.
     """
 
     input_shape = (
@@ -403,21 +606,35 @@ def convert_geobench_to_beton(
             }
         )
 
-    fields.update(
-        {
-            "mean": NDArrayField(
-                dtype=np.dtype("float32"),
-                shape=(input_shape[0],),
-            ),
-            "std": NDArrayField(
-                dtype=np.dtype("float32"),
-                shape=(input_shape[0],),
-            ),
-        }
-    )
-
     # Pass a type for each data field
     writer = DatasetWriter(write_path, fields, num_workers=num_workers)
 
     # Write dataset
     writer.from_indexed_dataset(dataset, indices=indices)
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser("GeoBench beton conversion of all partitions")
+    parser.add_argument("--dataset", type=str, required=True, choices=list(GEOBENCH_TASK))
+    parser.add_argument("--processed-dir", type=Path, required=True)
+    parser.add_argument("--splits", type=str, nargs="+", default=None)
+    parser.add_argument("--partitions", type=str, nargs="+", default=None)
+    parser.add_argument("--num-workers", type=int, default=-1)
+    parser.add_argument(
+        "--no-partition-views",
+        action="store_true",
+        help="Write a separate beton file for every partition.",
+    )
+    cli_args = parser.parse_args()
+
+    beton_files = convert_geobench_partitions(
+        cli_args.dataset,
+        cli_args.processed_dir,
+        splits=cli_args.splits,
+        partitions=cli_args.partitions,
+        num_workers=cli_args.num_workers,
+        partition_views=not cli_args.no_partition_views,
+    )
+    print(f"{len(beton_files)} beton files at {cli_args.processed_dir}")
@@ -0,0 +1,109 @@
+import os
+from multiprocessing.util import Finalize
+from pathlib import Path
+from typing import Optional, Union
+
+import h5py
+from lightly.utils.dist import print_rank_zero
+from torch.utils.data import get_worker_info
+
+
+class HDF5Handle:
+    """
+    Opens an h5 file lazily, once per process.
+
+    A handle opened in the parent process is never used by forked data loading workers, since the file is reopened
+    whenever the process id changed. The handle is not pickled (e.g. for spawned workers) and is closed when the
+    process shuts down.
+
+    Parameters:
+    ----------
+    path : Union[str, Path]
+        Path to the h5 file.
+    rdcc_nbytes : int, optional
+        Size of the chunk cache of each dataset in bytes. Should hold at least one chunk, otherwise every read
+        decompresses the chunk again. Default is None (h5py default, 1 MB).
+    rdcc_nslots : int, optional
+        Number of hash table slots of the chunk cache, ideally a prime about 100 times the number of chunks that fit
+        into the cache. Default is None (h5py default).
+    rdcc_w0 : float, optional
+        Eviction policy of the chunk cache, 1 evicts fully read chunks first. Default is None (h5py default).
+    driver : str, optional
+        Low level file driver, e.g. "sec2" or "core" (reads the whole file into memory). Default is None (h5py
+        default).
+    driver_kwargs : dict, optional
+        Additional arguments of the driver, e.g. `{"backing_store": False}` for "core".
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        rdcc_nbytes: Optional[int] = None,
+        rdcc_nslots: Optional[int] = None,
+        rdcc_w0: Optional[float] = None,
+        driver: Optional[str] = None,
+        driver_kwargs: Optional[dict] = None,
+    ):
+        self.path = path
+        self.kwargs = {
+            k: v
+            for k, v in dict(
+                rdcc_nbytes=rdcc_nbytes,
+                rdcc_nslots=rdcc_nslots,
+                rdcc_w0=rdcc_w0,
+                driver=driver,
+            ).items()
+            if v is not None
+        }
+        self.kwargs.update(driver_kwargs or {})
+        self._file = None
+        self._pid = None
+
+    def is_open(self) -> bool:
+        return self._file is not None and self._pid == os.getpid()
+
+    def get(self) -> h5py.File:
+        if self._file is None or self._pid != os.getpid():
+            # a handle inherited from the parent process is left alone, the parent closes it
+            self._file = h5py.File(self.path, "r", **self.kwargs)
+            self._pid = os.getpid()
+            # runs when the process (also a data loading worker) exits
+            Finalize(self, self._file.close, exitpriority=10)
+        return self._file
+
+    def close(self):
+        if self.is_open():
+            self._file.close()
+        self._file = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_file"] = None
+        state["_pid"] = None
+        return state
+
+    def log_chunk_layout(self, names: list[str]):
+        """Logs the chunking of the given datasets, only in the main process or the first data loading worker."""
+        worker_info = get_worker_info()
+        if worker_info is not None and worker_info.id != 0:
+            return
+        file = self.get()
+        cache_size = self.kwargs.get("rdcc_nbytes", file.id.get_access_plist().get_cache()[2])
+        for name in names:
+            dataset = file[name]
+            if dataset.chunks is None:
+                print_rank_zero(f"{self.path}:{name} {dataset.shape} {dataset.dtype}, not chunked")
+                continue
+            chunk_bytes = dataset.dtype.itemsize
+            for size in dataset.chunks:
+                chunk_bytes *= size
+            print_rank_zero(
+                f"{self.path}:{name} {dataset.shape} {dataset.dtype}, chunks {dataset.chunks} "
+                f"({chunk_bytes / 1e6:.2f} MB), compression {dataset.compression}"
+            )
+            if chunk_bytes > cache_size:
+                print_rank_zero(
+                    f"chunks of {name} do not fit into the chunk cache ({cache_size / 1e6:.2f} MB), "
+                    f"consider increasing rdcc_nbytes"
+                )
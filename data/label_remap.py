@@ -0,0 +1,44 @@
+import numpy as np
+
+from .constants import LABEL_REMAP, NO_DATA_VAL
+
+# raw label values are stored as uint8, values outside of this range are treated as no data
+LUT_SIZE = 256
+
+
+def build_label_lut(modality: str, size: int = LUT_SIZE) -> np.ndarray:
+    """
+    Builds a lookup table that maps every raw label value of a segmentation modality to its class index.
+
+    The table has `size + 1` entries, the last entry is used for raw values outside of [0, size) and is always nan.
+    Raw values that are not part of `LABEL_REMAP[modality]` (including `NO_DATA_VAL[modality]`) are mapped to nan.
+
+    Parameters:
+    ----------
+    modality : str
+        Name of the segmentation modality, must be a key of `LABEL_REMAP`.
+    size : int, optional
+        Number of raw values covered by the table. Default is 256 (uint8).
+
+    Returns:
+    -------
+    np.ndarray
+        float32 lookup table of shape (size + 1,).
+    """
+    lut = np.full(size + 1, np.nan, dtype=np.dtype("float32"))
+    lut[LABEL_REMAP[modality]["old"]] = LABEL_REMAP[modality]["new"]
+    no_data = NO_DATA_VAL[modality]
+    if 0 <= no_data < size:
+        lut[int(no_data)] = np.nan
+    return lut
+
+
+def apply_label_lut(data: np.ndarray, lut: np.ndarray) -> np.ndarray:
+    """Remaps raw label values with a table from `build_label_lut` using a single gather."""
+    size = len(lut) - 1
+    if data.dtype != np.uint8 or size < 256:
+        # out of range (and nan) values are redirected to the last entry of the table
+        in_range = (data >= 0) & (data < size)
+        data = np.where(in_range, data, size).astype(np.intp)
+    return lut[data]
+
@@ -0,0 +1,75 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+from lightly.utils.dist import print_rank_zero
+from numpy.lib.format import open_memmap
+from torch.utils.data import Dataset
+
+MANIFEST_NAME = "manifest.json"
+IDS_NAME = "id.json"
+
+
+def export_memmap_cache(dataset: Dataset, cache_dir: Path, block_size: int = 256) -> dict:
+    """
+    Materializes all samples of a dataset into one `.npy` file per entry (e.g. modality) in `cache_dir`, which can be
+    memory mapped with `load_memmap_cache`.
+
+    The samples are read in blocks of `block_size` with `dataset.get_batch`, which needs to return a dict of stacked
+    arrays. The "id" entry is stored as json list.
+
+    Returns:
+    -------
+    dict
+        The manifest, written to `cache_dir / MANIFEST_NAME` once all files are complete.
+    """
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    num_samples = len(dataset)
+    print_rank_zero(f"Caching {num_samples} samples as memory maps at {cache_dir}.")
+
+    arrays = {}
+    ids = []
+    for start in range(0, num_samples, block_size):
+        batch = dataset.get_batch(list(range(start, min(start + block_size, num_samples))))
+        for key, value in batch.items():
+            if key == "id":
+                ids += list(value)
+                continue
+            value = np.asarray(value)
+            if key not in arrays:
+                # the shape and dtype of the whole split are known from the first block
+                arrays[key] = open_memmap(
+                    cache_dir / f"{key}.tmp.npy",
+                    mode="w+",
+                    dtype=value.dtype,
+                    shape=(num_samples, *value.shape[1:]),
+                )
+            arrays[key][start : start + len(value)] = value
+
+    for key, array in arrays.items():
+        array.flush()
+        os.replace(cache_dir / f"{key}.tmp.npy", cache_dir / f"{key}.npy")
+    with open(cache_dir / IDS_NAME, "w") as f:
+        json.dump(ids, f)
+
+    manifest = {"num_samples": num_samples, "keys": list(arrays)}
+    # written last, marks the cache as complete
+    with open(cache_dir / MANIFEST_NAME, "w") as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def load_memmap_cache(cache_dir: Path) -> dict:
+    """
+    Opens the files of `export_memmap_cache`. The arrays are copy-on-write memory maps, so they are writable (as
+    required by `torch.from_numpy`) without ever changing the cache, and a sample is only read when it is accessed.
+    """
+    with open(cache_dir / MANIFEST_NAME, "r") as f:
+        manifest = json.load(f)
+    cache = {
+        key: np.load(cache_dir / f"{key}.npy", mmap_mode="c") for key in manifest["keys"]
+    }
+    with open(cache_dir / IDS_NAME, "r") as f:
+        cache["id"] = json.load(f)
+    return cache
@@ -1,37 +1,174 @@
 import json
+import os
 from argparse import Namespace
 from collections import OrderedDict
 from copy import copy
 from pathlib import Path
-from typing import Union, Tuple
+from typing import Union, Tuple, NamedTuple, Optional, Dict
 
 import ffcv
 import h5py
 import numpy as np
 from ffcv import DatasetWriter
 from ffcv.fields import NDArrayField, IntField, FloatField
-from ffcv.fields.basics import IntDecoder
+from ffcv.fields.basics import IntDecoder, FloatDecoder
 from ffcv.fields.ndarray import NDArrayDecoder
 from ffcv.loader import OrderOption
 from ffcv.transforms import ToTensor, Squeeze
 from lightly.utils.dist import print_rank_zero
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import (
+    Dataset,
+    DataLoader,
+    RandomSampler,
+    SequentialSampler,
+    default_convert,
+)
 from torchvision.transforms import Compose
 
 from methods.transforms import to_tensor
-from .constants import NO_DATA_VAL, MODALITIES_FULL, MODALITY_TASK, ori_input_size
+from .constants import (
+    NO_DATA_VAL,
+    MODALITIES_FULL,
+    MODALITY_TASK,
+    LABEL_REMAP,
+    SENTINEL2_STORAGE,
+    DATA_BACKENDS,
+    ori_input_size,
+)
+from .beton_cache import (
+    evict_cache,
+    file_digest,
+    file_signature,
+    get_cache_key,
+    indices_digest,
+    is_cached,
+    mark_cached,
+)
+from .beton_shards import (
+    ShardedLoader,
+    convert_to_beton_shards,
+    get_shard_path,
+)
+from .label_remap import build_label_lut, apply_label_lut
+from .sentinel2_storage import Sentinel2NormalizingLoader, get_sentinel2_norm
+from .stream_shards import StreamShardDataset, export_stream_shards
+from .memmap_cache import export_memmap_cache, load_memmap_cache
+from .hdf5_handle import HDF5Handle
+from .chunk_sampler import ChunkAwareSampler
 
 
 ##################### FUNCTIONS FOR PRETRAINING DATASETS #####################
 
 
+class ModalityReadPlan(NamedTuple):
+    # band indices in ascending order (or a slice if contiguous) for reading from the h5 file
+    hdf5_idx: Union[np.ndarray, slice]
+    # permutation restoring the requested band order after reading, None if the bands are already in order
+    inverse_idx: Optional[np.ndarray]
+    # band_stats name -> broadcast-ready float32 (mean, std), None for modalities that are not normalized
+    norm: Optional[Dict[str, Tuple[np.ndarray, np.ndarray]]]
+    # dtype of the returned array
+    dtype: np.dtype
+
+
+def get_modality_dtype(modality: str, sentinel2_storage: str = "float32") -> np.dtype:
+    """Data type of a modality as returned by `MMEarthDataset` and stored in the beton files."""
+    if modality == "sentinel2":
+        return np.dtype(SENTINEL2_STORAGE[sentinel2_storage])
+    if MODALITY_TASK[modality] in ["classification", "segmentation"]:
+        return np.dtype("int64")
+    return np.dtype("float32")
+
+
+def compile_read_plan(
+    modality: str,
+    bands: Union[list[str], str],
+    band_stats: dict,
+    modalities_full: dict = MODALITIES_FULL,
+    sentinel2_storage: str = "float32",
+) -> ModalityReadPlan:
+    """Precomputes everything that is needed to read and normalize the given bands of a modality."""
+    # get the indices based on how it is in modalities_full
+    if bands == "all":
+        modality_idx = np.arange(len(modalities_full[modality]))
+    else:
+        modality_idx = np.array([modalities_full[modality].index(m) for m in bands])
+
+    # h5py only supports reading bands in ascending order
+    sort_idx = np.argsort(modality_idx, kind="stable")
+    hdf5_idx = modality_idx[sort_idx]
+    inverse_idx = None
+    if np.any(sort_idx != np.arange(len(sort_idx))):
+        inverse_idx = np.argsort(sort_idx)
+    if np.all(np.diff(hdf5_idx) == 1):
+        # contiguous bands can be read with a (much cheaper) slice
+        hdf5_idx = slice(int(hdf5_idx[0]), int(hdf5_idx[-1]) + 1)
+
+    norm = None
+    if modality not in ["biome", "eco_region", "dynamic_world", "esa_worldcover"]:
+        # inside the band_stats, the name for sentinel2 is sentinel2_l1c or sentinel2_l2a
+        if modality == "sentinel2":
+            stats_names = ["sentinel2_l1c", "sentinel2_l2a"]
+        else:
+            stats_names = [modality]
+        # single value mean and std for era5, lat, lon and month, else for each band of the map
+        shape = (-1,) if modality in ["era5", "lat", "lon", "month"] else (-1, 1, 1)
+        norm = {}
+        for stats_name in stats_names:
+            stats = band_stats[stats_name]
+            means = np.array(stats["mean"], dtype=np.float32)[modality_idx]
+            stds = np.array(stats["std"], dtype=np.float32)[modality_idx]
+            norm[stats_name] = (means.reshape(shape), stds.reshape(shape))
+
+    dtype = get_modality_dtype(modality, sentinel2_storage)
+    return ModalityReadPlan(hdf5_idx, inverse_idx, norm, dtype)
+
+
+def read_rows_and_bands(dataset: h5py.Dataset, rows: np.ndarray, bands: np.ndarray) -> np.ndarray:
+    """
+    Reads the given (sorted, unique) bands of the given (sorted, unique) rows of an h5 dataset with a single read.
+
+    h5py only supports one index list per selection, so the selection is built with the low level API as the union
+    of one hyperslab per row and band, which is read in ascending order into an array of shape
+    (len(rows), len(bands), ...).
+    """
+    file_space = dataset.id.get_space()
+    file_space.select_none()
+    tail = dataset.shape[2:]
+    for row in rows:
+        for band in bands:
+            file_space.select_hyperslab(
+                (int(row), int(band)) + (0,) * len(tail),
+                (1,) * dataset.ndim,
+                block=(1, 1) + tail,
+                op=h5py.h5s.SELECT_OR,
+            )
+    out = np.empty((len(rows), len(bands)) + tail, dtype=dataset.dtype)
+    dataset.id.read(h5py.h5s.create_simple(out.shape), file_space, out)
+    return out
+
+
 class MMEarthDataset(Dataset):
-    def __init__(self, args, split: str, transform = None, return_tuple: bool = False):
+    # batched reads fetch a whole block of rows if it is at most this many times larger than the number of requested rows
+    coalesce_factor = 4
+
+    def __init__(
+        self,
+        args,
+        split: str,
+        transform=None,
+        return_tuple: bool = False,
+        sentinel2_storage: str = "float32",
+        memmap_dir: Optional[Path] = None,
+        hdf5_kwargs: Optional[dict] = None,
+    ):
         # return_dict transform
         self.transform = transform
 
         # path to the dataset
         self.data_path = args.data_path
+        # opened lazily once per process, with the chunk cache and driver options of HDF5Handle (e.g. rdcc_nbytes)
+        self.hdf5 = HDF5Handle(self.data_path, **(hdf5_kwargs or {}))
         # name of the dataset. for example: data_100k_130
         self.data_name = args.data_name
         # path to the split file
@@ -50,6 +187,69 @@ class MMEarthDataset(Dataset):
 
         self.return_tuple = return_tuple
 
+        # how sentinel2 is returned, see SENTINEL2_STORAGE. with "uint16", the raw reflectance is returned (as int16
+        # view) together with the "l2a" flag and the normalization has to be done afterward (e.g. on the GPU)
+        assert (
+            sentinel2_storage in SENTINEL2_STORAGE
+        ), f"unknown sentinel2 storage '{sentinel2_storage}'"
+        self.sentinel2_storage = sentinel2_storage
+
+        # if given, the samples are served from the memory mapped cache of `export_memmap_cache` (written by a
+        # dataset with the same arguments) instead of the h5 file
+        self.memmap_dir = memmap_dir
+
+        # lookup tables for remapping the segmentation labels, built once instead of for every sample
+        self.label_luts = {
+            modality: build_label_lut(modality)
+            for modality in self.modalities
+            if modality in LABEL_REMAP
+        }
+        # band indices, normalization vectors and output dtype of each modality (compiled read plan)
+        self.read_plan = OrderedDict(
+            (
+                modality,
+                compile_read_plan(
+                    modality,
+                    self.modalities[modality],
+                    self.norm_stats,
+                    self.modalities_full,
+                    self.sentinel2_storage,
+                ),
+            )
+            for modality in self.modalities
+        )
+
+    def _process(
+        self, modality: str, plan: ModalityReadPlan, data: np.ndarray, l2a: bool
+    ) -> np.ndarray:
+        if modality in self.label_luts:
+            # the labels of dynamic world (1, ..., 9) and esa worldcover (10, 20, ..., 90, 95, 100) are remapped to
+            # 0, 1, 2, ... with a single lookup. no data and unknown values are mapped to nan.
+            data = apply_label_lut(data, self.label_luts[modality])
+
+        if modality == "sentinel2" and self.sentinel2_storage == "uint16":
+            # raw reflectance, stored bit-wise as int16 since uint16 is not supported by torch
+            return data.astype(np.uint16, copy=False).view(plan.dtype)
+
+        if plan.norm is not None:
+            if modality == "sentinel2" and np.ndim(l2a) > 0:
+                # batch with mixed l1c and l2a samples, select the statistics per sample
+                l2a = np.asarray(l2a, dtype=np.intp)
+                stats = [plan.norm["sentinel2_l1c"], plan.norm["sentinel2_l2a"]]
+                mean = np.stack([m for m, _ in stats])[l2a]
+                std = np.stack([s for _, s in stats])[l2a]
+            elif modality == "sentinel2":
+                mean, std = plan.norm["sentinel2_l2a" if l2a else "sentinel2_l1c"]
+            else:
+                mean, std = plan.norm[modality]
+            # normalize straight into a float32 array
+            data = np.subtract(data, mean, dtype=np.float32)
+            data /= std
+            # converting the nodata values to nan to keep everything consistent
+            data[data == NO_DATA_VAL[modality]] = np.nan
+
+        return data.astype(plan.dtype, copy=False)
+
     def apply_transform(self, return_dict: dict):
         # TODO if more modalities are used, this will create a distorted view
         #  (e.g., flip applied to one but not to another modality)
@@ -67,127 +267,134 @@ class MMEarthDataset(Dataset):
                 return_dict[modality] = self.transform(return_dict[modality])
         return return_dict
 
-    def _open_hdf5(self, path: [str, Path]):
-        self.data_full = h5py.File(path, "r")
+    @property
+    def data_full(self) -> h5py.File:
+        # every worker process opens its own handle, the first one logs the chunk layout
+        if not self.hdf5.is_open():
+            self.hdf5.log_chunk_layout(list(self.modalities))
+        return self.hdf5.get()
+
+    def get_chunk_rows(self) -> int:
+        """Number of rows per chunk of the h5 datasets (of the first modality), 1 if they are not chunked."""
+        chunks = self.data_full[next(iter(self.modalities))].chunks
+        return 1 if chunks is None else chunks[0]
+
+    def __getstate__(self):
+        # the memory maps would be pickled as arrays (e.g. for spawned workers), they are reopened instead
+        state = self.__dict__.copy()
+        state.pop("memmap", None)
+        return state
 
     def __len__(self):
         return len(self.indices)
 
-    def __getitem__(self, idx: int):
+    def _get_memmap(self) -> dict:
+        # opened lazily like the h5 file, the memory maps are shared between workers through the page cache
+        if not hasattr(self, "memmap"):
+            self.memmap = load_memmap_cache(self.memmap_dir)
+        return self.memmap
+
+    def _finalize(self, return_dict: dict):
+        # apply transforms on normalized data
+        if self.transform is not None:
+            return_dict = self.apply_transform(return_dict)
 
-        # this is to ensure that multiple workers do not open the same file multiple times.
-        if not hasattr(self, "data_full"):
-            self._open_hdf5(self.data_path)
+        if self.return_tuple:
+            return tuple(return_dict.values())
+
+        return return_dict
+
+    def __getitem__(self, idx: int):
+        if self.memmap_dir is not None:
+            # the cached arrays are already processed, indexing a single sample does not copy
+            memmap = self._get_memmap()
+            return self._finalize(OrderedDict((k, v[idx]) for k, v in memmap.items()))
 
         # based on what bands and what modalities we need for training, we return the return_dict[idx].)
         return_dict = OrderedDict()
         name = self.data_full["metadata"][self.indices[idx]][0].decode("utf-8")
         l2a = self.tile_info[name]["S2_type"] == "l2a"
 
-        for modality in self.modalities.keys():
-            # get the indices based on how it is in modalities_full
-            if self.modalities[modality] == "all":
-                modality_idx = [i for i in range(len(self.modalities_full[modality]))]
-            else:
-                modality_idx = [
-                    self.modalities_full[modality].index(m)
-                    for m in self.modalities[modality]
-                ]
-
+        for modality, plan in self.read_plan.items():
             if modality in ["biome", "eco_region"]:
-                # for these modalities the array is already one hot encoded. hence modality_idx is not needed.
+                # for these modalities the array is already one hot encoded. hence the band indices are not needed.
                 data = np.argmax(self.data_full[modality][self.indices[idx]])
             else:
-                # get the data
-                # check if modalities are in ascending order, if not, swap for reading and swap for storing
-                modality_idx = np.array(modality_idx)
-                if np.all(np.diff(modality_idx) >= 0):
-                    data = self.data_full[modality][self.indices[idx], modality_idx]
-                else:
-                    swap_idx = np.argsort(modality_idx)
-                    data = self.data_full[modality][
-                        self.indices[idx], modality_idx[swap_idx]
-                    ][swap_idx]
-
-            if modality == "dynamic_world":
-                # the labels of dynamic world are 0, 1, 2, 3, 4, 5, 6, 7, 8, 9. We convert them to 0, 1, 2, 3, 4, 5, 6, 7, 8, nan respectively.
-                # originally when downloading the no return_dict values are 0. hence we remap them to nan.
-                data = np.where(data == NO_DATA_VAL[modality], np.nan, data)
-                old_values = [1, 2, 3, 4, 5, 6, 7, 8, 9, np.nan]
-                new_values = [0, 1, 2, 3, 4, 5, 6, 7, 8, np.nan]
-                for old, new in zip(old_values, new_values):
-                    data = np.where(data == old, new, data)
-                # for any value greater than 8, we map them to nan
-                data = np.where(data > 8, np.nan, data)
-
-            if modality == "esa_worldcover":
-                # the labels of esa worldcover are 10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 100, 255.
-                # We convert them to 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10 255 respectively.
-                old_values = [10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 100, 255]
-                new_values = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 255]
-                for old, new in zip(old_values, new_values):
-                    data = np.where(data == old, new, data)
-                # for any value greater than 10, we map them to nan
-                data = np.where(data > 10, np.nan, data)
-
-            # normalize
-            if modality not in [
-                "biome",
-                "eco_region",
-                "dynamic_world",
-                "esa_worldcover",
-            ]:
-                if self.modalities[modality] == "all":
-                    modality_idx = [
-                        i for i in range(len(self.modalities_full[modality]))
-                    ]
-                else:
-                    modality_idx = [
-                        self.modalities_full[modality].index(m)
-                        for m in self.modalities[modality]
-                    ]
-
-                # inside the band_stats, the name for sentinel2 is sentinel2_l1c or sentinel2_l2a
-                if modality == "sentinel2":
-                    modality_ = "sentinel2_l2a" if l2a else "sentinel2_l1c"
-                else:
-                    modality_ = modality
-
-                means = np.array(self.norm_stats[modality_]["mean"])[modality_idx]
-                stds = np.array(self.norm_stats[modality_]["std"])[modality_idx]
-                if modality in ["era5", "lat", "lon", "month"]:
-                    # single value mean and std
-                    data = (data - means) / stds
-                else:
-                    # single value mean and std for each band
-                    data = (data - means[:, None, None]) / stds[:, None, None]
+                # bands are read in ascending order and swapped back to the requested order afterward
+                data = self.data_full[modality][self.indices[idx], plan.hdf5_idx]
+                if plan.inverse_idx is not None:
+                    data = data[plan.inverse_idx]
 
-            # converting the nodata values to nan to keep everything consistent
-            data = (
-                np.where(data == NO_DATA_VAL[modality], np.nan, data)
-                if modality != "dynamic_world"
-                else data
-            )
-
-            if MODALITY_TASK[modality] in ["classification", "segmentation"]:
-                data = data.astype(np.dtype("int64"))
-            else:
-                data = data.astype(np.dtype("float32"))
+            return_dict[modality] = self._process(modality, plan, data, l2a)
 
-            return_dict[modality] = data
+        if self.sentinel2_storage == "uint16":
+            return_dict["l2a"] = int(l2a)
 
         # we also return the id, to differentiate between sentinel2_l1c and sentinel2_l2a, since this is given in the tile_info json file. To keep everything
         # consistent, we name the modality as sentinel2 instead of sentinel2_l1c or sentinel2_l2a
         return_dict["id"] = name
 
-        # apply transforms on normalized data
-        if self.transform is not None:
-            return_dict = self.apply_transform(return_dict)
+        return self._finalize(return_dict)
+
+    def _read_rows(self, modality: str, rows: np.ndarray, band_idx) -> np.ndarray:
+        # reads the given (sorted, unique) rows of a modality with a single h5py call
+        dataset = self.data_full[modality]
+        start, stop = int(rows[0]), int(rows[-1]) + 1
+        if stop - start <= self.coalesce_factor * len(rows):
+            # rows are close together, read the whole block and drop the rows in between
+            return dataset[start:stop, band_idx][rows - start]
+        if isinstance(band_idx, np.ndarray):
+            # rows are scattered, only the selected bands are read
+            return read_rows_and_bands(dataset, rows, band_idx)
+        return dataset[rows, band_idx]
+
+    def get_batch(self, idxs: list[int]):
+        """
+        Reads several samples at once with one h5py call per modality and returns them stacked along the first dimension.
+
+        The samples are returned in the order of `idxs`, the h5 file is read in ascending order. The output has the
+        same structure as `__getitem__`, with "id" being a list of names. The transform is applied to the whole batch.
+        """
+        if self.memmap_dir is not None:
+            memmap = self._get_memmap()
+            return self._finalize(
+                OrderedDict(
+                    (k, [v[idx] for idx in idxs] if k == "id" else v[idxs])
+                    for k, v in memmap.items()
+                )
+            )
 
-        if self.return_tuple:
-            return tuple(return_dict.values())
+        rows = np.asarray([self.indices[idx] for idx in idxs])
+        # h5py needs increasing indices without duplicates
+        rows, inverse = np.unique(rows, return_inverse=True)
 
-        return return_dict
+        return_dict = OrderedDict()
+        names = [
+            name.decode("utf-8")
+            for name in self._read_rows("metadata", rows, 0)[inverse]
+        ]
+        l2a = np.array([self.tile_info[name]["S2_type"] == "l2a" for name in names])
+
+        for modality, plan in self.read_plan.items():
+            if modality in ["biome", "eco_region"]:
+                data = self._read_rows(modality, rows, slice(None))[inverse]
+                data = data.reshape(len(data), -1).argmax(axis=1)
+            else:
+                data = self._read_rows(modality, rows, plan.hdf5_idx)[inverse]
+                if plan.inverse_idx is not None:
+                    data = data[:, plan.inverse_idx]
+
+            return_dict[modality] = self._process(modality, plan, data, l2a)
+
+        if self.sentinel2_storage == "uint16":
+            return_dict["l2a"] = l2a.astype(np.int64)
+
+        return_dict["id"] = names
+
+        return self._finalize(return_dict)
+
+    # used by torch.utils.data.DataLoader to fetch a whole batch at once (instead of calling __getitem__ per sample)
+    __getitems__ = get_batch
 
 
 def get_single_glob_file(data_root: Path, pattern) -> Path:
@@ -211,6 +418,8 @@ def create_MMEearth_args(
     with open(args.band_stats_path, "r") as f:
         args.band_stats = json.load(f)
     args.data_name = data_root.name
+    args.input_modality = input_modality
+    args.target_modality = target_modality
     modalities = copy(input_modality)
     if target_modality is not None:
         modalities.update(target_modality)
@@ -219,6 +428,48 @@ def create_MMEearth_args(
     return args
 
 
+def get_mmearth_cache_entry(
+    processed_dir: Path,
+    split: str,
+    args: Namespace,
+    indices: list[int] = None,
+    num_shards: int = 1,
+    sentinel2_storage: str = "float32",
+    backend: str = "ffcv",
+    samples_per_shard: int = None,
+) -> Tuple[Path, dict]:
+    """
+    Returns the path of the processed beton file (or shard directory if `num_shards > 1`) of a split and its cache key.
+    For the "stream" and "memmap" backends, it is the directory of the npz shards or memory mapped arrays.
+
+    The name is derived from a hash of everything that determines the content of the converted data: the modalities
+    and bands, the selected indices, the split, tile info and band stats files, the h5 file (size and modification
+    time) and `CACHE_VERSION`. A changed input therefore never reuses a stale beton file.
+    """
+    input_name = "-".join(k.replace("_", "-") for k in args.input_modality)
+    target_name = "-".join(k.replace("_", "-") for k in args.target_modality or {})
+    digest, key = get_cache_key(
+        split=split,
+        modalities=args.modalities,
+        indices=indices_digest(indices),
+        data=file_signature(args.data_path),
+        splits=file_digest(args.splits_path),
+        tile_info=file_digest(args.tile_info_path),
+        band_stats=file_digest(args.band_stats_path),
+        num_shards=num_shards,
+        sentinel2_storage=sentinel2_storage,
+        # only part of the key for other backends, to keep the names of existing beton files
+        **({} if backend == "ffcv" else {"backend": backend, "samples_per_shard": samples_per_shard}),
+    )
+    name = f"{split}_{input_name}_{target_name}_{digest}"
+    if backend in ["stream", "memmap"]:
+        return processed_dir / f"{name}_{backend}", key
+    if num_shards > 1:
+        # with sharding, the split is stored as several beton files inside this directory
+        return processed_dir / f"{name}_{num_shards}shards", key
+    return processed_dir / f"{name}.beton", key
+
+
 def get_mmearth_dataloaders(
     data_dir: Path,
     processed_dir: Path,
@@ -229,7 +480,14 @@ def get_mmearth_dataloaders(
     splits: list[str] = None,
     no_ffcv: bool = False,
     indices: list[list[int]] = None,
-) -> list[Union[ffcv.Loader, DataLoader]]:
+    num_shards: int = 1,
+    cache_max_bytes: int = None,
+    sentinel2_storage: str = "float32",
+    backend: str = "ffcv",
+    samples_per_shard: int = 512,
+    hdf5_kwargs: dict = None,
+    sequential: bool = False,
+) -> list[Union[ffcv.Loader, ShardedLoader, DataLoader, Sentinel2NormalizingLoader]]:
     """
     Creates and returns data loaders for the MMEarth dataset. If the processed beton file does not exist, it processes the data
     and creates the beton file, then returns FFCV data loaders.
@@ -251,14 +509,48 @@ def get_mmearth_dataloaders(
     splits : list[str], optional
         The dataset splits to be used. Default is ["train", "val"].
     no_ffcv: bool, optional
-        Disables the creation of beton file and return torch Dataloader instead. Default is False.
+        Disables the creation of beton file and return torch Dataloader instead. Same as `backend="hdf5"`. Default is False.
     indices: list[list[int]], optional
-        Select indices to use for each split (starting at 0). Default is None, meaning all samples are used. Only with FFCV enabled.
+        Select indices to use for each split (starting at 0). Default is None, meaning all samples are used. Not
+        supported by the "hdf5" backend.
+    num_shards: int, optional
+        Splits each split into this many beton files, which are converted one after another (resuming an interrupted
+        conversion) and chained at load time. Shards can also be converted by separate jobs beforehand, see
+        `convert_mmearth_shards`. Default is 1 (single beton file). Only with FFCV enabled.
+    cache_max_bytes: int, optional
+        If given, the least recently used processed files of other configurations in `processed_dir` are deleted
+        until all of them together take at most this many bytes. Default is None (no eviction).
+    sentinel2_storage: str, optional
+        How sentinel2 is stored, see `SENTINEL2_STORAGE`. Both "float16" and "uint16" (raw reflectance, normalized
+        after loading) halve the size of the beton files compared to the default "float32". The loaders are then
+        wrapped in a `Sentinel2NormalizingLoader` that returns normalized float32 data on the training device.
+    backend: str, optional
+        How the data is loaded, see `DATA_BACKENDS`:
+            - "ffcv": converts each split into beton files and loads them with `ffcv.Loader` (default).
+            - "hdf5": reads the samples directly from the h5 file with a `torch.utils.data.DataLoader`. For training,
+              the samples are shuffled chunk by chunk with a `ChunkAwareSampler`.
+            - "stream": exports each split into npz shards of `samples_per_shard` samples, which are read sequentially
+              by a `StreamShardDataset` (with shard level shuffling and a shuffle buffer for training). Does not need
+              FFCV and avoids random reads, e.g. on network file systems.
+            - "memmap": like "hdf5", but the processed samples of each split are cached as memory mapped `.npy` files
+              (one per modality) once, so no decoding or normalization is needed afterward. The cache is shared by
+              all runs with the same settings (e.g. pretraining and the offline evaluations).
+    samples_per_shard: int, optional
+        Number of samples per npz shard of the "stream" backend. Default is 512.
+    hdf5_kwargs: dict, optional
+        Options for opening the h5 file, e.g. the chunk cache size `rdcc_nbytes` or the driver, see `HDF5Handle`.
+        Default is None (h5py defaults).
+    sequential: bool, optional
+        Loads all splits (also "train") in order and without dropping the last batch, e.g. to compute the features
+        of every sample once. All samples are loaded on every rank, the loaders are not split over the ranks.
+        Default is False.
 
     Returns:
     -------
-    list[Union[ffcv.Loader, torch.utils.data.DataLoader]]
-        A list containing data loaders. Each loader can be either `ffcv.Loader` (for beton files) or `torch.data.DataLoader` (for standard PyTorch datasets).
+    list[Union[ffcv.Loader, ShardedLoader, torch.utils.data.DataLoader, Sentinel2NormalizingLoader]]
+        A list containing data loaders. Each loader can be either `ffcv.Loader` (for beton files), `ShardedLoader`
+        (for sharded beton files) or `torch.data.DataLoader` (for standard PyTorch datasets), wrapped in a
+        `Sentinel2NormalizingLoader` if a compact sentinel2 storage is used.
 
 
     Example Usage:
@@ -288,15 +580,22 @@ def get_mmearth_dataloaders(
     -----
     - The function checks if the processed beton file exists for each split. If it doesn't exist, it processes the data
       and creates the beton file.
+    - The beton file name contains a hash of all conversion inputs (see `get_mmearth_cache_entry`), so a processed
+      directory can be shared safely across experiments with different settings.
     - The input and target modalities are reverse looked up using `IN_MODALITIES` and `MODALITIES_FULL` respectively.
     - The `convert_mmearth` function is used to convert the dataset into beton format.
     - The `ffcv.Loader` is used to create the data loaders with appropriate pipelines for training and validation.
+    - Every input and target modality is stored in its own beton field (see `get_mmearth_fields`), the batches contain
+      them in the order of `input_modality` followed by `target_modality`.
 
     """
     if splits is None:
         splits = ["train", "val"]
-    assert not no_ffcv or (
-        no_ffcv and indices is None
+    if no_ffcv:
+        backend = "hdf5"
+    assert backend in DATA_BACKENDS, f"unknown backend '{backend}', expected one of {DATA_BACKENDS}"
+    assert backend not in ["hdf5", "memmap"] or (
+        indices is None
     ), "Providing indices is not supported in no_ffcv mode."
     assert indices is None or (len(indices) == len(splits)), (
         "If indices are given, the number of splits and number of list of indices"
@@ -308,34 +607,110 @@ def get_mmearth_dataloaders(
     else:
         processed_dir.mkdir(exist_ok=True)
 
-    # lookup input modality
-    # only one input modality at a time supported TODO
-    input_name = list(input_modality.keys())[0].replace("_", "-")
-
-    # reverse lookup target modality
-    if target_modality is None:
-        target_name = ""
-    else:
-        # only one task supported TODO
-        target_name = list(target_modality.keys())[0].replace("_", "-")
+    args = create_MMEearth_args(data_dir, input_modality, target_modality)
 
     dataloaders = []
+    cache_entries = []
     for i, split in enumerate(splits):
         is_train = split == "train"
-        subset = "" if indices is None else "_subset"
-        beton_file = processed_dir / f"{split}_{input_name}_{target_name}{subset}.beton"
+        # only the training split is shuffled (and drops the last incomplete batch)
+        shuffle = is_train and not sequential
+        idx = None if indices is None else indices[i]
+
+        if backend in ["hdf5", "memmap"]:
+            memmap_dir = None
+            if backend == "memmap":
+                memmap_dir, cache_key = get_mmearth_cache_entry(
+                    processed_dir,
+                    split,
+                    args,
+                    sentinel2_storage=sentinel2_storage,
+                    backend=backend,
+                )
+                cache_entries.append(memmap_dir)
 
-        if not beton_file.exists() or no_ffcv:
-            if not no_ffcv:
+            dataset = MMEarthDataset(
+                args,
+                split=split,
+                transform=to_tensor,
+                return_tuple=True,
+                sentinel2_storage=sentinel2_storage,
+                memmap_dir=memmap_dir,
+                hdf5_kwargs=hdf5_kwargs,
+            )
+            if len(dataset) == 0:
+                assert not is_train, "training dataset has no samples"
                 print_rank_zero(
-                    f"Processed file {beton_file} does not exist, trying to create it now."
+                    f"No samples in evaluation split '{split}', skipping it"
                 )
-                transform = None
+                dataloaders.append(None)
+                continue
+
+            if memmap_dir is not None and not is_cached(memmap_dir):
+                print_rank_zero(
+                    f"Processed file {memmap_dir} does not exist (or is incomplete), trying to create it now."
+                )
+                export_memmap_cache(
+                    MMEarthDataset(
+                        args,
+                        split=split,
+                        sentinel2_storage=sentinel2_storage,
+                        hdf5_kwargs=hdf5_kwargs,
+                    ),
+                    memmap_dir,
+                )
+                mark_cached(memmap_dir, cache_key)
+
+            # the batch sampler of the loader hands a whole batch of indices to dataset.__getitems__, which reads
+            # them with one h5py call (or memory map lookup) per modality and returns an already stacked batch
+            if shuffle and backend == "hdf5":
+                # random order that reads the h5 file chunk by chunk, so the batches come from few chunks; it splits
+                # the samples over the ranks itself, so Lightning does not replace it (see ChunkAwareSampler)
+                sampler = ChunkAwareSampler(dataset.indices, dataset.get_chunk_rows())
+                # the handle of the main process is not used by the workers
+                dataset.hdf5.close()
+            elif shuffle:
+                sampler = RandomSampler(dataset)
             else:
-                transform = to_tensor
-            args = create_MMEearth_args(data_dir, input_modality, target_modality)
+                sampler = SequentialSampler(dataset)
+            dataloader = DataLoader(
+                dataset,
+                sampler=sampler,
+                batch_size=batch_size_per_device,
+                drop_last=shuffle,
+                collate_fn=default_convert,
+                num_workers=num_workers,
+                persistent_workers=num_workers > 0,
+            )
+            dataloaders.append(
+                wrap_sentinel2_loader(dataloader, args, sentinel2_storage)
+            )
+            continue
+
+        cache_entry, cache_key = get_mmearth_cache_entry(
+            processed_dir,
+            split,
+            args,
+            idx,
+            num_shards,
+            sentinel2_storage,
+            backend,
+            samples_per_shard,
+        )
+        cache_entries.append(cache_entry)
+
+        if not is_cached(cache_entry):
+            print_rank_zero(
+                f"Processed file {cache_entry} does not exist (or is incomplete), trying to create it now."
+            )
             dataset = MMEarthDataset(
-                args, split=split, transform=transform, return_tuple=True
+                args,
+                split=split,
+                transform=None,
+                # the stream export reads whole shards with get_batch, which then returns a dict
+                return_tuple=backend == "ffcv",
+                sentinel2_storage=sentinel2_storage,
+                hdf5_kwargs=hdf5_kwargs,
             )
 
             if len(dataset) == 0:
@@ -346,70 +721,189 @@ def get_mmearth_dataloaders(
                 dataloaders.append(None)
                 continue
 
-            if no_ffcv:
-                dataloader = DataLoader(
+            if backend == "stream":
+                # existing shards are kept, so an interrupted export is resumed
+                export_stream_shards(
+                    dataset, cache_entry, samples_per_shard, indices=idx
+                )
+            elif num_shards > 1:
+                # only the missing shards are converted, so an interrupted conversion is resumed
+                convert_to_beton_shards(
                     dataset,
-                    batch_size=batch_size_per_device,
-                    shuffle=is_train,
+                    cache_entry,
+                    num_shards,
+                    convert_fn=convert_mmearth_to_beton,
+                    indices=idx,
                     num_workers=num_workers,
-                    drop_last=is_train,
-                    persistent_workers=num_workers > 0,
+                    sentinel2_storage=sentinel2_storage,
                 )
-                dataloaders.append(dataloader)
-                continue
             else:
-                input_shape = (
-                    sum([len(input_modality[k]) for k in input_modality]),
-                    ori_input_size,
-                    ori_input_size,
-                )
-                idx = None if indices is None else indices[i]
+                # write to a temporary file first, so that an interrupted conversion is never picked up
+                tmp_file = cache_entry.with_suffix(".beton.tmp")
                 convert_mmearth_to_beton(
                     dataset,
-                    beton_file,
+                    tmp_file,
                     num_workers=num_workers,
-                    input_shape=input_shape,
                     indices=idx,
+                    sentinel2_storage=sentinel2_storage,
                 )
-
-        # Data decoding and augmentation
-        # Pipeline for each data field
-        pipelines = {
-            "sentinel2": [NDArrayDecoder(), ToTensor()],
-        }
-
-        if target_modality is not None:
-            pipelines.update(
-                {
-                    "label": [
-                        IntDecoder(),
-                        ToTensor(),
-                        Squeeze([1]),
-                    ],  # this will only work for classification TODO
-                }
+                os.replace(tmp_file, cache_entry)
+            mark_cached(cache_entry, cache_key)
+
+        if backend == "stream":
+            # the shards are split over the ranks and workers by the dataset itself, sequential loaders read all
+            # samples on every rank
+            dataloader = DataLoader(
+                StreamShardDataset(
+                    cache_entry,
+                    shuffle=shuffle,
+                    rank=0 if sequential else None,
+                    world_size=1 if sequential else None,
+                ),
+                batch_size=batch_size_per_device,
+                drop_last=shuffle,
+                num_workers=num_workers,
+                persistent_workers=num_workers > 0,
             )
-
         # Replaces PyTorch data loader (`torch.utils.data.Dataloader`)
-        dataloader = ffcv.Loader(
-            beton_file,
-            batch_size=batch_size_per_device,
-            num_workers=num_workers,
-            order=OrderOption.QUASI_RANDOM if is_train else OrderOption.SEQUENTIAL,
-            pipelines=pipelines,
-            drop_last=is_train,
-        )
+        elif num_shards > 1:
+            # the shards are chained at load time
+            dataloader = ShardedLoader(
+                [
+                    get_mmearth_ffcv_loader(
+                        get_shard_path(cache_entry, shard_id, num_shards),
+                        args.modalities,
+                        num_workers,
+                        batch_size_per_device,
+                        shuffle,
+                        sentinel2_storage,
+                        # the incomplete batches of the shards are merged by the ShardedLoader
+                        drop_last=False,
+                    )
+                    for shard_id in range(num_shards)
+                ],
+                shuffle=shuffle,
+                batch_size=batch_size_per_device,
+            )
+        else:
+            dataloader = get_mmearth_ffcv_loader(
+                cache_entry,
+                args.modalities,
+                num_workers,
+                batch_size_per_device,
+                shuffle,
+                sentinel2_storage,
+            )
 
-        dataloaders.append(dataloader)
+        dataloaders.append(wrap_sentinel2_loader(dataloader, args, sentinel2_storage))
+
+    if cache_max_bytes is not None:
+        # least recently used beton files of other configurations are removed first
+        evict_cache(processed_dir, cache_max_bytes, keep=cache_entries)
 
     return dataloaders
 
 
+def wrap_sentinel2_loader(
+    dataloader, args: Namespace, sentinel2_storage: str
+) -> Union[ffcv.Loader, ShardedLoader, DataLoader, Sentinel2NormalizingLoader]:
+    """Wraps the loader in a `Sentinel2NormalizingLoader` if sentinel2 is not stored as normalized float32."""
+    if sentinel2_storage == "float32":
+        return dataloader
+    plan = compile_read_plan(
+        "sentinel2", args.modalities["sentinel2"], args.band_stats, args.modalities_full
+    )
+    mean, std = get_sentinel2_norm(plan.norm)
+    modalities = list(args.modalities)
+    return Sentinel2NormalizingLoader(
+        dataloader,
+        sentinel2_storage,
+        mean,
+        std,
+        sentinel2_index=modalities.index("sentinel2"),
+        # the l2a flag follows the modalities, see MMEarthDataset.__getitem__
+        l2a_index=len(modalities),
+    )
+
+
+def get_mmearth_fields(
+    modalities: dict,
+    sentinel2_storage: str = "float32",
+    image_size: int = ori_input_size,
+) -> Dict[str, ffcv.fields.Field]:
+    """
+    Returns one beton field per modality (named like the modality, in the order of `modalities`), matching what
+    `MMEarthDataset` returns for it:
+        - IntField for classification (the class index).
+        - FloatField for regression of a single value, else NDArrayField(dtype=float32, shape=(c,)).
+        - NDArrayField(dtype=int64, shape=(c, image_size, image_size)) for segmentation.
+        - NDArrayField(dtype=float32, shape=(c, image_size, image_size)) for regression map. For sentinel2, the data
+          type depends on `sentinel2_storage`.
+    With the "uint16" sentinel2 storage, an IntField "l2a" is appended.
+    """
+    fields = OrderedDict()
+    for modality, bands in modalities.items():
+        c = len(MODALITIES_FULL[modality]) if bands == "all" else len(bands)
+        dtype = get_modality_dtype(modality, sentinel2_storage)
+        task = MODALITY_TASK[modality]
+        if task == "classification":
+            # the one hot encoding is turned into the class index by the dataset
+            fields[modality] = IntField()
+        elif task == "regression" and c == 1:
+            fields[modality] = FloatField()
+        elif task == "regression":
+            fields[modality] = NDArrayField(dtype=dtype, shape=(c,))
+        else:
+            fields[modality] = NDArrayField(dtype=dtype, shape=(c, image_size, image_size))
+
+    if sentinel2_storage == "uint16":
+        # comes after the modalities, see MMEarthDataset.__getitem__
+        fields["l2a"] = IntField()
+    return fields
+
+
+def get_mmearth_pipelines(fields: Dict[str, ffcv.fields.Field]) -> Dict[str, list]:
+    """Builds the decoding pipeline for each field of `get_mmearth_fields`."""
+    pipelines = {}
+    for name, field in fields.items():
+        if isinstance(field, IntField):
+            pipelines[name] = [IntDecoder(), ToTensor(), Squeeze([1])]
+        elif isinstance(field, FloatField):
+            pipelines[name] = [FloatDecoder(), ToTensor(), Squeeze([1])]
+        else:
+            pipelines[name] = [NDArrayDecoder(), ToTensor()]
+    return pipelines
+
+
+def get_mmearth_ffcv_loader(
+    beton_file: Path,
+    modalities: dict,
+    num_workers: int,
+    batch_size_per_device: int,
+    is_train: bool,
+    sentinel2_storage: str = "float32",
+    drop_last: Optional[bool] = None,
+) -> ffcv.Loader:
+    # Data decoding and augmentation
+    # Pipeline for each data field, the fields are returned in the order of the modalities
+    pipelines = get_mmearth_pipelines(get_mmearth_fields(modalities, sentinel2_storage))
+
+    return ffcv.Loader(
+        beton_file,
+        batch_size=batch_size_per_device,
+        num_workers=num_workers,
+        order=OrderOption.QUASI_RANDOM if is_train else OrderOption.SEQUENTIAL,
+        pipelines=pipelines,
+        drop_last=is_train if drop_last is None else drop_last,
+    )
+
+
 def convert_mmearth_to_beton(
     dataset: MMEarthDataset,
     write_path: Path,
-    input_shape: Tuple[int, int, int] = (12, 128, 128),
     num_workers: int = -1,
     indices: list = None,
+    sentinel2_storage: str = "float32",
 ):
     """
     Converts a MMEarth dataset into a format optimized for a specified machine learning task and writes it to a specified path.
@@ -420,29 +914,33 @@ def convert_mmearth_to_beton(
         The dataset to be converted and written. It should be compatible with the DatasetWriter's from_indexed_dataset method.
     write_path : Path
         The file path where the transformed dataset will be written.
-    input_shape : Tuple[int, int, int], optional
-        The shape of the input data, used to define the shape of the sentinel2 and label fields when applicable. Default is (12, 128, 128).
     num_workers : int, optional
         The number of worker threads to use for writing the dataset. A value of -1 indicates that the default number of workers should be used. Default is -1.
     indices : list, optional
         Indices to select from dataset, good for subset creation.
+    sentinel2_storage : str, optional
+        Data type of the sentinel2 field, see `SENTINEL2_STORAGE`. Needs to match the `sentinel2_storage` of the
+        dataset. Default is "float32".
 
     Fields:
     ------
+    One field per modality of the dataset, named like the modality (see `get_mmearth_fields`):
     sentinel2 : NDArrayField
-        A field for storing Sentinel-2 data with a specified shape and data type float32.
-    label : IntField or FloatField or NDArrayField
-        A field for storing labels, the type of which depends on the supervised_task parameter:
+        A field for storing Sentinel-2 data with a specified shape and data type float32 (normalized), float16
+        (normalized) or int16 (raw uint16 reflectance).
+    <other modalities> : IntField or FloatField or NDArrayField
+        The type depends on the task of the modality (`MODALITY_TASK`):
             - IntField for classification.
-            - NDArrayField(dtype=np.dtype("float32"), shape=(c)) for regression.
-            - NDArrayField(dtype=np.dtype("int64"), shape=(c, input_shape[1], input_shape[2])) for segmentation.
-            - NDArrayField(dtype=np.dtype("float32"), shape=(c, input_shape[1], input_shape[2])) for regression map.
+            - FloatField for regression of a single value, NDArrayField(dtype=np.dtype("float32"), shape=(c,)) else.
+            - NDArrayField(dtype=np.dtype("int64"), shape=(c, 128, 128)) for segmentation.
+            - NDArrayField(dtype=np.dtype("float32"), shape=(c, 128, 128)) for regression map.
+    l2a : IntField
+        Only for the "uint16" storage, 1 if the sample is a sentinel2 l2a product, 0 for l1c.
 
     Process:
     -------
     1. Field Initialization:
-        Initializes the fields dictionary with a sentinel2 field.
-        Adds a label field to the fields dictionary based on the supervised_task.
+        Creates a field for every modality of the dataset based on its task.
     2. Dataset Writing:
         Creates a DatasetWriter instance with the specified write_path, fields, and num_workers.
         Writes the dataset using the from_indexed_dataset method of the DatasetWriter.
@@ -459,65 +957,118 @@ def convert_mmearth_to_beton(
     convert_mmearth(
         dataset=my_dataset,
         write_path=Path('/path/to/save/dataset'),
-        input_shape=(12, 128, 128),
         num_workers=4
     )
     ```
     """
 
-    fields = {
-        # Tune options to optimize dataset size, throughput at train-time
-        "sentinel2": NDArrayField(dtype=np.dtype("float32"), shape=input_shape),
-    }
-
-    # if more than 1 modality is selected, we expect the second one to be the supervised task
-    if len(dataset.modalities) >= 2:
-        # only supporting single task here, so check the task and prepare fiel accordingly
-        assert (
-            len(dataset.modalities) == 2
-        ), f"only two modalities should be returned, got: {dataset.modalities.keys()}"
-        target_name, targets = [
-            (k, v) for k, v in dataset.modalities.items() if k != "sentinel2"
-        ][0]
-        c = len(targets)  # number targets
-        supervised_task = MODALITY_TASK[target_name]
-
-        if supervised_task == "classification":
-            if c == 1:
-                fields.update({"label": IntField()})
-            else:
-                fields.update(
-                    {"label": NDArrayField(dtype=np.dtype("int64"), shape=(c,))}
-                )
-
-        elif supervised_task == "segmentation":
-            fields.update(
-                {
-                    "label": NDArrayField(
-                        dtype=np.dtype("int64"),
-                        shape=(c, input_shape[1], input_shape[2]),
-                    )
-                }
-            )
-        elif supervised_task == "regression":
-            if c == 1:
-                fields.update({"label": FloatField()})
-            else:
-                fields.update(
-                    {"label": NDArrayField(dtype=np.dtype("float32"), shape=(c,))}
-                )
-        elif supervised_task == "regression_map":
-            fields.update(
-                {
-                    "label": NDArrayField(
-                        dtype=np.dtype("float32"),
-                        shape=(c, input_shape[1], input_shape[2]),
-                    )
-                }
-            )
+    assert (
+        dataset.sentinel2_storage == sentinel2_storage
+    ), f"dataset returns {dataset.sentinel2_storage} sentinel2 data, not {sentinel2_storage}"
+    # Tune options to optimize dataset size, throughput at train-time
+    fields = get_mmearth_fields(dataset.modalities, sentinel2_storage)
 
     # Pass a type for each data field
     writer = DatasetWriter(write_path, fields, num_workers=num_workers)
 
     # Write dataset
     writer.from_indexed_dataset(dataset, indices=indices)
+
+
+def convert_mmearth_shards(
+    data_dir: Path,
+    processed_dir: Path,
+    input_modality: dict,
+    target_modality: dict,
+    split: str,
+    num_shards: int,
+    shard_ids: list[int] = None,
+    num_processes: int = 1,
+    num_workers: int = -1,
+    sentinel2_storage: str = "float32",
+) -> list[int]:
+    """
+    Converts (some of) the shards of a split, such that `get_mmearth_dataloaders(..., num_shards=num_shards)` finds
+    them. Meant to spread the conversion over several processes or cluster jobs, e.g. with job k of n running:
+
+    `python -m data.mmearth_dataset --split train --num-shards 64 --shard-ids $(seq k n 63)`
+
+    Returns the ids of all completed shards.
+    """
+    if processed_dir is None:
+        processed_dir = data_dir
+    processed_dir.mkdir(exist_ok=True)
+
+    args = create_MMEearth_args(data_dir, input_modality, target_modality)
+    shard_dir, cache_key = get_mmearth_cache_entry(
+        processed_dir,
+        split,
+        args,
+        num_shards=num_shards,
+        sentinel2_storage=sentinel2_storage,
+    )
+    dataset = MMEarthDataset(
+        args,
+        split=split,
+        transform=None,
+        return_tuple=True,
+        sentinel2_storage=sentinel2_storage,
+    )
+    completed = convert_to_beton_shards(
+        dataset,
+        shard_dir,
+        num_shards,
+        convert_fn=convert_mmearth_to_beton,
+        shard_ids=shard_ids,
+        num_processes=num_processes,
+        num_workers=num_workers,
+        sentinel2_storage=sentinel2_storage,
+    )
+    if len(completed) == num_shards:
+        mark_cached(shard_dir, cache_key)
+    return completed
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    from .constants import IN_MODALITIES, MMEARTH_DIR
+
+    parser = ArgumentParser("Sharded MMEarth beton conversion")
+    parser.add_argument("--data-dir", type=Path, default=MMEARTH_DIR)
+    parser.add_argument("--processed-dir", type=Path, default=None)
+    parser.add_argument("--split", type=str, default="train")
+    parser.add_argument("--input-channel", "-i", type=str, default="all")
+    parser.add_argument("--target", "-t", type=str, default="biome")
+    parser.add_argument("--num-shards", type=int, required=True)
+    parser.add_argument(
+        "--shard-ids",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Shards converted by this job (default: all shards).",
+    )
+    parser.add_argument("--num-processes", type=int, default=1)
+    parser.add_argument("--num-workers", type=int, default=-1)
+    parser.add_argument(
+        "--sentinel2-storage",
+        type=str,
+        default="float32",
+        choices=list(SENTINEL2_STORAGE),
+    )
+    cli_args = parser.parse_args()
+
+    target = None if cli_args.target.lower() == "none" else cli_args.target
+    completed = convert_mmearth_shards(
+        data_dir=cli_args.data_dir,
+        processed_dir=cli_args.processed_dir,
+        input_modality=IN_MODALITIES[cli_args.input_channel],
+        target_modality=None if target is None else {target: MODALITIES_FULL[target]},
+        split=cli_args.split,
+        num_shards=cli_args.num_shards,
+        shard_ids=cli_args.shard_ids,
+        num_processes=cli_args.num_processes,
+        num_workers=cli_args.num_workers,
+        sentinel2_storage=cli_args.sentinel2_storage,
+    )
+    print(f"{len(completed)} of {cli_args.num_shards} shards completed")
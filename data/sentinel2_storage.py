@@ -0,0 +1,101 @@
+from typing import Optional
+
+import numpy as np
+import torch
+
+from .constants import NO_DATA_VAL, SENTINEL2_STORAGE
+
+
+def get_sentinel2_norm(norm: dict) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Stacks the sentinel2 statistics of a compiled read plan (see `compile_read_plan`) into mean and std arrays of
+    shape (2, C, 1, 1), which are indexed with the l2a flag (0: l1c, 1: l2a).
+    """
+    stats = [norm["sentinel2_l1c"], norm["sentinel2_l2a"]]
+    mean = np.stack([m for m, _ in stats])
+    std = np.stack([s for _, s in stats])
+    return mean, std
+
+
+class Sentinel2NormalizingLoader:
+    """
+    Wraps a loader of compactly stored sentinel2 data (see `SENTINEL2_STORAGE`) and turns every batch into the same
+    normalized float32 batch the default storage would yield.
+
+    The batch is moved to the training device first, so that the (cheap) conversion runs on the GPU instead of the
+    data loading workers:
+        - "float16": the already normalized values are cast to float32.
+        - "uint16": the raw reflectance (stored as int16) is normalized with the l1c or l2a statistics of each sample,
+          selected by the "l2a" entry of the batch, which is removed afterward.
+
+    All other attributes are passed through to the wrapped loader.
+    """
+
+    def __init__(
+        self,
+        loader,
+        storage: str,
+        mean: np.ndarray,
+        std: np.ndarray,
+        sentinel2_index: int = 0,
+        l2a_index: Optional[int] = None,
+        device: Optional[torch.device] = None,
+    ):
+        assert storage in SENTINEL2_STORAGE, f"unknown sentinel2 storage '{storage}'"
+        assert (
+            storage != "uint16" or l2a_index is not None
+        ), "the l2a flag is needed to normalize raw sentinel2 data"
+        self.loader = loader
+        self.storage = storage
+        self.mean = torch.from_numpy(mean)
+        self.std = torch.from_numpy(std)
+        self.sentinel2_index = sentinel2_index
+        self.l2a_index = l2a_index
+        self.device = device
+        self._stats = {}
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        # only called if the attribute is not found on the wrapper itself
+        if name == "loader":
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def _get_device(self) -> torch.device:
+        if self.device is not None:
+            return self.device
+        # resolved when iterating, since the trainer selects the device of each process only after setup
+        if torch.cuda.is_available():
+            return torch.device("cuda", torch.cuda.current_device())
+        return torch.device("cpu")
+
+    def _get_stats(self, device: torch.device) -> tuple[torch.Tensor, torch.Tensor]:
+        if device not in self._stats:
+            self._stats[device] = (self.mean.to(device), self.std.to(device))
+        return self._stats[device]
+
+    def normalize(self, batch):
+        batch = list(batch)
+        device = self._get_device()
+        x = batch[self.sentinel2_index].to(device, non_blocking=True)
+
+        if self.storage == "uint16":
+            l2a = batch.pop(self.l2a_index)
+            l2a = torch.as_tensor(l2a).to(device, non_blocking=True).long().view(-1)
+            mean, std = self._get_stats(device)
+            # the bits of the int16 values are reinterpreted as uint16 reflectance
+            x = (x.to(torch.int32) & 0xFFFF).float()
+            x = (x - mean[l2a]) / std[l2a]
+            # converting the nodata values to nan, as it is done for the float32 storage
+            x[x == NO_DATA_VAL["sentinel2"]] = torch.nan
+        else:
+            x = x.float()
+
+        batch[self.sentinel2_index] = x
+        return tuple(batch)
+
+    def __iter__(self):
+        for batch in self.loader:
+            yield self.normalize(batch)
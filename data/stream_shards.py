@@ -0,0 +1,211 @@
+import json
+import math
+import os
+import random
+from pathlib import Path
+from typing import Iterator, Optional
+
+import numpy as np
+import torch.distributed as dist
+from lightly.utils.dist import print_rank_zero
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+
+MANIFEST_NAME = "manifest.json"
+
+
+def get_stream_shard_path(shard_dir: Path, shard_id: int) -> Path:
+    return shard_dir / f"shard_{shard_id:05d}.npz"
+
+
+def export_stream_shards(
+    dataset: Dataset,
+    shard_dir: Path,
+    samples_per_shard: int,
+    indices: list[int] = None,
+    keys: list[str] = None,
+) -> dict:
+    """
+    Exports a dataset into fixed-size npz shards that can be streamed with `StreamShardDataset`.
+
+    The samples are read with `dataset.get_batch` (one batch per shard, in ascending order), so the source is read
+    sequentially. Shards are written to a temporary file first and shards that exist already are skipped, so an
+    interrupted export is resumed.
+
+    Parameters:
+    ----------
+    dataset : Dataset
+        The dataset to export, `get_batch` needs to return a dict of stacked arrays.
+    shard_dir : Path
+        Directory for the shards and the manifest.
+    samples_per_shard : int
+        Number of samples per shard, only the last shard can be smaller.
+    indices : list[int], optional
+        Indices to select from the dataset. Default is None, meaning all samples are used.
+    keys : list[str], optional
+        Entries of the batches that are stored, in the order they are returned when streaming. Default is None,
+        meaning all entries except "id".
+
+    Returns:
+    -------
+    dict
+        The manifest, also written to `shard_dir / MANIFEST_NAME` once all shards are complete.
+    """
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    if indices is None:
+        indices = list(range(len(dataset)))
+    indices = list(indices)
+    shard_starts = list(range(0, len(indices), samples_per_shard))
+
+    print_rank_zero(
+        f"Exporting {len(indices)} samples into {len(shard_starts)} shards at {shard_dir}."
+    )
+    for shard_id, start in enumerate(shard_starts):
+        shard_path = get_stream_shard_path(shard_dir, shard_id)
+        if shard_path.exists():
+            continue
+        batch = dataset.get_batch(indices[start : start + samples_per_shard])
+        if keys is None:
+            keys = [k for k in batch if k != "id"]
+        # np.savez appends .npz to names without that suffix
+        tmp_path = shard_path.with_suffix(f".{os.getpid()}.tmp.npz")
+        np.savez(tmp_path, **{k: np.asarray(batch[k]) for k in keys})
+        os.replace(tmp_path, shard_path)
+
+    if keys is None:
+        keys = list(np.load(get_stream_shard_path(shard_dir, 0)).files)
+    manifest = {
+        "num_samples": len(indices),
+        "samples_per_shard": samples_per_shard,
+        "num_shards": len(shard_starts),
+        "keys": keys,
+    }
+    # written last, marks the export as complete
+    with open(shard_dir / MANIFEST_NAME, "w") as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def _get_rank_and_world_size() -> tuple[int, int]:
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+class StreamShardDataset(IterableDataset):
+    """
+    Streams the samples of npz shards written by `export_stream_shards`, reading every shard sequentially.
+
+    Each rank and each data loading worker reads its own subset of the shards. For training, the order of the shards
+    is shuffled in every epoch (with the same seed on all ranks) and the samples are shuffled with an in-memory buffer
+    of `shuffle_buffer_size` samples. To give every rank the same number of samples, training drops the (smaller)
+    last shard (unless it is the only one) and repeats shards until they can be distributed evenly over the ranks,
+    as the `DistributedSampler` pads its indices, so every rank gets at least one shard. Without shuffling, every rank
+    reads an equally long, contiguous range of the samples in order, padded by repeating the first samples (as the
+    `DistributedSampler`), so all ranks run the same number of (e.g. validation) steps.
+
+    The ranks are taken from the process group, unless `rank` and `world_size` are given, e.g. `world_size=1` to
+    read all samples on one rank (as when encoding a split on rank zero only).
+
+    The epoch is counted per worker, so the loader should use `persistent_workers=True` (or no workers) to get a new
+    shard order in every epoch.
+    """
+
+    def __init__(
+        self,
+        shard_dir: Path,
+        shuffle: bool,
+        shuffle_buffer_size: int = 1000,
+        seed: int = 0,
+        rank: Optional[int] = None,
+        world_size: Optional[int] = None,
+    ):
+        assert (rank is None) == (world_size is None), "rank and world_size need to be given together"
+        with open(shard_dir / MANIFEST_NAME, "r") as f:
+            self.manifest = json.load(f)
+        self.shard_dir = shard_dir
+        self.keys = self.manifest["keys"]
+        self.shuffle = shuffle
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.epoch = 0
+        self.rank = rank
+        self.world_size = world_size
+
+    def _get_rank_and_world_size(self) -> tuple[int, int]:
+        if self.world_size is not None:
+            return self.rank, self.world_size
+        return _get_rank_and_world_size()
+
+    def _get_shards(self, epoch: int, rank: int, world_size: int) -> list[int]:
+        shards = list(range(self.manifest["num_shards"]))
+        if self.shuffle:
+            num_samples = self.manifest["num_samples"]
+            if num_samples % self.manifest["samples_per_shard"] != 0 and len(shards) > 1:
+                shards = shards[:-1]
+            random.Random(self.seed + epoch).shuffle(shards)
+            # repeat shards (in the shuffled order) up to a multiple of the number of ranks
+            num_padded = -len(shards) % world_size
+            shards += [shards[i % len(shards)] for i in range(num_padded)]
+        return shards[rank::world_size]
+
+    def _shard_size(self, shard_id: int) -> int:
+        return min(
+            self.manifest["samples_per_shard"],
+            self.manifest["num_samples"] - shard_id * self.manifest["samples_per_shard"],
+        )
+
+    def _get_segments(self, epoch: int, rank: int, world_size: int) -> list[tuple[int, int, int]]:
+        # (shard id, start, stop) of the samples a rank reads
+        if self.shuffle:
+            shards = self._get_shards(epoch, rank, world_size)
+            return [(shard_id, 0, self._shard_size(shard_id)) for shard_id in shards]
+        num_samples = self.manifest["num_samples"]
+        samples_per_rank = math.ceil(num_samples / world_size)
+        segments = []
+        # positions past the end wrap around to the first samples
+        pos, end = rank * samples_per_rank, (rank + 1) * samples_per_rank
+        while pos < end:
+            shard_id, start = divmod(pos % num_samples, self.manifest["samples_per_shard"])
+            stop = min(self._shard_size(shard_id), start + end - pos)
+            segments.append((shard_id, start, stop))
+            pos += stop - start
+        return segments
+
+    def __len__(self):
+        rank, world_size = self._get_rank_and_world_size()
+        return sum(stop - start for _, start, stop in self._get_segments(0, rank, world_size))
+
+    def _read_shards(self, segments: list[tuple[int, int, int]]) -> Iterator[tuple]:
+        for shard_id, start, stop in segments:
+            with np.load(get_stream_shard_path(self.shard_dir, shard_id)) as shard:
+                arrays = [shard[k] for k in self.keys]
+            for i in range(start, stop):
+                yield tuple(a[i] for a in arrays)
+
+    def __iter__(self):
+        rank, world_size = self._get_rank_and_world_size()
+        segments = self._get_segments(self.epoch, rank, world_size)
+        worker_info = get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+        if worker_info is not None:
+            segments = segments[worker_id :: worker_info.num_workers]
+        samples = self._read_shards(segments)
+
+        if not self.shuffle:
+            yield from samples
+        else:
+            rng = random.Random(hash((self.seed, self.epoch, rank, worker_id)))
+            buffer = []
+            for sample in samples:
+                if len(buffer) < self.shuffle_buffer_size:
+                    buffer.append(sample)
+                    continue
+                # emit a random sample of the buffer and put the new one in its place
+                i = rng.randrange(len(buffer))
+                buffer[i], sample = sample, buffer[i]
+                yield sample
+            rng.shuffle(buffer)
+            yield from buffer
+
+        self.epoch += 1
+
@@ -1,7 +1,8 @@
 from .finetune import finetune_eval
+from .frozen_eval import frozen_eval
 from .geobench_clf import geobench_clf_eval
 from .knn import knn_eval
 from .linear import linear_eval
 
 
-__all__ = ["knn_eval", "linear_eval", "finetune_eval", "geobench_clf_eval"]
+__all__ = ["knn_eval", "linear_eval", "finetune_eval", "geobench_clf_eval", "frozen_eval"]
@@ -0,0 +1,374 @@
+import hashlib
+import os
+import random
+import time
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Callable, Optional
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from lightly.utils.dist import print_rank_zero
+from pytorch_lightning.utilities import rank_zero_only
+from torch import Tensor
+from torch.nn import Module
+from numpy.lib.format import open_memmap
+from torch.utils.data import DataLoader, Dataset, default_convert
+
+from data.dataloader_utils import get_num_samples
+from data.beton_cache import get_cache_key, is_cached, mark_cached
+from data.mmearth_dataset import (
+    create_MMEearth_args,
+    get_mmearth_cache_entry,
+    get_mmearth_dataloaders,
+)
+
+FEATURES_NAME = "features.npy"
+LABELS_NAME = "labels.npy"
+
+# fixed test time augmentation views (horizontal flip, vertical flip), the first view is the original image
+TTA_VIEWS = {
+    "none": [(False, False)],
+    "flip": [(False, False), (True, False), (False, True), (True, True)],
+}
+
+
+def model_digest(model: Module) -> str:
+    """sha256 of the parameters and buffers of a model, identifies the checkpoint the embeddings are computed with."""
+    h = hashlib.sha256()
+    for name, value in model.state_dict().items():
+        h.update(name.encode())
+        value = value.detach().cpu().contiguous().reshape(-1)
+        h.update(str(value.dtype).encode())
+        h.update(value.view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+
+def get_embedding_cache_entry(
+    cache_dir: Path, model_hash: str, dataset_key: dict, tta: str
+) -> tuple[Path, dict]:
+    """
+    Returns the directory of the cached embeddings of one split and its cache key, named by the hash of the model, the
+    dataset and the views.
+    """
+    digest, key = get_cache_key(model=model_hash, dataset=dataset_key, tta=tta)
+    return cache_dir / f"embeddings_{digest}", key
+
+
+def _apply_view(x: Tensor, hflip: bool, vflip: bool) -> Tensor:
+    dims = [d for d, flip in [(-1, hflip), (-2, vflip)] if flip]
+    return x.flip(dims) if dims else x
+
+
+@torch.no_grad()
+def encode_dataloader(
+    model: Module,
+    dataloader,
+    tta: str = "none",
+    device: Optional[torch.device] = None,
+    features_path: Optional[Path] = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Computes the features (`model(images)`, flattened) of all batches of a dataloader for every view in
+    `TTA_VIEWS[tta]`.
+
+    The features are written batch by batch into a float16 array that is allocated for all samples (see
+    `get_num_samples`) after the first batch, so only the bank itself is held in memory. With `features_path`, the
+    array is a memory mapped `.npy` file instead.
+
+    Returns the features of shape (N, V, D) and the labels (`batch[1]`) of shape (N, ...).
+    """
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    was_training = model.training
+    model.eval().to(device)
+    autocast = (
+        torch.autocast(device_type="cuda", dtype=torch.float16)
+        if device.type == "cuda"
+        else nullcontext()
+    )
+
+    num_samples = get_num_samples(dataloader)
+    features, labels = None, None
+    num_written = 0
+    with autocast:
+        for batch in dataloader:
+            images = batch[0].to(device, non_blocking=True)
+            views = [
+                model(_apply_view(images, *view)).flatten(start_dim=1)
+                for view in TTA_VIEWS[tta]
+            ]
+            batch_features = torch.stack(views, dim=1).half().cpu().numpy()
+            batch_labels = torch.as_tensor(batch[1]).cpu().numpy()
+            if features is None:
+                # the feature dimension and the label shape are known from the first batch
+                shape = (num_samples, *batch_features.shape[1:])
+                if features_path is None:
+                    features = np.empty(shape, dtype=np.float16)
+                else:
+                    features = open_memmap(features_path, mode="w+", dtype=np.float16, shape=shape)
+                labels = np.empty((num_samples, *batch_labels.shape[1:]), dtype=batch_labels.dtype)
+            end = num_written + len(batch_features)
+            assert end <= num_samples, f"the dataloader returned more than {num_samples} samples"
+            features[num_written:end] = batch_features
+            labels[num_written:end] = batch_labels
+            num_written = end
+
+    model.train(was_training)
+    assert num_written == num_samples, f"got {num_written} of {num_samples} samples, was the last batch dropped?"
+    return features, labels
+
+
+def write_embeddings(entry: Path, features: np.ndarray, labels: np.ndarray, key: dict):
+    entry.mkdir(parents=True, exist_ok=True)
+    for name, array in [(FEATURES_NAME, features), (LABELS_NAME, labels)]:
+        if isinstance(array, np.memmap):
+            # already written to a temporary file by `encode_dataloader`
+            array.flush()
+            os.replace(array.filename, entry / name)
+            continue
+        tmp_path = entry / f"{os.getpid()}.tmp.{name}"
+        np.save(tmp_path, array)
+        os.replace(tmp_path, entry / name)
+    # written last, marks the entry as complete
+    mark_cached(entry, key)
+
+
+class EmbeddingDataset(Dataset):
+    """
+    Cached embeddings of one split, memory mapped from the directory written by `write_embeddings`.
+
+    With `random_view=True` (training), every sample returns the features of a random view, e.g. one of the flipped
+    images for the "flip" views, which replaces the flip augmentation of the images. Otherwise, the features of the
+    original image are returned.
+    """
+
+    def __init__(self, entry: Path, random_view: bool = False):
+        self.entry = entry
+        self.random_view = random_view
+        self.features = np.load(entry / FEATURES_NAME, mmap_mode="r")
+        self.labels = np.load(entry / LABELS_NAME, mmap_mode="r")
+        self.feature_dim = self.features.shape[-1]
+
+    def __len__(self):
+        return len(self.features)
+
+    def __getstate__(self):
+        # memory maps are pickled as full copies, the workers open the files again
+        state = self.__dict__.copy()
+        state.pop("features")
+        state.pop("labels")
+        return state
+
+    def __setstate__(self, state):
+        self.__init__(state["entry"], state["random_view"])
+
+    def __getitems__(self, indices: list[int]) -> tuple[Tensor, Tensor]:
+        indices = np.asarray(indices)
+        num_views = self.features.shape[1]
+        if self.random_view and num_views > 1:
+            views = np.array([random.randrange(num_views) for _ in indices])
+        else:
+            views = np.zeros(len(indices), dtype=int)
+        # memory maps are read faster in ascending order
+        order = np.argsort(indices)
+        features = np.empty((len(indices), self.feature_dim), dtype=np.float32)
+        features[order] = self.features[indices[order], views[order]]
+        labels = np.asarray(self.labels[indices])
+        return torch.from_numpy(features), torch.from_numpy(labels)
+
+    def __getitem__(self, idx: int) -> tuple[Tensor, Tensor]:
+        features, labels = self.__getitems__([idx])
+        return features[0], labels[0]
+
+
+def _is_rank_zero() -> bool:
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank() == 0
+    # before a Trainer creates the process group, the rank is only known from the environment of the launcher
+    return rank_zero_only.rank == 0
+
+
+def _broadcast_from_rank_zero(value: bool) -> bool:
+    # every rank follows the decision of rank zero, so either all ranks or none of them call the barrier
+    if dist.is_available() and dist.is_initialized():
+        values = [value]
+        dist.broadcast_object_list(values, src=0)
+        return values[0]
+    return value
+
+
+def _wait_for_entries(entries: list[Path], poll_interval: float = 5.0):
+    if dist.is_available() and dist.is_initialized():
+        dist.barrier()
+        return
+    while not all(is_cached(entry) for entry in entries):
+        time.sleep(poll_interval)
+
+
+def encode_splits(
+    model: Module,
+    get_dataloaders: Callable[[], list],
+    dataset_keys: list[dict],
+    splits: list[str],
+    cache_dir: Path,
+    tta: str = "none",
+) -> list[Optional[Path]]:
+    """
+    Encodes every split once with the frozen model, so the features can be reused by several evaluations (and runs)
+    without running the backbone again. With several processes (e.g. DDP), only rank zero encodes and writes the
+    entries, the other ranks wait for them.
+
+    Parameters:
+    ----------
+    model : Module
+        The frozen model, its output is flattened to the features.
+    get_dataloaders : Callable[[], list]
+        Returns the image dataloaders of `splits` (in order and without dropping samples, e.g. with
+        `sequential=True`). Only called if an embedding is not cached yet.
+    dataset_keys : list[dict]
+        Json serializable identification of the data of each split, part of the cache key.
+    splits : list[str]
+        Names of the splits, only used for logging.
+    cache_dir : Path
+        Directory of the cached embeddings, entries are named by the hash of the model weights, the dataset key and
+        the views.
+    tta : str, optional
+        The views of `TTA_VIEWS` every image is encoded with. Default is "none".
+
+    Returns:
+    -------
+    list[Optional[Path]]
+        The cache entries of the splits (see `EmbeddingDataset`), None for splits without data (dataloader is None).
+    """
+    assert tta in TTA_VIEWS, f"unknown views '{tta}'"
+    model_hash = model_digest(model)
+    entries = [
+        get_embedding_cache_entry(cache_dir, model_hash, dataset_key, tta)
+        for dataset_key in dataset_keys
+    ]
+
+    needs_encoding = not all(is_cached(entry) for entry, _ in entries)
+    if _broadcast_from_rank_zero(needs_encoding):
+        if _is_rank_zero():
+            image_dataloaders = get_dataloaders()
+            for split, (entry, key), image_dataloader in zip(
+                splits, entries, image_dataloaders
+            ):
+                if is_cached(entry):
+                    continue
+                entry.mkdir(parents=True, exist_ok=True)
+                if image_dataloader is None:
+                    # an empty entry, so the other ranks do not wait for it
+                    mark_cached(entry, key)
+                    continue
+                print_rank_zero(f"Encoding {split} split to {entry}.")
+                features, labels = encode_dataloader(
+                    model,
+                    image_dataloader,
+                    tta,
+                    features_path=entry / f"{os.getpid()}.tmp.{FEATURES_NAME}",
+                )
+                write_embeddings(entry, features, labels, key)
+                del features
+            del image_dataloaders
+        _wait_for_entries([entry for entry, _ in entries])
+
+    return [entry if (entry / FEATURES_NAME).exists() else None for entry, _ in entries]
+
+
+def get_embedding_dataloader(
+    entry: Optional[Path],
+    batch_size_per_device: int,
+    is_train: bool,
+    num_workers: int = 0,
+) -> Optional[DataLoader]:
+    """
+    Dataloader of cached embeddings. Training batches are shuffled and use a random view of every sample, otherwise
+    all samples are returned in order with the features of the original images.
+    """
+    if entry is None:
+        return None
+    return DataLoader(
+        EmbeddingDataset(entry, random_view=is_train),
+        batch_size=batch_size_per_device,
+        shuffle=is_train,
+        drop_last=is_train,
+        num_workers=num_workers,
+        collate_fn=default_convert,
+    )
+
+
+def get_embedding_dataloaders(
+    model: Module,
+    get_dataloaders: Callable[[], list],
+    dataset_keys: list[dict],
+    splits: list[str],
+    cache_dir: Path,
+    batch_size_per_device: int,
+    num_workers: int = 0,
+    tta: str = "none",
+) -> list[Optional[DataLoader]]:
+    """
+    Encodes every split once with `encode_splits` and returns dataloaders of the cached embeddings (see
+    `get_embedding_dataloader`, the "train" split is used for training), so a linear head (with an `nn.Identity()`
+    model) can be trained without running the backbone in every epoch.
+    """
+    entries = encode_splits(model, get_dataloaders, dataset_keys, splits, cache_dir, tta)
+    return [
+        get_embedding_dataloader(entry, batch_size_per_device, split == "train", num_workers)
+        for split, entry in zip(splits, entries)
+    ]
+
+
+def get_mmearth_feature_bank(
+    model: Module,
+    input_modality: dict,
+    target_modality: dict,
+    data_dir: Path,
+    processed_dir: Path,
+    batch_size_per_device: int,
+    num_workers: int,
+    no_ffcv: bool,
+    sentinel2_storage: str = "float32",
+    data_backend: str = "ffcv",
+    splits: list[str] = None,
+    tta: str = "flip",
+) -> dict[str, Optional[Path]]:
+    """
+    Encodes the MMEarth splits (default: train and val) once with the frozen model (see `encode_splits`) and returns
+    the cache entry of each split, which can be shared by all evaluations of the frozen model. The entries are stored in
+    `processed_dir / "embeddings"` and are independent of the data backend.
+    """
+    splits = splits or ["train", "val"]
+    # same default as get_mmearth_dataloaders
+    processed_dir = processed_dir or data_dir
+    args = create_MMEearth_args(data_dir, input_modality, target_modality)
+    entries = encode_splits(
+        model,
+        lambda: get_mmearth_dataloaders(
+            data_dir,
+            processed_dir,
+            input_modality,
+            target_modality,
+            num_workers,
+            batch_size_per_device,
+            splits,
+            no_ffcv,
+            sentinel2_storage=sentinel2_storage,
+            backend=data_backend,
+            sequential=True,
+        ),
+        # identifies the converted data of each split, independent of the backend
+        [
+            get_mmearth_cache_entry(
+                processed_dir, split, args, sentinel2_storage=sentinel2_storage
+            )[1]
+            for split in splits
+        ],
+        splits,
+        processed_dir / "embeddings",
+        tta,
+    )
+    return dict(zip(splits, entries))
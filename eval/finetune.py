@@ -29,6 +29,8 @@ def finetune_eval(
     precision: str,
     num_classes: int,
     no_ffcv: bool,
+    sentinel2_storage: str = "float32",
+    data_backend: str = "ffcv",
     debug: bool = False,
 ) -> None:
     """Runs fine-tune evaluation on the given model.
@@ -66,6 +68,8 @@ def finetune_eval(
         batch_size_per_device,
         ["train", "val"],
         no_ffcv,
+        sentinel2_storage=sentinel2_storage,
+        backend=data_backend,
     )
 
     # Train linear classifier.
@@ -0,0 +1,82 @@
+from pathlib import Path
+
+from lightly.utils.dist import print_rank_zero
+from torch.nn import Module
+
+from eval.embedding_cache import get_mmearth_feature_bank
+from eval.knn import knn_eval
+from eval.linear import linear_eval
+
+FROZEN_EVALS = ["linear", "knn"]
+
+
+def frozen_eval(
+    protocols: list[str],
+    model: Module,
+    input_modality: dict,
+    target_modality: [dict],
+    data_dir: Path,
+    processed_dir: Path,
+    log_dir: Path,
+    batch_size_per_device: int,
+    num_workers: int,
+    accelerator: str,
+    devices: int,
+    precision: str,
+    num_classes: int,
+    no_ffcv: bool,
+    sentinel2_storage: str = "float32",
+    data_backend: str = "ffcv",
+    knn_engine: str = "lightly",
+    debug: bool = False,
+) -> dict[str, Path]:
+    """Runs several evaluations of the frozen model from one feature bank.
+
+    The train and val splits are encoded once (see `get_mmearth_feature_bank`), then every protocol in `protocols`
+    ("linear" or "knn", see `FROZEN_EVALS`) runs on the cached features, so a single forward pass over the data serves
+    all of them. The feature bank is cached on disk in `processed_dir / "embeddings"` and returned.
+    """
+    assert (
+        target_modality is not None
+    ), "target modality needs to be set for offline evaluation"
+    for protocol in protocols:
+        assert protocol in FROZEN_EVALS, f"unknown frozen evaluation '{protocol}'"
+    print_rank_zero(f"Computing the feature bank for {', '.join(protocols)} evaluation...")
+
+    feature_bank = get_mmearth_feature_bank(
+        model,
+        input_modality,
+        target_modality,
+        data_dir,
+        processed_dir,
+        batch_size_per_device,
+        num_workers,
+        no_ffcv,
+        sentinel2_storage,
+        data_backend,
+    )
+
+    eval_config = {
+        "model": model,
+        "input_modality": input_modality,
+        "target_modality": target_modality,
+        "data_dir": data_dir,
+        "processed_dir": processed_dir,
+        "log_dir": log_dir,
+        "batch_size_per_device": batch_size_per_device,
+        "num_workers": num_workers,
+        "accelerator": accelerator,
+        "devices": devices,
+        "num_classes": num_classes,
+        "no_ffcv": no_ffcv,
+        "sentinel2_storage": sentinel2_storage,
+        "data_backend": data_backend,
+        "feature_bank": feature_bank,
+        "debug": debug,
+    }
+    for protocol in protocols:
+        if protocol == "linear":
+            linear_eval(**eval_config, precision=precision)
+        elif protocol == "knn":
+            knn_eval(**eval_config, knn_engine=knn_engine)
+    return feature_bank
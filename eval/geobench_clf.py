@@ -7,9 +7,11 @@ from lightly.utils.dist import print_rank_zero
 from pytorch_lightning import Trainer
 from pytorch_lightning.callbacks import LearningRateMonitor, ModelCheckpoint
 from pytorch_lightning.loggers import WandbLogger
-from torch.nn import Module, Sequential
+from torch.nn import Identity, Module, Sequential
 
 from data import get_geobench_dataloaders
+from data.beton_cache import indices_digest
+from eval.embedding_cache import get_embedding_dataloaders
 from eval.helper_modules import (
     LinearMultiLabelClassifier,
     FinetuneMultiLabelClassifier,
@@ -31,6 +33,7 @@ def geobench_clf_eval(
     devices: int,
     precision: str,
     no_ffcv: bool,
+    embedding_cache: bool = False,
     debug: [bool, str] = False,
 ) -> None:
     """Runs a linear evaluation on the given model.
@@ -46,6 +49,9 @@ def geobench_clf_eval(
         - Weight Decay: 0.0
         - LR Schedule: Cosine without warmup
 
+    With `embedding_cache` (only for the linear method), every split is encoded once with the frozen backbone (the
+    train split with all flips, see `get_embedding_dataloaders`) and the linear head is trained on the cached features.
+
     References:
         - [0]: SimCLR, 2020, https://arxiv.org/abs/2002.05709
     """
@@ -67,18 +73,46 @@ def geobench_clf_eval(
     if debug and not no_ffcv:
         indices = [[i for i in range(10)] * 3]
     # init dataloaders
-    (train_dataloader, val_dataloader, test_dataloader), task = (
-        get_geobench_dataloaders(
+    splits = ["train", "val", "test"]
+
+    def get_dataloaders(sequential: bool = False):
+        return get_geobench_dataloaders(
             dataset_name,
             processed_dir,
             num_workers,
             batch_size_per_device,
-            ["train", "val", "test"],
+            splits,
             partition,
             no_ffcv,
             indices,
+            sequential=sequential,
         )
-    )
+
+    classifier_model = model
+    if embedding_cache and method == "linear":
+        dataloaders, task = get_dataloaders(sequential=True)
+        train_dataloader, val_dataloader, test_dataloader = get_embedding_dataloaders(
+            model,
+            lambda: dataloaders,
+            [
+                dict(
+                    geobench=dataset_name,
+                    partition=partition,
+                    split=split,
+                    indices=indices_digest(None if indices is None else indices[i]),
+                )
+                for i, split in enumerate(splits)
+            ],
+            splits,
+            processed_dir / "embeddings",
+            batch_size_per_device,
+            tta="flip",
+        )
+        del dataloaders
+        # the head is trained on the features, the flips are part of the cached views
+        classifier_model, train_transform = Identity(), None
+    else:
+        (train_dataloader, val_dataloader, test_dataloader), task = get_dataloaders()
 
     # Train linear classifier.
     metric_callback = MetricCallback()
@@ -116,12 +150,13 @@ def geobench_clf_eval(
     )
 
     classifier = get_geobench_classifier(
-        model,
+        classifier_model,
         method,
         is_multi_label=dataset_name == "m-bigearthnet",
         num_classes=task.label_type.n_classes,
         batch_size_per_device=batch_size_per_device,
         train_transform=train_transform,
+        feature_dim=model.last_backbone_channel,
     )
 
     trainer.fit(
@@ -160,7 +195,10 @@ def get_geobench_classifier(
     num_classes: int,
     batch_size_per_device: int,
     train_transform: Module,
+    feature_dim: int = None,
 ):
+    if feature_dim is None:
+        feature_dim = model.last_backbone_channel
     if method == "linear":
         # if dataset is multi-label, we need a different classifier class
         clf_class = LinearMultiLabelClassifier if is_multi_label else LinearClassifier
@@ -173,7 +211,7 @@ def get_geobench_classifier(
     classifier = clf_class(
         model=model,
         batch_size_per_device=batch_size_per_device,
-        feature_dim=model.last_backbone_channel,
+        feature_dim=feature_dim,
         num_classes=num_classes,
         freeze_model=method == "linear",
         train_transform=train_transform,
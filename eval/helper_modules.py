@@ -1,6 +1,9 @@
 from typing import Tuple, Dict
 
 import torch
+import torch.nn.functional as F
+from lightly.utils import dist
+from lightly.utils.benchmarking import KNNClassifier
 from lightly.utils.benchmarking import LinearClassifier as LightningLinearClassifier
 from lightly.utils.scheduler import CosineWarmupScheduler
 from torch import Tensor, nn
@@ -195,3 +198,58 @@ class FinetuneMultiLabelClassifier(LinearMultiLabelClassifier):
             "interval": "step",
         }
         return [optimizer], [scheduler]
+
+
+class StreamingKNNClassifier(KNNClassifier):
+    """
+    KNN classifier that writes the training features batch by batch into a bank preallocated for `num_samples`
+    samples (see `data.get_num_samples`), instead of concatenating the batches after the epoch, so that building the
+    bank never needs twice its memory. The bank grows if the loader returns more samples (e.g. padded by a
+    distributed sampler).
+    """
+
+    def __init__(self, *args, num_samples: int, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.num_samples = num_samples
+        self._bank = None
+        self._bank_targets = None
+        self._bank_size = 0
+
+    def _grow_bank(self, min_capacity: int):
+        capacity = max(min_capacity, int(self._bank.shape[1] * 1.25))
+        bank = self._bank.new_empty((self._bank.shape[0], capacity))
+        bank[:, : self._bank_size] = self._bank[:, : self._bank_size]
+        targets = self._bank_targets.new_empty((capacity,))
+        targets[: self._bank_size] = self._bank_targets[: self._bank_size]
+        self._bank, self._bank_targets = bank, targets
+
+    @torch.no_grad()
+    def training_step(self, batch: Tuple[Tensor, ...], batch_idx: int) -> None:
+        images, targets = batch[0], batch[1]
+        features = self.model.forward(images).flatten(start_dim=1)
+        if self.normalize:
+            features = F.normalize(features, dim=1)
+        if dist.world_size() > 1:
+            features = torch.cat(dist.gather(features), dim=0)
+            targets = torch.cat(dist.gather(targets.contiguous()), dim=0)
+        targets = targets.flatten()
+
+        if self._bank is None:
+            # (D, N) as expected by `knn_predict`, kept on the cpu until the bank is complete
+            self._bank = torch.empty(
+                (features.shape[1], self.num_samples), dtype=self.feature_dtype
+            )
+            self._bank_targets = torch.empty((self.num_samples,), dtype=targets.dtype)
+        end = self._bank_size + len(features)
+        if end > self._bank.shape[1]:
+            self._grow_bank(end)
+        self._bank[:, self._bank_size : end] = features.t().to("cpu", self.feature_dtype)
+        self._bank_targets[self._bank_size : end] = targets.cpu()
+        self._bank_size = end
+
+    def on_validation_epoch_start(self) -> None:
+        if self._bank is None:
+            return
+        self._train_features_tensor = self._bank[:, : self._bank_size].to(self.device)
+        self._train_targets_tensor = self._bank_targets[: self._bank_size].to(self.device)
+        self._bank, self._bank_targets, self._bank_size = None, None, 0
@@ -2,14 +2,42 @@ from pathlib import Path
 
 import torch
 import wandb
-from lightly.utils.benchmarking import KNNClassifier, MetricCallback
+from lightly.utils.benchmarking import MetricCallback
 from lightly.utils.dist import print_rank_zero
 from pytorch_lightning import LightningModule, Trainer
 from pytorch_lightning.loggers import WandbLogger
+from torch.nn import Identity
 
+from data import get_num_samples
 from data.mmearth_dataset import (
     get_mmearth_dataloaders,
 )
+from eval.embedding_cache import (
+    EmbeddingDataset,
+    get_embedding_dataloader,
+    get_mmearth_feature_bank,
+)
+from eval.helper_modules import StreamingKNNClassifier
+from eval.knn_engine import (
+    KNN_ENGINES,
+    IVFPQIndex,
+    knn_classify,
+    topk_accuracy,
+)
+
+# smaller banks are always searched exactly
+MIN_IVFPQ_SAMPLES = 65536
+
+
+def _get_knn_logger(model: LightningModule, log_dir: Path, debug: bool) -> WandbLogger:
+    return WandbLogger(
+        save_dir=log_dir / "knn_eval",
+        name="knn_eval",
+        project="ssl4eo",
+        # log model config
+        config=model.hparams,
+        offline=debug,
+    )
 
 
 def knn_eval(
@@ -25,6 +53,10 @@ def knn_eval(
     devices: int,
     num_classes: int,
     no_ffcv: bool,
+    sentinel2_storage: str = "float32",
+    data_backend: str = "ffcv",
+    feature_bank: dict[str, Path] = None,
+    knn_engine: str = "lightly",
     debug: bool = False,
 ) -> None:
     """Runs KNN evaluation on the given model.
@@ -35,6 +67,12 @@ def knn_eval(
         - Num nearest neighbors: 200
         - Temperature: 0.1
 
+    With a `feature_bank` (cache entries of the train and val splits, see `get_mmearth_feature_bank`), the neighbors
+    are searched among the cached features of the original images instead of running the backbone.
+
+    The "exact" and "ivfpq" `knn_engine` search the memory mapped feature bank on the CPU (see `eval.knn_engine`),
+    which scales to banks that do not fit on the device. The feature bank is computed if it is not passed.
+
     References:
        - [0]: InstDict, 2018, https://arxiv.org/abs/1805.01978
     """
@@ -43,23 +81,57 @@ def knn_eval(
     ), "target modality needs to be set for offline evaluation"
     print_rank_zero("Running KNN evaluation...")
 
+    assert knn_engine in KNN_ENGINES, f"unknown knn engine '{knn_engine}'"
+    if knn_engine != "lightly":
+        if feature_bank is None:
+            feature_bank = get_mmearth_feature_bank(
+                model,
+                input_modality,
+                target_modality,
+                data_dir,
+                processed_dir,
+                batch_size_per_device,
+                num_workers,
+                no_ffcv,
+                sentinel2_storage,
+                data_backend,
+            )
+        metrics = knn_engine_eval(feature_bank, num_classes, knn_engine, debug)
+        # same logger and metric names as the lightly KNN classifier
+        _get_knn_logger(model, log_dir, debug).log_metrics(metrics)
+        wandb.finish()
+        return
+
     # Setup training data.
-    train_dataloader, val_dataloader = get_mmearth_dataloaders(
-        data_dir,
-        processed_dir,
-        input_modality,
-        target_modality,
-        num_workers,
-        batch_size_per_device,
-        ["train", "val"],
-        no_ffcv,
-    )
+    if feature_bank is not None:
+        # all training samples in order, the model is already applied
+        train_dataloader, val_dataloader = [
+            get_embedding_dataloader(feature_bank[split], batch_size_per_device, is_train=False)
+            for split in ["train", "val"]
+        ]
+        classifier_model = Identity()
+    else:
+        train_dataloader, val_dataloader = get_mmearth_dataloaders(
+            data_dir,
+            processed_dir,
+            input_modality,
+            target_modality,
+            num_workers,
+            batch_size_per_device,
+            ["train", "val"],
+            no_ffcv,
+            sentinel2_storage=sentinel2_storage,
+            backend=data_backend,
+        )
+        classifier_model = model
 
-    classifier = KNNClassifier(
-        model=model,
+    num_samples = get_num_samples(train_dataloader)
+    classifier = StreamingKNNClassifier(
+        model=classifier_model,
         num_classes=num_classes,
-        knn_k=1 if debug else min(len(train_dataloader.reader.num_samples), 200),
+        knn_k=1 if debug else min(num_samples, 200),
         feature_dtype=torch.float16,
+        num_samples=num_samples,
     )
 
     # Run KNN evaluation.
@@ -68,14 +140,7 @@ def knn_eval(
         max_epochs=1,
         accelerator=accelerator,
         devices=devices,
-        logger=WandbLogger(
-            save_dir=log_dir / "knn_eval",
-            name="knn_eval",
-            project="ssl4eo",
-            # log model config
-            config=model.hparams,
-            offline=debug,
-        ),
+        logger=_get_knn_logger(model, log_dir, debug),
         callbacks=[metric_callback],
         # strategy="ddp_find_unused_parameters_true",
         num_sanity_val_steps=0,
@@ -100,3 +165,50 @@ def knn_eval(
             print_rank_zero(
                 f"max knn {metric}: {max(metric_callback.val_metrics[metric])}"
             )
+
+
+def knn_engine_eval(
+    feature_bank: dict[str, Path],
+    num_classes: int,
+    knn_engine: str,
+    debug: bool = False,
+    knn_k: int = 200,
+    temperature: float = 0.1,
+) -> dict[str, float]:
+    """KNN evaluation of the val split on the features of the original images in the feature bank, on the CPU."""
+    assert feature_bank.get("val") is not None, "knn engines need a val split"
+    train = EmbeddingDataset(feature_bank["train"])
+    val = EmbeddingDataset(feature_bank["val"])
+    # view 0 are the features of the original images
+    bank, queries = train.features[:, 0], val.features[:, 0]
+    if debug:
+        queries = queries[:10]
+    knn_k = 1 if debug else min(len(bank), knn_k)
+
+    index = None
+    if knn_engine == "ivfpq" and len(bank) < MIN_IVFPQ_SAMPLES:
+        print_rank_zero(f"Searching the {len(bank)} training samples exactly, the bank is too small for ivfpq.")
+    elif knn_engine == "ivfpq":
+        dim = bank.shape[1]
+        index = IVFPQIndex.build(
+            bank,
+            nlist=int(min(4 * len(bank) ** 0.5, 4096)),
+            m=next(m for m in [16, 8, 4, 2, 1] if dim % m == 0),
+        )
+
+    scores = knn_classify(
+        bank,
+        train.labels,
+        queries,
+        num_classes,
+        k=knn_k,
+        temperature=temperature,
+        index=index,
+    )
+    metrics = {
+        f"val_top{k}": acc
+        for k, acc in topk_accuracy(scores, val.labels[: len(queries)]).items()
+    }
+    for metric, value in metrics.items():
+        print_rank_zero(f"knn ({knn_engine}) {metric}: {value}")
+    return metrics
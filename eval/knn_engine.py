@@ -0,0 +1,310 @@
+"""
+Nearest neighbor search for KNN evaluation on large (memory mapped) feature banks, on the CPU.
+
+Features are compared by cosine similarity as in lightly's `KNNClassifier`: `exact_topk` scans the bank block by block
+and keeps a running top-k, so only one block of the bank is in memory at a time. `IVFPQIndex` is an approximate
+inverted file index with product quantization of the residuals, which only scores the samples of the `nprobe` closest
+lists with lookup tables. `knn_classify` turns the neighbors into class scores.
+"""
+from typing import Optional
+
+import numpy as np
+
+# "lightly": `KNNClassifier` on the device, "exact": `exact_topk`, "ivfpq": `IVFPQIndex`
+KNN_ENGINES = ["lightly", "exact", "ivfpq"]
+
+
+def normalize(x: np.ndarray, eps: float = 1e-12) -> np.ndarray:
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), eps)
+
+
+def _merge_topk(
+    sims: np.ndarray, idx: np.ndarray, k: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """Keeps the k largest similarities of each row (unsorted)."""
+    if sims.shape[1] <= k:
+        return sims, idx
+    part = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(sims, part, axis=1), np.take_along_axis(idx, part, axis=1)
+
+
+def _sort_topk(sims: np.ndarray, idx: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    order = np.argsort(-sims, axis=1, kind="stable")
+    return np.take_along_axis(sims, order, axis=1), np.take_along_axis(idx, order, axis=1)
+
+
+def exact_topk(
+    bank: np.ndarray, queries: np.ndarray, k: int, block_size: int = 65536
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Exact k nearest neighbors (cosine similarity) of the queries in the bank, reading `block_size` samples of the bank
+    at a time.
+
+    Returns the similarities and the bank indices of the neighbors, both of shape (Q, k) and sorted by decreasing
+    similarity.
+    """
+    queries = normalize(queries)
+    k = min(k, len(bank))
+    sims = np.empty((len(queries), 0), dtype=np.float32)
+    idx = np.empty((len(queries), 0), dtype=np.int64)
+    for start in range(0, len(bank), block_size):
+        block = normalize(bank[start : start + block_size])
+        block_sims = queries @ block.T
+        block_idx = np.broadcast_to(
+            np.arange(start, start + len(block)), block_sims.shape
+        )
+        sims, idx = _merge_topk(
+            np.concatenate([sims, block_sims], axis=1),
+            np.concatenate([idx, block_idx], axis=1),
+            k,
+        )
+    return _sort_topk(sims, idx)
+
+
+def _kmeans(
+    x: np.ndarray, num_clusters: int, num_iters: int, rng: np.random.Generator
+) -> np.ndarray:
+    """Lloyd's k-means (squared euclidean distance), empty clusters are reset to random samples."""
+    centroids = x[rng.choice(len(x), num_clusters, replace=False)].copy()
+    for _ in range(num_iters):
+        assign = _nearest(x, centroids)
+        counts = np.bincount(assign, minlength=num_clusters)
+        empty = counts == 0
+        # sums of the (sorted) samples of each non-empty cluster
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[~empty]
+        sums = np.add.reduceat(x[np.argsort(assign, kind="stable")], starts, axis=0)
+        centroids[~empty] = sums / counts[~empty, None]
+        centroids[empty] = x[rng.choice(len(x), int(empty.sum()), replace=False)]
+    return centroids
+
+
+def _nearest(x: np.ndarray, centroids: np.ndarray, block_size: int = 16384) -> np.ndarray:
+    """Index of the nearest centroid (squared euclidean distance) of every sample."""
+    c_sq = (centroids**2).sum(axis=1)
+    assign = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), block_size):
+        block = x[start : start + block_size]
+        # |x|^2 is the same for all centroids
+        assign[start : start + block_size] = np.argmin(c_sq - 2 * block @ centroids.T, axis=1)
+    return assign
+
+
+class IVFPQIndex:
+    """
+    Approximate nearest neighbor index (cosine similarity) of a feature bank: inverted file with product quantization.
+
+    The normalized features are assigned to the nearest of `nlist` coarse centroids and the residual to the centroid is
+    encoded with `m` codebooks of 2**`nbits` centroids each, one per subspace of `dim / m` dimensions. A query only
+    scores the samples of its `nprobe` closest lists: the inner product of the query with a sample is the inner product
+    with the list centroid plus the sum of the inner products with the codewords of the residual, which are looked up
+    in tables computed once per query. With `rerank`, the `rerank * k` best candidates are scored again exactly with the
+    features of the bank.
+
+    Parameters:
+    ----------
+    nlist : int, optional
+        Number of inverted lists (coarse centroids). Default is 1024.
+    m : int, optional
+        Number of subspaces, needs to divide the feature dimension. Default is 16.
+    nbits : int, optional
+        Bits per code, at most 8. Default is 8.
+    nprobe : int, optional
+        Number of lists searched per query, the trade-off between recall and speed. Default is 16.
+    num_iters : int, optional
+        Number of k-means iterations for training. Default is 20.
+    seed : int, optional
+        Seed of the training samples and the k-means initialization. Default is 0.
+    """
+
+    def __init__(
+        self,
+        nlist: int = 1024,
+        m: int = 16,
+        nbits: int = 8,
+        nprobe: int = 16,
+        num_iters: int = 20,
+        seed: int = 0,
+    ):
+        assert 0 < nbits <= 8, f"nbits needs to be in [1, 8], got {nbits}"
+        self.nlist = nlist
+        self.m = m
+        self.ksub = 2**nbits
+        self.nprobe = nprobe
+        self.num_iters = num_iters
+        self.seed = seed
+        self.centroids = None
+        self.codebooks = None
+        self.codes = None
+        self.list_ids = None
+        self.list_offsets = None
+
+    def train(self, x: np.ndarray):
+        """Trains the coarse centroids and the codebooks on (a sample of) the features."""
+        x = normalize(x)
+        dim = x.shape[1]
+        assert dim % self.m == 0, f"m={self.m} does not divide the feature dimension {dim}"
+        assert len(x) >= max(self.nlist, self.ksub), "not enough training samples"
+        rng = np.random.default_rng(self.seed)
+        self.centroids = _kmeans(x, self.nlist, self.num_iters, rng)
+        residuals = x - self.centroids[_nearest(x, self.centroids)]
+        dsub = dim // self.m
+        self.codebooks = np.stack(
+            [
+                _kmeans(
+                    np.ascontiguousarray(residuals[:, i * dsub : (i + 1) * dsub]),
+                    self.ksub,
+                    self.num_iters,
+                    rng,
+                )
+                for i in range(self.m)
+            ]
+        )
+
+    def _encode(self, residuals: np.ndarray) -> np.ndarray:
+        dsub = residuals.shape[1] // self.m
+        codes = np.empty((len(residuals), self.m), dtype=np.uint8)
+        for i in range(self.m):
+            codes[:, i] = _nearest(residuals[:, i * dsub : (i + 1) * dsub], self.codebooks[i])
+        return codes
+
+    def add(self, bank: np.ndarray, block_size: int = 65536):
+        """Encodes all features of the bank (read block by block) and sorts them into the inverted lists."""
+        assert self.centroids is not None, "the index needs to be trained first"
+        assign = np.empty(len(bank), dtype=np.int64)
+        self.codes = np.empty((len(bank), self.m), dtype=np.uint8)
+        for start in range(0, len(bank), block_size):
+            block = normalize(bank[start : start + block_size])
+            block_assign = _nearest(block, self.centroids)
+            assign[start : start + len(block)] = block_assign
+            self.codes[start : start + len(block)] = self._encode(
+                block - self.centroids[block_assign]
+            )
+        # samples of each list are stored contiguously
+        self.list_ids = np.argsort(assign, kind="stable")
+        self.codes = self.codes[self.list_ids]
+        self.list_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(assign, minlength=self.nlist))]
+        )
+
+    @classmethod
+    def build(
+        cls, bank: np.ndarray, max_train_samples: int = 100_000, **kwargs
+    ) -> "IVFPQIndex":
+        """Trains an index on a random sample of the bank and adds the whole bank."""
+        index = cls(**kwargs)
+        rng = np.random.default_rng(index.seed)
+        num_train = min(len(bank), max_train_samples)
+        # sorted, so a memory mapped bank is read sequentially
+        train_idx = np.sort(rng.choice(len(bank), num_train, replace=False))
+        index.train(bank[train_idx])
+        index.add(bank)
+        return index
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int,
+        nprobe: Optional[int] = None,
+        bank: Optional[np.ndarray] = None,
+        rerank: int = 0,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Approximate k nearest neighbors of the queries, returns the (estimated) similarities and the bank indices of
+        shape (Q, k), sorted by decreasing similarity. Queries with less than k candidates are padded with index -1
+        and similarity -inf.
+        """
+        assert self.codes is not None, "the index is empty"
+        assert rerank == 0 or bank is not None, "reranking needs the bank"
+        queries = normalize(queries)
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        dsub = queries.shape[1] // self.m
+        num_candidates = k * max(rerank, 1)
+
+        coarse = queries @ self.centroids.T
+        probes = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+        sims = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        idx = np.full((len(queries), k), -1, dtype=np.int64)
+        for q, query in enumerate(queries):
+            # inner products of each query subvector with all codewords, shape (m, ksub)
+            tables = np.einsum(
+                "md,mkd->mk", query.reshape(self.m, dsub), self.codebooks
+            )
+            cand_sims, cand_pos = [], []
+            for lst in probes[q]:
+                start, end = self.list_offsets[lst], self.list_offsets[lst + 1]
+                if start == end:
+                    continue
+                codes = self.codes[start:end]
+                cand_sims.append(
+                    coarse[q, lst] + tables[np.arange(self.m), codes].sum(axis=1)
+                )
+                cand_pos.append(np.arange(start, end))
+            if not cand_sims:
+                continue
+            cand_sims = np.concatenate(cand_sims)[None]
+            cand_pos = np.concatenate(cand_pos)[None]
+            cand_sims, cand_pos = _merge_topk(cand_sims, cand_pos, num_candidates)
+            cand_ids = self.list_ids[cand_pos[0]]
+            if rerank:
+                order = np.argsort(cand_ids)
+                cand_ids = cand_ids[order]
+                cand_sims = (normalize(bank[cand_ids]) @ query)[None]
+            cand_sims, cand_ids = _sort_topk(*_merge_topk(cand_sims, cand_ids[None], k))
+            sims[q, : cand_sims.shape[1]] = cand_sims[0]
+            idx[q, : cand_ids.shape[1]] = cand_ids[0]
+        return sims, idx
+
+
+def knn_classify(
+    bank: np.ndarray,
+    bank_labels: np.ndarray,
+    queries: np.ndarray,
+    num_classes: int,
+    k: int = 200,
+    temperature: float = 0.1,
+    index: Optional[IVFPQIndex] = None,
+    query_block_size: int = 1024,
+    bank_block_size: int = 65536,
+    **search_kwargs,
+) -> np.ndarray:
+    """
+    Weighted KNN class scores of the queries, as computed by lightly's `knn_predict`: every neighbor votes for its
+    class with weight exp(similarity / temperature).
+
+    The neighbors are searched exactly (`exact_topk`) or with the given `index` (passing `search_kwargs` to
+    `IVFPQIndex.search`), `query_block_size` queries at a time.
+
+    Returns the scores of shape (Q, num_classes).
+    """
+    bank_labels = np.asarray(bank_labels).reshape(len(bank), -1)[:, 0].astype(np.int64)
+    scores = np.zeros((len(queries), num_classes), dtype=np.float32)
+    for start in range(0, len(queries), query_block_size):
+        block = queries[start : start + query_block_size]
+        if index is None:
+            sims, idx = exact_topk(bank, block, k, bank_block_size)
+        else:
+            sims, idx = index.search(block, k, **search_kwargs)
+        weights = np.exp(sims / temperature)
+        # padded neighbors (index -1) have weight 0
+        weights[idx < 0] = 0
+        labels = bank_labels[np.maximum(idx, 0)]
+        np.add.at(
+            scores[start : start + len(block)],
+            (np.arange(len(block))[:, None], labels),
+            weights,
+        )
+    return scores
+
+
+def topk_accuracy(scores: np.ndarray, labels: np.ndarray, topk: tuple[int, ...] = (1, 5)) -> dict[int, float]:
+    labels = np.asarray(labels).reshape(len(scores), -1)[:, 0]
+    ranked = np.argsort(-scores, axis=1, kind="stable")
+    return {k: float((ranked[:, :k] == labels[:, None]).any(axis=1).mean()) for k in topk}
+
+
+def recall_at_k(approx_idx: np.ndarray, exact_idx: np.ndarray) -> float:
+    """Fraction of the exact k nearest neighbors that are found by the approximate search."""
+    k = exact_idx.shape[1]
+    hits = [len(np.intersect1d(a, e)) for a, e in zip(approx_idx, exact_idx)]
+    return float(np.sum(hits) / (len(exact_idx) * k))
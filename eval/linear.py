@@ -6,12 +6,13 @@ from lightly.utils.dist import print_rank_zero
 from pytorch_lightning import Trainer
 from pytorch_lightning.callbacks import LearningRateMonitor
 from pytorch_lightning.loggers import WandbLogger
-from torch.nn import Module, Sequential
+from torch.nn import Identity, Module, Sequential
 import kornia.augmentation as K
 
 from data.mmearth_dataset import (
     get_mmearth_dataloaders,
 )
+from eval.embedding_cache import get_embedding_dataloader, get_mmearth_feature_bank
 from eval.helper_modules import LinearClassifier
 
 
@@ -29,6 +30,10 @@ def linear_eval(
     precision: str,
     num_classes: int,
     no_ffcv: bool,
+    sentinel2_storage: str = "float32",
+    data_backend: str = "ffcv",
+    embedding_cache: bool = False,
+    feature_bank: dict[str, Path] = None,
     debug: bool = False,
 ) -> None:
     """Runs a linear evaluation on the given model.
@@ -44,6 +49,10 @@ def linear_eval(
         - Weight Decay: 0.0
         - LR Schedule: Cosine without warmup
 
+    With `embedding_cache`, the train and val splits are encoded once with the frozen backbone (with all flips, see
+    `get_mmearth_feature_bank`) and the linear head is trained on the cached features. An existing `feature_bank`
+    (cache entries of the splits) can be passed instead.
+
     References:
         - [0]: SimCLR, 2020, https://arxiv.org/abs/2002.05709
     """
@@ -57,16 +66,42 @@ def linear_eval(
         K.RandomHorizontalFlip(),
         K.RandomVerticalFlip(),
     )
-    train_dataloader, val_dataloader = get_mmearth_dataloaders(
-        data_dir,
-        processed_dir,
-        input_modality,
-        target_modality,
-        num_workers,
-        batch_size_per_device,
-        ["train", "val"],
-        no_ffcv,
-    )
+    if embedding_cache and feature_bank is None:
+        feature_bank = get_mmearth_feature_bank(
+            model,
+            input_modality,
+            target_modality,
+            data_dir,
+            processed_dir,
+            batch_size_per_device,
+            num_workers,
+            no_ffcv,
+            sentinel2_storage,
+            data_backend,
+        )
+    if feature_bank is not None:
+        train_dataloader = get_embedding_dataloader(
+            feature_bank["train"], batch_size_per_device, is_train=True
+        )
+        val_dataloader = get_embedding_dataloader(
+            feature_bank["val"], batch_size_per_device, is_train=False
+        )
+        # the head is trained on the features, the flips are part of the cached views
+        classifier_model, train_transform = Identity(), None
+    else:
+        train_dataloader, val_dataloader = get_mmearth_dataloaders(
+            data_dir,
+            processed_dir,
+            input_modality,
+            target_modality,
+            num_workers,
+            batch_size_per_device,
+            ["train", "val"],
+            no_ffcv,
+            sentinel2_storage=sentinel2_storage,
+            backend=data_backend,
+        )
+        classifier_model = model
 
     # Train linear classifier.
     metric_callback = MetricCallback()
@@ -93,7 +128,7 @@ def linear_eval(
         fast_dev_run=debug,
     )
     classifier = LinearClassifier(
-        model=model,
+        model=classifier_model,
         batch_size_per_device=batch_size_per_device,
         feature_dim=model.last_backbone_channel,
         num_classes=num_classes,
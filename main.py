@@ -23,8 +23,11 @@ from data.constants import (
     MMEARTH_DIR,
     input_size,
     IN_MODALITIES,
+    DATA_BACKENDS,
+    SENTINEL2_STORAGE,
 )
-from eval import finetune_eval, geobench_clf_eval, knn_eval, linear_eval
+from eval import finetune_eval, frozen_eval, geobench_clf_eval, knn_eval, linear_eval
+from eval.knn_engine import KNN_ENGINES
 from methods import modules
 from methods import transforms
 
@@ -57,6 +60,13 @@ parser.add_argument(
     default=128,
     help="Batch size per device (default: 128).",
 )
+parser.add_argument(
+    "--accumulate-grad-batches",
+    type=int,
+    default=1,
+    help="Number of batches to accumulate the gradients over before each optimizer step. The learning rates scale "
+    "with the effective batch size (batch size per device * devices * accumulated batches) (default: 1).",
+)
 parser.add_argument(
     "--epochs",
     type=int,
@@ -99,13 +109,15 @@ parser.add_argument(
     "--methods",
     type=str,
     nargs="+",
-    help="SSL methods to apply: 'byol', 'simclr', 'mae', 'barlowtwins', 'vicreg'.",
+    help="SSL methods to apply: 'byol', 'simclr', 'mae', 'mae_fast', 'barlowtwins', 'vicreg'.",
 )
 parser.add_argument(
     "--backbone",
     type=str,
     default="default",
-    help="Encoder architecture to use (default: 'default').",
+    help="Encoder architecture to use (default: 'default'). For MAE, a tokenizer can be appended, e.g. "
+    "'vit_base_patch16_224:p28' (patch size 28) or 'vit_base_patch16_224:spectral_p16' (a token per patch and "
+    "channel group).",
 )
 parser.add_argument(
     "--input-channel",
@@ -147,6 +159,50 @@ parser.add_argument(
     action="store_true",
     help="If set, pretraining will be done with regular pytorch DataLoader instead of ffcv.Loader (should be slower).",
 )
+parser.add_argument(
+    "--sentinel2-storage",
+    type=str,
+    default="float32",
+    choices=list(SENTINEL2_STORAGE),
+    help="How sentinel2 is stored in the beton files: 'float32' (normalized), 'float16' (normalized) or 'uint16' "
+    "(raw, normalized on the GPU). The compact formats halve the size of the beton files (default: 'float32').",
+)
+parser.add_argument(
+    "--data-backend",
+    type=str,
+    default="ffcv",
+    choices=DATA_BACKENDS,
+    help="How the MMEarth data is loaded: 'ffcv' (beton files), 'hdf5' (random reads from the h5 file, same as "
+    "--no-ffcv), 'stream' (sequentially read npz shards, no FFCV needed) or 'memmap' (like 'hdf5', but served from "
+    "memory mapped arrays cached in the processed dir) (default: 'ffcv').",
+)
+parser.add_argument(
+    "--embedding-cache",
+    action="store_true",
+    help="If set, the frozen backbone encodes every split once and linear (also on GeoBench) and KNN evaluation run on "
+    "the features cached in the processed dir.",
+)
+parser.add_argument(
+    "--knn-engine",
+    type=str,
+    default="lightly",
+    choices=KNN_ENGINES,
+    help="Nearest neighbor search of the KNN evaluation: 'lightly' (feature bank on the device), 'exact' (blocked "
+    "search of the cached features on the CPU) or 'ivfpq' (approximate index of the cached features on the CPU) "
+    "(default: 'lightly').",
+)
+parser.add_argument(
+    "--multicrop",
+    action="store_true",
+    help="If set, the random resized crops of all views of the multi-view methods are produced by one batched "
+    "roi_align call instead of a crop per view.",
+)
+parser.add_argument(
+    "--fused-augmentation",
+    action="store_true",
+    help="If set, the multi-view methods create all views with one pass of every augmentation over the stacked views "
+    "(takes precedence over --multicrop).",
+)
 parser.add_argument(
     "--geobench-datasets",
     type=str,
@@ -188,10 +244,22 @@ METHODS = {
             transforms.BarlowTwinsView1Transform(input_size=input_size),
             transforms.BarlowTwinsView2Transform(input_size=input_size),
         ),
+        "fused_transform": transforms.FusedMultiViewTransform(
+            input_size,
+            [
+                transforms.ViewProbs(blur=1.0, solarize=0.0),
+                transforms.ViewProbs(blur=0.1, solarize=0.2),
+            ],
+        ),
     },
     "simclr": {
         "model": modules.SimCLR,
+        # memory bank with the negatives of all accumulated batches
+        "negatives_cache": True,
         "transform": transforms.SimCLRTransform(input_size=input_size),
+        "fused_transform": transforms.FusedMultiViewTransform(
+            input_size, [transforms.ViewProbs(blur=0.5)] * 2
+        ),
     },
     "byol": {
         "model": modules.BYOL,
@@ -199,15 +267,41 @@ METHODS = {
             transforms.BYOLView1Transform(input_size=input_size),
             transforms.BYOLView2Transform(input_size=input_size),
         ),
+        "fused_transform": transforms.FusedMultiViewTransform(
+            input_size,
+            [
+                transforms.ViewProbs(blur=1.0, solarize=0.0),
+                transforms.ViewProbs(blur=0.1, solarize=0.2),
+            ],
+        ),
     },
     "vicreg": {
         "model": modules.VICReg,
         "transform": transforms.VICRegTransform(input_size=input_size),
+        "fused_transform": transforms.FusedMultiViewTransform(
+            input_size,
+            [transforms.ViewProbs(blur=0.5, solarize=0.1)] * 2,
+            # same blur as VICRegTransform, which overrides the (0.2, 2) default of its views
+            sigmas=(0.1, 2),
+            solarize_before_blur=True,
+        ),
     },
     "mae": {
         "model": partial(modules.MAE, img_size=input_size),
         "transform": transforms.MAETransform(input_size=input_size),
     },
+    "mae_fast": {
+        "model": partial(
+            modules.MAE,
+            img_size=input_size,
+            decoder_embed_dim=256,
+            decoder_depth=4,
+            decoder_num_heads=8,
+            fused_attention=True,
+            predict_ratio=0.5,
+        ),
+        "transform": transforms.MAETransform(input_size=input_size),
+    },
 }
 
 
@@ -236,6 +330,13 @@ def main(
     geobench_eval_method: str,
     ckpt_path: Union[Path, None],
     no_ffcv: bool,
+    sentinel2_storage: str = "float32",
+    data_backend: str = "ffcv",
+    embedding_cache: bool = False,
+    knn_engine: str = "lightly",
+    multicrop: bool = False,
+    fused_augmentation: bool = False,
+    accumulate_grad_batches: int = 1,
     debug: bool = False,
 ) -> LightningModule:
     if data_dir is None:
@@ -279,6 +380,19 @@ def main(
         ).resolve()
         method_dir.mkdir(exist_ok=True, parents=True)
 
+        train_transform = METHODS[method]["transform"]
+        if fused_augmentation and "fused_transform" in METHODS[method]:
+            train_transform = METHODS[method]["fused_transform"]
+        elif multicrop and isinstance(train_transform, transforms.MultiViewTransform):
+            train_transform = transforms.MultiCropTransform.from_multi_view(
+                train_transform, input_size
+            )
+
+        # Gradient accumulation would shrink the negatives of contrastive methods to a single batch
+        model_kwargs = {}
+        if accumulate_grad_batches > 1 and METHODS[method].get("negatives_cache", False):
+            model_kwargs["memory_bank_size"] = batch_size_per_device * devices * accumulate_grad_batches
+
         # Initialize model with method-specific parameters
         model = METHODS[method]["model"](
             backbone=backbone,
@@ -286,8 +400,9 @@ def main(
             num_classes=num_classes,
             in_channels=in_channels,
             has_online_classifier=target is not None,
-            train_transform=METHODS[method]["transform"],
+            train_transform=train_transform,
             last_backbone_channel=last_backbone_channel,
+            **model_kwargs,
         )
 
         # Compile the model if PyTorch supports it
@@ -309,6 +424,8 @@ def main(
             "devices": devices,
             "precision": precision,
             "no_ffcv": no_ffcv,
+            "sentinel2_storage": sentinel2_storage,
+            "data_backend": data_backend,
             "debug": debug,
         }
 
@@ -323,6 +440,7 @@ def main(
             pretrain_config = default_config.copy()
             pretrain_config["epochs"] = epochs
             pretrain_config["ckpt_path"] = ckpt_path
+            pretrain_config["accumulate_grad_batches"] = accumulate_grad_batches
 
             print_rank_zero(f"Running pretraining for {method}...")
             pretrain(**pretrain_config)
@@ -361,6 +479,7 @@ def main(
                         devices=devices,
                         precision=precision,
                         no_ffcv=no_ffcv,
+                        embedding_cache=embedding_cache,
                         debug=debug,
                     )
                 else:
@@ -378,9 +497,18 @@ def main(
         eval_config = default_config.copy()
         eval_config["num_classes"] = num_classes
 
-        # Perform linear evaluation if enabled
+        # With the embedding cache, linear and KNN evaluation share one feature bank
+        frozen_protocols = []
+        if embedding_cache and target is not None:
+            frozen_protocols += ["linear"] if enable_linear_eval else []
+            frozen_protocols += ["knn"] if enable_knn_eval else []
+        if frozen_protocols:
+            frozen_eval(frozen_protocols, **eval_config, knn_engine=knn_engine)
+
+        # Perform linear evaluation if enabled (and not done with the feature bank)
         if enable_linear_eval and target is not None:
-            linear_eval(**eval_config)
+            if "linear" not in frozen_protocols:
+                linear_eval(**eval_config)
         else:
             print_rank_zero("Skipping linear eval.")
 
@@ -390,10 +518,11 @@ def main(
         else:
             print_rank_zero("Skipping fine-tune eval.")
 
-        # Perform KNN evaluation if enabled
+        # Perform KNN evaluation if enabled (and not done with the feature bank)
         if enable_knn_eval and target is not None:
-            del eval_config["precision"]
-            knn_eval(**eval_config)
+            if "knn" not in frozen_protocols:
+                del eval_config["precision"]
+                knn_eval(**eval_config, knn_engine=knn_engine)
         else:
             print_rank_zero("Skipping KNN eval.")
 
@@ -415,6 +544,9 @@ def pretrain(
     precision: str,
     ckpt_path: Union[Path, None],
     no_ffcv: bool,
+    sentinel2_storage: str = "float32",
+    data_backend: str = "ffcv",
+    accumulate_grad_batches: int = 1,
     debug: bool = False,
 ) -> None:
     # Setup training data.
@@ -427,6 +559,8 @@ def pretrain(
         batch_size_per_device,
         ["train", "val"],
         no_ffcv,
+        sentinel2_storage=sentinel2_storage,
+        backend=data_backend,
     )
 
     # Train model.
@@ -434,6 +568,11 @@ def pretrain(
     wandb_config = model.hparams.copy()
     wandb_config["log_dir"] = str(log_dir)
     wandb_config["ckpt_path"] = ckpt_path
+    wandb_config["accumulate_grad_batches"] = accumulate_grad_batches
+    print_rank_zero(
+        f"Effective batch size: {batch_size_per_device} per device x {devices} devices x "
+        f"{accumulate_grad_batches} accumulated batches"
+    )
     trainer = Trainer(
         max_epochs=epochs,
         accelerator=accelerator,
@@ -454,6 +593,7 @@ def pretrain(
             offline=debug,
         ),
         precision=precision,
+        accumulate_grad_batches=accumulate_grad_batches,
         # strategy="ddp_find_unused_parameters_true",
         sync_batchnorm=accelerator != "cpu",  # Sync batchnorm is not supported on CPU.
         num_sanity_val_steps=0,
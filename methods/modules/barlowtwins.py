@@ -9,7 +9,7 @@ from lightly.utils.scheduler import CosineWarmupScheduler
 from torch import Tensor
 from torch.nn import Module
 
-from methods.modules.base import EOModule
+from methods.modules.base import EOModule, get_effective_batch_size
 
 
 class BarlowTwins(EOModule):
@@ -66,7 +66,7 @@ class BarlowTwins(EOModule):
         return loss
 
     def configure_optimizers(self):
-        lr_factor = self.batch_size_per_device * self.trainer.world_size / 256
+        lr_factor = get_effective_batch_size(self) / 256
 
         # Don't use weight decay for batch norm, bias parameters, and classification
         # head to improve performance.
@@ -1,5 +1,8 @@
-from typing import List, Tuple, Dict
+from contextlib import contextmanager
+from functools import partial
+from typing import List, Tuple, Dict, Iterator
 
+import torch
 from lightly.utils.benchmarking import OnlineLinearClassifier
 from lightly.utils.dist import print_rank_zero
 from pytorch_lightning import LightningModule
@@ -22,6 +25,48 @@ class BackboneExpander(nn.Module):
         return f"{self.backbone.__class__.__name__} and {self.__class__.__name__}"
 
 
+def _per_view_batch_norm_forward(module: nn.Module, num_views: int, x: Tensor) -> Tensor:
+    forward = type(module).forward
+    if not module.training:
+        return forward(module, x)
+    return torch.cat([forward(module, view) for view in x.chunk(num_views)])
+
+
+@contextmanager
+def per_view_batch_norm(modules: List[nn.Module], num_views: int) -> Iterator[None]:
+    """
+    Within the context, the batch norm layers of `modules` normalize each of the `num_views` equally sized chunks of a
+    training batch with its own statistics (and update the running statistics once per chunk), as if every view was a
+    separate forward pass. Other layers still process the concatenated views at once.
+
+    The layers are looked up when entering, so this also covers the `SyncBatchNorm` layers the Trainer swaps in for
+    `sync_batchnorm=True`, which then synchronize the statistics of each view over the devices. Outside of the
+    context (e.g. validation or fine-tuning of the backbone), the layers use the statistics of the whole batch.
+    """
+    layers = [
+        m
+        for module in modules
+        for m in module.modules()
+        if isinstance(m, (nn.modules.batchnorm._BatchNorm, nn.SyncBatchNorm))
+    ]
+    for m in layers:
+        m.forward = partial(_per_view_batch_norm_forward, m, num_views)
+    try:
+        yield
+    finally:
+        for m in layers:
+            del m.forward
+
+
+def get_effective_batch_size(module: LightningModule) -> int:
+    """
+    Number of samples per optimizer step, over all devices and accumulated batches. The learning rates scale with it,
+    the warmup and the schedules are counted in optimizer steps (`trainer.estimated_stepping_batches`) already.
+    """
+    trainer = module.trainer
+    return module.batch_size_per_device * trainer.world_size * trainer.accumulate_grad_batches
+
+
 class EOModule(LightningModule):
     def __init__(
         self,
@@ -1,16 +1,22 @@
 import copy
+from contextlib import nullcontext
 from typing import Tuple, Dict
 
 import torch
 from lightly.loss import NegativeCosineSimilarity
 from lightly.models.modules import BYOLPredictionHead, BYOLProjectionHead
-from lightly.models.utils import get_weight_decay_parameters, update_momentum
+from lightly.models.utils import get_weight_decay_parameters
 from lightly.utils.lars import LARS
 from lightly.utils.scheduler import CosineWarmupScheduler, cosine_schedule
 from torch import Tensor
 from torch.nn import Module
 
-from methods.modules.base import EOModule
+from methods.modules.base import (
+    EOModule,
+    get_effective_batch_size,
+    per_view_batch_norm,
+)
+from methods.modules.ema import FusedEMA
 
 
 class BYOL(EOModule):
@@ -25,6 +31,8 @@ class BYOL(EOModule):
         has_online_classifier: bool,
         train_transform: Module,
         last_backbone_channel: int = None,
+        ema_every_k: int = 1,
+        per_view_bn: bool = True,
     ) -> None:
         self.save_hyperparameters(ignore=["train_transform"])
         self.hparams["method"] = self.__class__.__name__
@@ -43,6 +51,16 @@ class BYOL(EOModule):
         self.teacher_backbone = copy.deepcopy(self.backbone)
         self.teacher_projection_head = BYOLProjectionHead(self.last_backbone_channel)
         self.criterion = NegativeCosineSimilarity()
+        self.ema = FusedEMA(
+            [
+                (self.backbone, self.teacher_backbone),
+                (self.projection_head, self.teacher_projection_head),
+            ],
+            every_k=ema_every_k,
+        )
+        # both views go through the networks in one batch, by default with batch norm statistics per view as in
+        # separate forward passes of the views
+        self.per_view_bn = per_view_bn
 
     def forward_student(self, x: Tensor) -> Tuple[Tensor, Tensor]:
         features = self(x).flatten(start_dim=1)
@@ -56,6 +74,21 @@ class BYOL(EOModule):
         projections = self.teacher_projection_head(features)
         return projections
 
+    def batch_norm_context(self):
+        """Batch norm statistics per view (`per_view_bn`) for the forward passes of the concatenated views."""
+        if not self.per_view_bn:
+            return nullcontext()
+        return per_view_batch_norm(
+            [
+                self.backbone,
+                self.projection_head,
+                self.prediction_head,
+                self.teacher_backbone,
+                self.teacher_projection_head,
+            ],
+            num_views=2,
+        )
+
     def training_step(self, batch: Dict, batch_idx: int) -> Tensor:
         # Momentum update teacher.
         # Settings follow original code for 100 epochs which are slightly different
@@ -67,18 +100,22 @@ class BYOL(EOModule):
             start_value=0.99,
             end_value=1.0,
         )
-        update_momentum(self.backbone, self.teacher_backbone, m=momentum)
-        update_momentum(self.projection_head, self.teacher_projection_head, m=momentum)
+        # once per optimizer step, with gradient accumulation the student only changes after the last batch
+        if batch_idx % self.trainer.accumulate_grad_batches == 0:
+            self.ema.update(momentum, step=self.trainer.global_step)
 
         # Forward pass and loss calculation.
         images = batch[0]
         # Create views
         with torch.no_grad():
             views = self.train_transform(images)
-        teacher_projections_0 = self.forward_teacher(views[0])
-        teacher_projections_1 = self.forward_teacher(views[1])
-        student_features_0, student_predictions_0 = self.forward_student(views[0])
-        _, student_predictions_1 = self.forward_student(views[1])
+        # one batched forward of both views for the teacher and the student
+        x = torch.cat(views[:2])
+        with self.batch_norm_context():
+            teacher_projections_0, teacher_projections_1 = self.forward_teacher(x).chunk(2)
+            student_features, student_predictions = self.forward_student(x)
+        student_features_0 = student_features.chunk(2)[0]
+        student_predictions_0, student_predictions_1 = student_predictions.chunk(2)
         # NOTE: Factor 2 because: L2(norm(x), norm(y)) = 2 - 2 * cossim(x, y)
         loss_0 = 2 * self.criterion(teacher_projections_0, student_predictions_1)
         loss_1 = 2 * self.criterion(teacher_projections_1, student_predictions_0)
@@ -130,7 +167,7 @@ class BYOL(EOModule):
             # Settings follow original code for 100 epochs which are slightly different
             # from the paper, see:
             # https://github.com/deepmind/deepmind-research/blob/f5de0ede8430809180254ee957abf36ed62579ef/byol/configs/byol.py#L21-L23
-            lr=0.45 * self.batch_size_per_device * self.trainer.world_size / 256,
+            lr=0.45 * get_effective_batch_size(self) / 256,
             momentum=0.9,
             weight_decay=1e-6,
         )
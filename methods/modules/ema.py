@@ -0,0 +1,49 @@
+from typing import Sequence, Tuple
+
+import torch
+from torch import nn
+
+
+class FusedEMA:
+    """
+    Exponential moving average of student parameters in teacher modules, with multi-tensor (`torch._foreach_*`) kernels.
+
+    Does the same as lightly's `update_momentum` for every (student, teacher) pair (only parameters, the buffers of the
+    teacher are kept), but updates all tensors with one fused `_foreach_lerp_` call instead of one Python level update
+    per parameter.
+
+    With `every_k > 1`, the teacher is only updated every k-th step, with the momentum raised to the power of k. This is
+    the average of k steps of a student that does not change in between, so the teacher follows the same schedule.
+
+    Parameters:
+    ----------
+    pairs : Sequence[Tuple[nn.Module, nn.Module]]
+        (student, teacher) modules with the same parameter layout.
+    every_k : int, optional
+        Number of steps between teacher updates. Default is 1.
+    """
+
+    def __init__(self, pairs: Sequence[Tuple[nn.Module, nn.Module]], every_k: int = 1):
+        assert every_k >= 1, f"every_k needs to be positive, got {every_k}"
+        self.every_k = every_k
+        self.student_params = []
+        self.teacher_params = []
+        for student, teacher in pairs:
+            student_params = list(student.parameters())
+            teacher_params = list(teacher.parameters())
+            assert len(student_params) == len(teacher_params), "student and teacher differ"
+            self.student_params += student_params
+            self.teacher_params += teacher_params
+
+    @torch.no_grad()
+    def update(self, momentum: float, step: int = 0) -> bool:
+        """Moves the teacher towards the student (teacher = momentum * teacher + (1 - momentum) * student)."""
+        if step % self.every_k != 0:
+            return False
+        weight = 1.0 - momentum**self.every_k
+        if hasattr(torch, "_foreach_lerp_"):
+            torch._foreach_lerp_(self.teacher_params, self.student_params, weight)
+        else:
+            torch._foreach_mul_(self.teacher_params, 1.0 - weight)
+            torch._foreach_add_(self.teacher_params, self.student_params, alpha=weight)
+        return True
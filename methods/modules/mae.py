@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Dict, Tuple
 
 import torch
 from lightly.models import utils
@@ -7,12 +7,32 @@ from lightly.utils.benchmarking import OnlineLinearClassifier
 from lightly.utils.dist import print_rank_zero
 from lightly.utils.scheduler import CosineWarmupScheduler
 from pytorch_lightning import LightningModule
-from torch import Tensor
+from torch import Tensor, nn
 from torch.nn import MSELoss, Parameter
 from torch.optim import AdamW
 from torch.nn import Module
 
-from methods.modules.base import get_backbone
+from methods.modules.base import get_backbone, get_effective_batch_size
+from methods.modules.tokenizer import (
+    CHANNEL_GROUPS,
+    GroupedChannelPatchEmbed,
+    group_embed_per_token,
+    grouped_sine_cosine_positional_embedding,
+    parse_backbone,
+)
+
+
+def use_fused_attention(module: nn.Module) -> int:
+    """
+    Switches all timm attention layers in `module` to `torch.nn.functional.scaled_dot_product_attention` (flash or
+    memory efficient attention kernels), returns the number of switched layers.
+    """
+    num_layers = 0
+    for m in module.modules():
+        if hasattr(m, "fused_attn"):
+            m.fused_attn = True
+            num_layers += 1
+    return num_layers
 
 
 class MAE(LightningModule):
@@ -29,7 +49,24 @@ class MAE(LightningModule):
         has_online_classifier: bool,
         train_transform: Module,
         last_backbone_channel: int = None,
+        decoder_embed_dim: int = 512,
+        decoder_depth: int = 8,
+        decoder_num_heads: int = 16,
+        fused_attention: bool = False,
+        predict_ratio: float = None,
     ):
+        """
+        The defaults follow the original MAE. For a faster configuration (see "mae_fast" in main), the decoder can be
+        made smaller (`decoder_embed_dim`, `decoder_depth`, `decoder_num_heads`), the attention can use the fused
+        `scaled_dot_product_attention` kernels (`fused_attention`), and with `predict_ratio` the decoder only
+        processes the visible tokens and a random `predict_ratio` share of the masked tokens, which are the only ones
+        that are predicted and in the loss (1.0 predicts all masked tokens, as the original without decoding the
+        sequence in its full length).
+
+        The tokenizer can be set after the backbone name, e.g. "vit_base_patch16_224:p28" for another patch size or
+        "vit_base_patch16_224:spectral_p16" for one token per patch and channel group (see `CHANNEL_GROUPS`).
+        """
+        backbone, tokenizer = parse_backbone(backbone)
         assert (
             "vit" in backbone or backbone == "default"
         ), f"only vit backbone supported (given: {backbone})"
@@ -49,42 +86,82 @@ class MAE(LightningModule):
         vit = get_backbone(backbone, in_channels=in_channels, feautures_only=False)
         vit.default_cfg["input_size"] = (in_channels, img_size, img_size)
         # overriding the patch embedding for new channel and image size
-        vit.patch_embed = vit.patch_embed.__class__(
-            img_size=img_size,
-            patch_size=vit.patch_embed.patch_size,
-            in_chans=in_channels,
-            embed_dim=vit.embed_dim,
-        )
+        patch_size = vit.patch_embed.patch_size if tokenizer is None else tokenizer.patch_size
+        if tokenizer is None or tokenizer.channel_groups is None:
+            vit.patch_embed = vit.patch_embed.__class__(
+                img_size=img_size,
+                patch_size=patch_size,
+                in_chans=in_channels,
+                embed_dim=vit.embed_dim,
+            )
+        else:
+            vit.patch_embed = GroupedChannelPatchEmbed(
+                img_size=img_size,
+                patch_size=patch_size,
+                in_chans=in_channels,
+                embed_dim=vit.embed_dim,
+                channel_groups=CHANNEL_GROUPS[tokenizer.channel_groups],
+            )
         # fixing learned position embedding
         vit.num_patches = vit.patch_embed.num_patches
         self.sequence_length = vit.patch_embed.num_patches + vit.num_prefix_tokens
-        vit.pos_embed = Parameter(
-            torch.randn(1, self.sequence_length, vit.embed_dim) * 0.02
-        )
+        grouped = isinstance(vit.patch_embed, GroupedChannelPatchEmbed)
+        if grouped:
+            # the patch positions repeat for every channel group, which is embedded by the tokenizer
+            grid_size = vit.patch_embed.grid_size[0]
+            num_groups = vit.patch_embed.num_groups
+            vit.pos_embed = Parameter(
+                grouped_sine_cosine_positional_embedding(
+                    vit.embed_dim, grid_size, num_groups, vit.num_prefix_tokens
+                ),
+                requires_grad=False,
+            )
+        else:
+            vit.pos_embed = Parameter(
+                torch.randn(1, self.sequence_length, vit.embed_dim) * 0.02
+            )
 
         self.last_backbone_channel = vit.embed_dim
 
-        decoder_embed_dim = 512
         self.mask_ratio = 0.75
+        assert predict_ratio is None or 0 < predict_ratio <= 1, f"invalid predict ratio {predict_ratio}"
+        self.predict_ratio = predict_ratio
         self.patch_size = vit.patch_embed.patch_size[0]
-        num_patches = vit.patch_embed.num_patches
+        # the decoder initializes a square sine-cosine table, which is replaced for grouped tokens below
+        num_patches = grid_size**2 if grouped else vit.patch_embed.num_patches
         mask_token = Parameter(torch.zeros(1, 1, decoder_embed_dim))
         torch.nn.init.normal_(mask_token, std=0.02)
-        self.backbone = MaskedVisionTransformerTIMM(vit=vit)
+        self.backbone = MaskedVisionTransformerTIMM(
+            vit=vit, pos_embed_initialization="skip" if grouped else "sincos"
+        )
+        # grouped tokens only reconstruct the channels of their group
         self.decoder = MAEDecoderTIMM(
-            in_chans=in_channels,
+            in_chans=getattr(vit.patch_embed, "group_size", in_channels),
             num_patches=num_patches,
             patch_size=self.patch_size,
             embed_dim=vit.embed_dim,
             decoder_embed_dim=decoder_embed_dim,
-            decoder_depth=8,
-            decoder_num_heads=16,
+            decoder_depth=decoder_depth,
+            decoder_num_heads=decoder_num_heads,
             mlp_ratio=4.0,
             proj_drop_rate=0.0,
             attn_drop_rate=0.0,
             mask_token=mask_token,
         )
+        self.decoder_group_embed = None
+        if grouped:
+            self.decoder.decoder_pos_embed = Parameter(
+                grouped_sine_cosine_positional_embedding(
+                    decoder_embed_dim, grid_size, num_groups, vit.num_prefix_tokens
+                ),
+                requires_grad=False,
+            )
+            self.decoder_group_embed = Parameter(torch.zeros(1, num_groups, 1, decoder_embed_dim))
+            torch.nn.init.normal_(self.decoder_group_embed, std=0.02)
         self.criterion = MSELoss()
+        if fused_attention:
+            num_layers = use_fused_attention(self)
+            print_rank_zero(f"Using fused attention in {num_layers} attention layers")
 
         self.has_online_classifier = has_online_classifier
         if has_online_classifier:
@@ -103,6 +180,15 @@ class MAE(LightningModule):
     def forward_encoder(self, images, idx_keep=None):
         return self.backbone.encode(images=images, idx_keep=idx_keep)
 
+    def decoder_group_embed_per_token(self) -> Tensor:
+        """Learned channel group embedding of every decoder token of grouped tokenizers, shape (1, sequence, D)."""
+        num_patches = self.backbone.vit.patch_embed.num_patches
+        return group_embed_per_token(
+            self.decoder_group_embed,
+            tokens_per_group=num_patches // self.decoder_group_embed.shape[1],
+            num_prefix_tokens=self.sequence_length - num_patches,
+        )
+
     def forward_decoder(self, x_encoded, idx_keep, idx_mask):
         # build decoder input
         batch_size = x_encoded.shape[0]
@@ -111,6 +197,9 @@ class MAE(LightningModule):
             self.decoder.mask_token, (batch_size, self.sequence_length)
         )
         x_masked = utils.set_at_index(x_masked, idx_keep, x_decode.type_as(x_masked))
+        if self.decoder_group_embed is not None:
+            # the decoder adds the fixed position embedding itself
+            x_masked = x_masked + self.decoder_group_embed_per_token().type_as(x_masked)
 
         # decoder forward pass
         x_decoded = self.decoder.decode(x_masked)
@@ -120,12 +209,37 @@ class MAE(LightningModule):
         x_pred = self.decoder.predict(x_pred)
         return x_pred
 
-    def training_step(self, batch: Dict, batch_idx: int) -> Tensor:
-        images = batch[0]
-        # Create views
-        with torch.no_grad():
-            images = self.train_transform(images)[0] # only expecting single view
+    def forward_decoder_masked(self, x_encoded, idx_keep, idx_pred):
+        # the decoder only sees the visible tokens and the mask tokens to predict, the attention does not depend on the
+        # order of the tokens as they carry their position embedding
+        batch_size = x_encoded.shape[0]
+        x_decode = self.decoder.embed(x_encoded)
+        x_masked = utils.repeat_token(
+            self.decoder.mask_token, (batch_size, idx_pred.shape[1])
+        )
+        x = torch.cat([x_decode, x_masked.type_as(x_decode)], dim=1)
+        idx = torch.cat([idx_keep, idx_pred], dim=1)
+        pos_embed = self.decoder.decoder_pos_embed
+        if self.decoder_group_embed is not None:
+            pos_embed = pos_embed + self.decoder_group_embed_per_token()
+        pos_embed = pos_embed.expand(batch_size, -1, -1)
+        x = x + utils.get_at_index(pos_embed, idx).type_as(x)
+
+        # decoder forward pass
+        x = self.decoder.decoder_blocks(x)
+        x = self.decoder.decoder_norm(x)
 
+        # predict pixel values for the mask tokens
+        return self.decoder.predict(x[:, idx_keep.shape[1] :])
+
+    def patchify(self, images: Tensor) -> Tensor:
+        patch_embed = self.backbone.vit.patch_embed
+        if isinstance(patch_embed, GroupedChannelPatchEmbed):
+            return patch_embed.patchify(images)
+        return utils.patchify(images, self.patch_size)
+
+    def reconstruction_loss(self, images: Tensor) -> Tuple[Tensor, Tensor]:
+        """Masks and reconstructs the images, returns the loss and the encoded (visible) tokens."""
         batch_size = images.shape[0]
         idx_keep, idx_mask = utils.random_token_mask(
             size=(batch_size, self.sequence_length),
@@ -133,14 +247,27 @@ class MAE(LightningModule):
             device=images.device,
         )
         features = self.forward_encoder(images, idx_keep)
-        predictions = self.forward_decoder(features, idx_keep, idx_mask)
+        if self.predict_ratio is None:
+            predictions = self.forward_decoder(features, idx_keep, idx_mask)
+        else:
+            # the masked tokens are in random order, so the first ones are a random subset
+            num_pred = max(1, round(self.predict_ratio * idx_mask.shape[1]))
+            idx_mask = idx_mask[:, :num_pred]
+            predictions = self.forward_decoder_masked(features, idx_keep, idx_mask)
 
         # get image patches for masked tokens
-        patches = utils.patchify(images, self.patch_size)
+        patches = self.patchify(images)
         # must adjust idx_mask for missing class token
         target = utils.get_at_index(patches, idx_mask - 1)
+        return self.criterion(predictions, target), features
+
+    def training_step(self, batch: Dict, batch_idx: int) -> Tensor:
+        images = batch[0]
+        # Create views
+        with torch.no_grad():
+            images = self.train_transform(images)[0] # only expecting single view
 
-        loss = self.criterion(predictions, target)
+        loss, features = self.reconstruction_loss(images)
         self.log(
             "train_loss", loss, prog_bar=True, sync_dist=True, batch_size=len(images)
         )
@@ -181,6 +308,8 @@ class MAE(LightningModule):
         params, params_no_weight_decay = utils.get_weight_decay_parameters(
             [self.backbone, self.decoder]
         )
+        if self.decoder_group_embed is not None:
+            params_no_weight_decay.append(self.decoder_group_embed)
         param_list = [
             {"name": "mae", "params": params},
             {
@@ -199,7 +328,7 @@ class MAE(LightningModule):
             )
         optimizer = AdamW(
             param_list,
-            lr=1.5e-4 * self.batch_size_per_device * self.trainer.world_size / 256,
+            lr=1.5e-4 * get_effective_batch_size(self) / 256,
             weight_decay=0.05,
             betas=(0.9, 0.95),
         )
@@ -10,7 +10,7 @@ from lightly.utils.scheduler import CosineWarmupScheduler
 from torch import Tensor
 from torch.nn import Module
 
-from methods.modules.base import EOModule
+from methods.modules.base import EOModule, get_effective_batch_size
 
 
 class SimCLR(EOModule):
@@ -25,7 +25,13 @@ class SimCLR(EOModule):
         has_online_classifier: bool,
         train_transform: Module,
         last_backbone_channel: int = None,
+        memory_bank_size: int = 0,
     ):
+        """
+        With `memory_bank_size > 0`, the negatives are the projections of the last `memory_bank_size` samples (over
+        all devices) instead of the current batch, e.g. to keep the negatives of the full effective batch with
+        gradient accumulation.
+        """
         self.save_hyperparameters(ignore=["train_transform"])
         self.hparams["method"] = self.__class__.__name__
         super().__init__(
@@ -38,8 +44,19 @@ class SimCLR(EOModule):
             last_backbone_channel,
         )
 
-        self.projection_head = SimCLRProjectionHead(self.last_backbone_channel)
-        self.criterion = NTXentLoss(temperature=0.1, gather_distributed=True)
+        projection_dim = 128
+        self.projection_head = SimCLRProjectionHead(
+            self.last_backbone_channel, output_dim=projection_dim
+        )
+        self.criterion = NTXentLoss(
+            temperature=0.1,
+            gather_distributed=True,
+            memory_bank_size=(
+                (memory_bank_size, projection_dim)
+                if memory_bank_size > 0
+                else 0
+            ),
+        )
 
     def training_step(self, batch: Dict, batch_idx: int) -> Tensor:
         images = batch[0]
@@ -90,9 +107,9 @@ class SimCLR(EOModule):
             # Square root learning rate scaling improves performance for small
             # batch sizes (<=2048) and few training epochs (<=200). Alternatively,
             # linear scaling can be used for larger batches and longer training:
-            #   lr=0.3 * self.batch_size_per_device * self.trainer.world_size / 256
+            #   lr=0.3 * get_effective_batch_size(self) / 256
             # See Appendix B.1. in the SimCLR paper https://arxiv.org/abs/2002.05709
-            lr=0.075 * math.sqrt(self.batch_size_per_device * self.trainer.world_size),
+            lr=0.075 * math.sqrt(get_effective_batch_size(self)),
             momentum=0.9,
             # Note: Paper uses weight decay of 1e-6 but reference code 1e-4. See:
             # https://github.com/google-research/simclr/blob/2fc637bdd6a723130db91b377ac15151e01e4fc2/README.md?plain=1#L103
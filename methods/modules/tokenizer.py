@@ -0,0 +1,149 @@
+import re
+from typing import NamedTuple, Optional, Tuple
+
+import torch
+from lightly.models.utils import get_2d_sine_cosine_positional_embedding
+from torch import Tensor, nn
+
+# channel groups (indices into the Sentinel-2 bands of INP_MODALITIES: B1, B2, B3, B4, B5, B6, B7, B8A, B8, B9, B11,
+# B12), all groups of a tokenizer need the same number of channels
+CHANNEL_GROUPS = {
+    # as SatMAE: visible and NIR, red edge, and the remaining (aerosol, water vapour and SWIR) bands
+    "spectral": [[1, 2, 3, 8], [4, 5, 6, 7], [0, 9, 10, 11]],
+    # one group per band, as SpectralGPT
+    "band": [[i] for i in range(12)],
+}
+
+# "<groups>_p<patch size>" or "p<patch size>", appended to the backbone name, e.g. "vit_base_patch16_224:spectral_p28"
+_TOKENIZER_PATTERN = re.compile(rf"^(?:(?P<groups>{'|'.join(CHANNEL_GROUPS)})_)?p(?P<patch_size>\d+)$")
+
+
+class TokenizerConfig(NamedTuple):
+    patch_size: int
+    channel_groups: Optional[str] = None
+
+
+def parse_backbone(backbone: str) -> Tuple[str, Optional[TokenizerConfig]]:
+    """
+    Splits the tokenizer option off a backbone name like "vit_base_patch16_224:spectral_p28", returns the timm
+    backbone name and the tokenizer config (None without tokenizer option).
+    """
+    if ":" not in backbone:
+        return backbone, None
+    backbone, tokenizer = backbone.split(":", 1)
+    match = _TOKENIZER_PATTERN.match(tokenizer)
+    assert (
+        match is not None
+    ), f"unknown tokenizer '{tokenizer}', expected p<patch size> or <{'|'.join(CHANNEL_GROUPS)}>_p<patch size>"
+    return backbone, TokenizerConfig(int(match["patch_size"]), match["groups"])
+
+
+def grouped_sine_cosine_positional_embedding(
+    embed_dim: int, grid_size: int, num_groups: int, num_prefix_tokens: int = 1
+) -> Tensor:
+    """
+    Fixed 2d sine-cosine embedding of the patch positions, repeated for every channel group (group-major tokens), with
+    zeros for the prefix tokens. Shape (1, num_prefix_tokens + num_groups * grid_size ** 2, embed_dim).
+    """
+    pos_embed = torch.from_numpy(
+        get_2d_sine_cosine_positional_embedding(embed_dim, grid_size, cls_token=False)
+    ).float()
+    pos_embed = torch.cat([torch.zeros(num_prefix_tokens, embed_dim), pos_embed.repeat(num_groups, 1)])
+    return pos_embed[None]
+
+
+def group_embed_per_token(group_embed: Tensor, tokens_per_group: int, num_prefix_tokens: int = 1) -> Tensor:
+    """
+    Expands a per-group embedding of shape (1, G, 1, D) to all group-major tokens, with zeros for the prefix tokens.
+    Shape (1, num_prefix_tokens + G * tokens_per_group, D).
+    """
+    tokens = group_embed.expand(-1, -1, tokens_per_group, -1).reshape(1, -1, group_embed.shape[-1])
+    return torch.cat([tokens.new_zeros(1, num_prefix_tokens, tokens.shape[-1]), tokens], dim=1)
+
+
+class GroupedChannelPatchEmbed(nn.Module):
+    """
+    Patch embedding with a separate token per patch and channel group, with all groups embedded by one grouped
+    convolution. The tokens are group-major (all patches of the first group, then of the second, ...), so a
+    sequence has `len(channel_groups) * (img_size // patch_size) ** 2` tokens. A learned embedding of the group is
+    added to every token, the position of the patch is embedded by the ViT (see
+    `grouped_sine_cosine_positional_embedding`).
+
+    Follows the interface of the timm `PatchEmbed` that the ViT and the masked ViT of lightly use.
+
+    Parameters:
+    ----------
+    img_size : int
+        Size of the (square) input images.
+    patch_size : int
+        Size of the (square) patches, needs to divide `img_size`.
+    in_chans : int
+        Number of input channels.
+    embed_dim : int
+        Size of the token embeddings.
+    channel_groups : list[list[int]], optional
+        Channel indices of each group, one group with all channels by default.
+    """
+
+    def __init__(
+        self,
+        img_size: int,
+        patch_size: int,
+        in_chans: int,
+        embed_dim: int,
+        channel_groups: list[list[int]] = None,
+    ):
+        super().__init__()
+        if channel_groups is None:
+            channel_groups = [list(range(in_chans))]
+        group_size = len(channel_groups[0])
+        assert all(
+            len(group) == group_size for group in channel_groups
+        ), "all channel groups need the same number of channels"
+        assert all(
+            0 <= c < in_chans for group in channel_groups for c in group
+        ), f"channel groups do not fit {in_chans} input channels"
+        assert img_size % patch_size == 0, f"patch size {patch_size} does not divide the image size {img_size}"
+
+        self.img_size = (img_size, img_size)
+        self.patch_size = (patch_size, patch_size)
+        self.grid_size = (img_size // patch_size, img_size // patch_size)
+        self.num_groups = len(channel_groups)
+        self.group_size = group_size
+        self.num_patches = self.num_groups * self.grid_size[0] * self.grid_size[1]
+        self.embed_dim = embed_dim
+        # attributes of the timm PatchEmbed used by the ViT
+        self.flatten = True
+        self.dynamic_img_pad = False
+        self.register_buffer(
+            "channel_index", torch.tensor([c for group in channel_groups for c in group]), persistent=False
+        )
+        self.proj = nn.Conv2d(
+            self.num_groups * group_size,
+            self.num_groups * embed_dim,
+            kernel_size=patch_size,
+            stride=patch_size,
+            groups=self.num_groups,
+        )
+        self.group_embed = nn.Parameter(torch.zeros(1, self.num_groups, 1, embed_dim))
+        nn.init.normal_(self.group_embed, std=0.02)
+
+    def forward(self, x: Tensor) -> Tensor:
+        batch_size = x.shape[0]
+        x = self.proj(x[:, self.channel_index])
+        # (B, G * D, h, w) -> (B, G * h * w, D)
+        x = x.reshape(batch_size, self.num_groups, self.embed_dim, -1).transpose(2, 3)
+        x = x + self.group_embed.to(x.dtype)
+        return x.reshape(batch_size, -1, self.embed_dim)
+
+    def patchify(self, images: Tensor) -> Tensor:
+        """
+        Pixel values of each token, in the order of `lightly.models.utils.patchify` within a group, shape
+        (B, num_patches, patch_size ** 2 * group_size).
+        """
+        batch_size = images.shape[0]
+        p = self.patch_size[0]
+        h, w = self.grid_size
+        x = images[:, self.channel_index].reshape(batch_size, self.num_groups, self.group_size, h, p, w, p)
+        x = x.permute(0, 1, 3, 5, 4, 6, 2)
+        return x.reshape(batch_size, self.num_patches, p * p * self.group_size)
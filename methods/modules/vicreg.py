@@ -9,7 +9,7 @@ from lightly.utils.scheduler import CosineWarmupScheduler
 from torch import Tensor
 from torch.nn import Module
 
-from methods.modules.base import EOModule
+from methods.modules.base import EOModule, get_effective_batch_size
 
 
 class VICReg(EOModule):
@@ -73,7 +73,7 @@ class VICReg(EOModule):
         params, params_no_weight_decay = get_weight_decay_parameters(
             [self.backbone, self.projection_head]
         )
-        global_batch_size = self.batch_size_per_device * self.trainer.world_size
+        global_batch_size = get_effective_batch_size(self)
         base_lr = _get_base_learning_rate(global_batch_size=global_batch_size)
         param_list = [
             {"name": "vicreg", "params": params},
@@ -4,9 +4,11 @@ from .barlowtwins import (
     BarlowTwinsView1Transform,
     BarlowTwinsView2Transform,
 )
-from .base import to_tensor
+from .base import MultiViewTransform, to_tensor
 from .byol import BYOLTransform, BYOLView1Transform, BYOLView2Transform
+from .fused import FusedMultiViewTransform, ViewProbs
 from .mae import MAETransform
+from .multicrop import MultiCropTransform
 from .simclr import SimCLRTransform
 from .vicreg import VICRegTransform
 
@@ -17,7 +19,11 @@ __all__ = [
     "BYOLTransform",
     "BYOLView1Transform",
     "BYOLView2Transform",
+    "FusedMultiViewTransform",
+    "ViewProbs",
     "MAETransform",
+    "MultiViewTransform",
+    "MultiCropTransform",
     "SimCLRTransform",
     "VICRegTransform",
     "to_tensor"
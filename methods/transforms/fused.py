@@ -0,0 +1,158 @@
+from typing import NamedTuple, Tuple
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor, nn
+
+from methods.transforms.multicrop import resized_crops, sample_resized_crop_boxes
+
+
+class ViewProbs(NamedTuple):
+    """Probabilities of the augmentations of one view of a `FusedMultiViewTransform`."""
+
+    hflip: float = 0.5
+    vflip: float = 0.0
+    rotation: float = 0.0
+    blur: float = 0.0
+    solarize: float = 0.0
+
+
+def gaussian_kernels(sigma: Tensor, kernel_size: int) -> Tensor:
+    """Normalized 1d gaussian kernels of shape (N, kernel_size) for the standard deviations `sigma` of shape (N,)."""
+    r = torch.arange(kernel_size, device=sigma.device, dtype=sigma.dtype) - kernel_size // 2
+    kernels = torch.exp(-(r**2) / (2 * sigma[:, None] ** 2))
+    return kernels / kernels.sum(dim=1, keepdim=True)
+
+
+def separable_blur(images: Tensor, kernels: Tensor) -> Tensor:
+    """Blurs every image with its own kernel (zero padding) with two grouped convolutions over the whole batch."""
+    n, c, h, w = images.shape
+    k = kernels.shape[1]
+    weight = kernels.to(images.dtype).repeat_interleave(c, dim=0)
+    x = images.reshape(1, n * c, h, w)
+    x = F.conv2d(x, weight[:, None, None, :], padding=(0, k // 2), groups=n * c)
+    x = F.conv2d(x, weight[:, None, :, None], padding=(k // 2, 0), groups=n * c)
+    return x.reshape(n, c, h, w)
+
+
+def rotate(images: Tensor, degrees: Tensor) -> Tensor:
+    """Rotates every image counter-clockwise by its angle (bilinear, zero padding)."""
+    angle = torch.deg2rad(degrees).to(images.dtype)
+    cos, sin = torch.cos(angle), torch.sin(angle)
+    zero = torch.zeros_like(cos)
+    theta = torch.stack(
+        [torch.stack([cos, sin, zero], dim=1), torch.stack([-sin, cos, zero], dim=1)], dim=1
+    )
+    grid = F.affine_grid(theta, list(images.shape), align_corners=False)
+    return F.grid_sample(images, grid, mode="bilinear", padding_mode="zeros", align_corners=False)
+
+
+class FusedMultiViewTransform(nn.Module):
+    """
+    Creates all views of a batch with one pass of every augmentation over the stacked views.
+
+    The views are cropped with one `roi_align` call (see `MultiCropTransform`) and concatenated along the batch
+    dimension. The parameters of all V * B images are sampled at once and each augmentation (rotation, horizontal and
+    vertical flip, gaussian blur, solarization) runs once over the whole stack. The different probabilities of the
+    views (e.g. the asymmetric blur and solarization of BYOL) are applied with per-sample masks, so there is no data
+    dependent control flow and the transform can be captured by `torch.compile` or CUDA graphs.
+
+    The augmentations follow the kornia transforms of the method views (`RandomResizedCrop`, `RandomRotation`,
+    `RandomHorizontalFlip`, `RandomVerticalFlip`, `RandomGaussianBlur` with constant border and `RandomSolarize`).
+
+    Attributes:
+        input_size:
+            Size of the views in pixels.
+        view_probs:
+            Probabilities of the augmentations of each view, their number sets the number of views.
+        min_scale:
+            Minimum area of the crops relative to the image.
+        rr_degrees:
+            Range of degrees of the random rotation, a single number means [-rr_degrees, +rr_degrees].
+        sigmas:
+            Range of the standard deviation of the gaussian blur.
+        solarize_before_blur:
+            Order of the blur and the solarization, as in the VICReg views.
+        solarize_thresholds:
+            Range around 0.5 of the solarization threshold.
+        solarize_additions:
+            Range around 0 of the value added before solarizing.
+    """
+
+    def __init__(
+        self,
+        input_size: int,
+        view_probs: list[ViewProbs],
+        min_scale: float = 0.08,
+        rr_degrees: float = 90.0,
+        sigmas: Tuple[float, float] = (0.1, 2),
+        solarize_before_blur: bool = False,
+        solarize_thresholds: float = 0.1,
+        solarize_additions: float = 0.1,
+    ):
+        super().__init__()
+        self.input_size = input_size
+        self.view_probs = view_probs
+        self.scale = (min_scale, 1.0)
+        self.rr_degrees = rr_degrees
+        self.sigmas = sigmas
+        # same kernel size as the kornia blur of the views, which needs to be odd
+        kernel_size = input_size // 10
+        self.kernel_size = kernel_size + 1 if kernel_size % 2 == 0 else kernel_size
+        self.solarize_before_blur = solarize_before_blur
+        self.solarize_thresholds = solarize_thresholds
+        self.solarize_additions = solarize_additions
+        # (num_ops, num_views), expanded to one probability per sample in forward
+        self.register_buffer(
+            "probs", torch.tensor(view_probs, dtype=torch.float32).t().contiguous(), persistent=False
+        )
+
+    def _uniform(self, n: int, low: float, high: float, like: Tensor) -> Tensor:
+        return torch.empty(n, device=like.device, dtype=like.dtype).uniform_(low, high)
+
+    def _blur(self, x: Tensor, mask: Tensor) -> Tensor:
+        sigma = self._uniform(len(x), *self.sigmas, like=x)
+        kernels = gaussian_kernels(sigma, self.kernel_size)
+        # images without blur are convolved with a delta kernel
+        delta = torch.zeros_like(kernels)
+        delta[:, self.kernel_size // 2] = 1
+        return separable_blur(x, torch.where(mask[:, None], kernels, delta))
+
+    def _solarize(self, x: Tensor, mask: Tensor) -> Tensor:
+        n = len(x)
+        thresholds = 0.5 + self._uniform(n, -self.solarize_thresholds, self.solarize_thresholds, like=x)
+        additions = self._uniform(n, -self.solarize_additions, self.solarize_additions, like=x)
+        # as kornia.enhance.solarize: add, clamp to [0, 1] and invert the values above the threshold
+        y = (x + additions[:, None, None, None]).clamp(0, 1)
+        y = torch.where(y < thresholds[:, None, None, None], y, 1 - y)
+        return torch.where(mask[:, None, None, None], y, x)
+
+    def forward(self, images: Tensor) -> list[Tensor]:
+        num_views, batch_size = len(self.view_probs), len(images)
+        height, width = images.shape[-2:]
+        boxes = sample_resized_crop_boxes(
+            num_views * batch_size, height, width, self.scale, device=images.device
+        )
+        x = resized_crops(images, boxes, self.input_size)
+
+        # the views are stacked view-major, so each probability is repeated for the samples of its view
+        probs = self.probs.to(x.device).repeat_interleave(batch_size, dim=1)
+        masks = torch.rand_like(probs) < probs
+        hflip, vflip, rotation, blur, solarize = masks
+        max_probs = [max(p) for p in zip(*self.view_probs)]
+
+        # ops that no view uses are skipped
+        if max_probs[2] > 0:
+            degrees = self._uniform(len(x), -self.rr_degrees, self.rr_degrees, like=x)
+            x = rotate(x, degrees * rotation.to(x.dtype))
+        if max_probs[0] > 0:
+            x = torch.where(hflip[:, None, None, None], x.flip(-1), x)
+        if max_probs[1] > 0:
+            x = torch.where(vflip[:, None, None, None], x.flip(-2), x)
+        if self.solarize_before_blur and max_probs[4] > 0:
+            x = self._solarize(x, solarize)
+        if max_probs[3] > 0:
+            x = self._blur(x, blur)
+        if not self.solarize_before_blur and max_probs[4] > 0:
+            x = self._solarize(x, solarize)
+        return list(x.chunk(num_views))
@@ -0,0 +1,157 @@
+import math
+from typing import Optional, Tuple
+
+import kornia.augmentation as K
+import torch
+from torch import Tensor, nn
+from torchvision.ops import roi_align
+
+from methods.transforms.base import MultiViewTransform
+
+
+def sample_resized_crop_boxes(
+    num_boxes: int,
+    height: int,
+    width: int,
+    scale: Tuple[float, float],
+    ratio: Tuple[float, float] = (3.0 / 4.0, 4.0 / 3.0),
+    device: Optional[torch.device] = None,
+) -> Tensor:
+    """
+    Samples the boxes of `num_boxes` random resized crops at once, as `RandomResizedCrop`: the area (relative to the
+    image) is uniform in `scale` and the aspect ratio log-uniform in `ratio`. Boxes that do not fit into the image are
+    clipped instead of resampled.
+
+    Returns the boxes (x1, y1, x2, y2) in pixels, shape (num_boxes, 4).
+    """
+    area = height * width * torch.empty(num_boxes, device=device).uniform_(*scale)
+    aspect = torch.exp(
+        torch.empty(num_boxes, device=device).uniform_(math.log(ratio[0]), math.log(ratio[1]))
+    )
+    w = torch.sqrt(area * aspect).clamp(max=width)
+    h = torch.sqrt(area / aspect).clamp(max=height)
+    x1 = torch.rand(num_boxes, device=device) * (width - w)
+    y1 = torch.rand(num_boxes, device=device) * (height - h)
+    return torch.stack([x1, y1, x1 + w, y1 + h], dim=1)
+
+
+def resized_crops(images: Tensor, boxes: Tensor, size: int) -> Tensor:
+    """
+    Crops `boxes` of shape (V * B, 4), view-major, out of the batch of B images and resizes them to `size` in one
+    `roi_align` call. Downscaled crops average several samples per output pixel.
+
+    Returns the crops of shape (V * B, C, size, size).
+    """
+    batch_idx = torch.arange(len(images), device=images.device).repeat(len(boxes) // len(images))
+    rois = torch.cat([batch_idx[:, None].to(boxes.dtype), boxes], dim=1)
+    return roi_align(
+        images, rois.to(images.dtype), output_size=(size, size), aligned=True
+    )
+
+
+def _get_crop_ranges(crop: K.RandomResizedCrop) -> Tuple[Tuple[float, ...], Tuple[float, ...]]:
+    """The scale and aspect ratio ranges of a kornia `RandomResizedCrop` (kept by its parameter generator)."""
+    generator = crop._param_generator
+    scale = tuple(round(float(s), 6) for s in generator.scale)
+    ratio = tuple(round(float(r), 6) for r in generator.ratio)
+    return scale, ratio
+
+
+class MultiCropTransform(nn.Module):
+    """
+    Creates the views of a batch with batched random resized crops: the crop boxes of all views are sampled at once and
+    all crops of one resolution are produced by a single `roi_align` call, instead of one `RandomResizedCrop` per view.
+
+    Every global view is followed by its own `view_transforms` (e.g. flips and blur). Optionally, `num_local_crops`
+    additional low resolution crops of smaller regions (as in DINO or SwAV) are appended to the views, which cost a
+    fraction of a global view.
+
+    Attributes:
+        input_size:
+            Size of the global views in pixels.
+        view_transforms:
+            Transform applied to each global view after cropping, their number sets the number of global views.
+        min_scale:
+            Minimum area of the global crops relative to the image.
+        ratio:
+            Range of the aspect ratio of the global crops.
+        num_local_crops:
+            Number of local views.
+        local_size:
+            Size of the local views in pixels.
+        local_scale:
+            Range of the area of the local crops relative to the image.
+        local_transform:
+            Transform applied to every local view after cropping.
+    """
+
+    def __init__(
+        self,
+        input_size: int,
+        view_transforms: list[nn.Module],
+        min_scale: float = 0.08,
+        ratio: Tuple[float, float] = (3.0 / 4.0, 4.0 / 3.0),
+        num_local_crops: int = 0,
+        local_size: int = 48,
+        local_scale: Tuple[float, float] = (0.05, 0.4),
+        local_transform: nn.Module = None,
+    ):
+        super().__init__()
+        self.input_size = input_size
+        self.view_transforms = nn.ModuleList(view_transforms)
+        self.scale = (min_scale, 1.0)
+        self.ratio = ratio
+        self.num_local_crops = num_local_crops
+        self.local_size = local_size
+        self.local_scale = local_scale
+        self.local_transform = nn.Identity() if local_transform is None else local_transform
+
+    @classmethod
+    def from_multi_view(
+        cls, transform: MultiViewTransform, input_size: int, **kwargs
+    ) -> "MultiCropTransform":
+        """
+        Replaces the `RandomResizedCrop` at the start of every view transform of a `MultiViewTransform` (e.g.
+        `SimCLRTransform`) with the batched crops, with the same scale and aspect ratio ranges. The remaining
+        augmentations of each view are kept.
+        """
+        view_transforms = []
+        crop_ranges = set()
+        for view_transform in transform.view_transforms:
+            crop = view_transform[0]
+            assert isinstance(
+                crop, K.RandomResizedCrop
+            ), "the view transforms need to start with a RandomResizedCrop"
+            crop_ranges.add(_get_crop_ranges(crop))
+            # slicing would call the constructor of the view transform class
+            view_transforms.append(nn.Sequential(*list(view_transform)[1:]))
+        assert len(crop_ranges) == 1, f"the views need the same crop scale and ratio, got {crop_ranges}"
+        scale, ratio = crop_ranges.pop()
+        assert scale[1] == 1.0, f"only crops up to the full image are supported, got scale {scale}"
+        kwargs.setdefault("min_scale", scale[0])
+        kwargs.setdefault("ratio", ratio)
+        return cls(input_size, view_transforms, **kwargs)
+
+    def _crop(
+        self,
+        images: Tensor,
+        num_views: int,
+        size: int,
+        scale: Tuple[float, float],
+        ratio: Tuple[float, float] = (3.0 / 4.0, 4.0 / 3.0),
+    ) -> list[Tensor]:
+        height, width = images.shape[-2:]
+        boxes = sample_resized_crop_boxes(
+            num_views * len(images), height, width, scale, ratio, device=images.device
+        )
+        return list(resized_crops(images, boxes, size).chunk(num_views))
+
+    def forward(self, images: Tensor) -> list[Tensor]:
+        crops = self._crop(
+            images, len(self.view_transforms), self.input_size, self.scale, self.ratio
+        )
+        views = [transform(crop) for transform, crop in zip(self.view_transforms, crops)]
+        if self.num_local_crops > 0:
+            local_crops = self._crop(images, self.num_local_crops, self.local_size, self.local_scale)
+            views += [self.local_transform(crop) for crop in local_crops]
+        return views
@@ -10,7 +10,9 @@ from data.mmearth_dataset import (
     create_MMEearth_args,
     get_mmearth_dataloaders,
 )
+from main import METHODS
 from methods import transforms
+import kornia.augmentation as K
 import torch
 
 
@@ -28,6 +30,9 @@ import torch
         ),
         transforms.VICRegTransform(input_size=input_size),
         transforms.MAETransform(input_size=input_size),
+        transforms.MultiCropTransform.from_multi_view(
+            transforms.SimCLRTransform(input_size=input_size), input_size, num_local_crops=2
+        ),
     ],
 )
 def test_augmentations(transform):
@@ -94,3 +99,88 @@ def test_augmentation_dataloader(transform, no_ffcv):
     finally:
         # cleanup
         shutil.rmtree(test_out, ignore_errors=True)
+
+
+def test_multicrop_transform():
+    images = torch.rand(4, 12, 64, 64)
+    transform = transforms.MultiCropTransform.from_multi_view(
+        transforms.BYOLTransform(
+            transforms.BYOLView1Transform(input_size=56),
+            transforms.BYOLView2Transform(input_size=56),
+        ),
+        56,
+        num_local_crops=3,
+        local_size=24,
+    )
+    views = transform(images)
+    assert [v.shape for v in views] == [(4, 12, 56, 56)] * 2 + [(4, 12, 24, 24)] * 3
+    # the crop ranges of the replaced RandomResizedCrop are kept
+    transform = transforms.MultiCropTransform.from_multi_view(
+        transforms.SimCLRTransform(input_size=56, min_scale=0.3), 56
+    )
+    assert transform.scale == (0.3, 1.0)
+    assert transform.ratio == pytest.approx((3.0 / 4.0, 4.0 / 3.0))
+
+    # a crop of the full image at its own size is the image itself
+    transform = transforms.MultiCropTransform(64, [torch.nn.Identity()], min_scale=1.0)
+    boxes = transforms.multicrop.sample_resized_crop_boxes(4, 64, 64, (1.0, 1.0), ratio=(1.0, 1.0))
+    assert torch.allclose(boxes, torch.tensor([[0.0, 0.0, 64.0, 64.0]] * 4))
+    assert torch.allclose(transforms.multicrop.resized_crops(images, boxes, 64), images, atol=1e-5)
+    assert transform(images)[0].shape == images.shape
+
+
+def test_fused_multi_view_transform():
+    images = torch.rand(4, 12, 64, 64)
+    transform = transforms.FusedMultiViewTransform(
+        56,
+        [
+            transforms.ViewProbs(vflip=0.5, rotation=0.5, blur=1.0, solarize=0.0),
+            transforms.ViewProbs(vflip=0.5, rotation=0.5, blur=0.1, solarize=0.2),
+            transforms.ViewProbs(),
+        ],
+    )
+    views = transform(images)
+    assert [v.shape for v in views] == [(4, 12, 56, 56)] * 3
+    assert all(torch.isfinite(v).all() for v in views)
+
+    # the delta kernel of unblurred samples and a zero rotation keep the images
+    kernels = torch.zeros(4, transform.kernel_size)
+    kernels[:, transform.kernel_size // 2] = 1
+    assert torch.allclose(transforms.fused.separable_blur(images, kernels), images, atol=1e-6)
+    assert torch.allclose(transforms.fused.rotate(images, torch.zeros(4)), images, atol=1e-5)
+    assert torch.allclose(
+        transforms.fused.gaussian_kernels(torch.tensor([0.1, 2.0]), 11).sum(dim=1), torch.ones(2)
+    )
+
+
+def _blur_sigmas(blur: K.RandomGaussianBlur) -> tuple:
+    # kept by the parameter generator in recent kornia versions, in the flags before
+    sigma = getattr(getattr(blur, "_param_generator", None), "sigma", None)
+    if sigma is None:
+        sigma = blur.flags["sigma"]
+    return tuple(round(float(s), 6) for s in sigma)
+
+
+@pytest.mark.parametrize(
+    "method", [method for method in METHODS if "fused_transform" in METHODS[method]]
+)
+def test_fused_transform_config(method):
+    # the fused pipeline reproduces the kornia views of the method
+    transform = METHODS[method]["transform"]
+    fused = METHODS[method]["fused_transform"]
+    assert len(fused.view_probs) == len(transform.view_transforms)
+
+    for probs, view_transform in zip(fused.view_probs, transform.view_transforms):
+        ops = {type(op): (i, op) for i, op in enumerate(view_transform)}
+        scale, _ = transforms.multicrop._get_crop_ranges(ops[K.RandomResizedCrop][1])
+        assert fused.scale == pytest.approx(scale)
+        assert probs.hflip == pytest.approx(ops[K.RandomHorizontalFlip][1].p)
+        assert probs.vflip == pytest.approx(ops[K.RandomVerticalFlip][1].p)
+        assert probs.rotation == pytest.approx(ops[K.RandomRotation][1].p)
+        blur_idx, blur = ops[K.RandomGaussianBlur]
+        assert probs.blur == pytest.approx(blur.p)
+        assert fused.sigmas == pytest.approx(_blur_sigmas(blur))
+        solarize_idx, solarize = ops.get(K.RandomSolarize, (None, None))
+        assert probs.solarize == pytest.approx(0.0 if solarize is None else solarize.p)
+        if solarize is not None and solarize.p > 0 and blur.p > 0:
+            assert fused.solarize_before_blur == (solarize_idx < blur_idx)
@@ -3,7 +3,12 @@ from pathlib import Path
 
 from data import constants
 from data.constants import MMEARTH_DIR
-from data.mmearth_dataset import MMEarthDataset, create_MMEearth_args, convert_mmearth_to_beton
+from data.mmearth_dataset import (
+    MMEarthDataset,
+    create_MMEearth_args,
+    convert_mmearth_to_beton,
+    get_mmearth_ffcv_loader,
+)
 
 
 def test_mmearth_dataset():
@@ -26,3 +31,43 @@ def test_mmearth_dataset():
     finally:
         # cleanup
         shutil.rmtree(test_out, ignore_errors=True)
+
+
+def test_mmearth_multi_modality():
+    split = "train"
+    modalities = {
+        "sentinel2": constants.INP_MODALITIES["sentinel2"],
+        "sentinel1": "all",
+        "aster": "all",
+        "era5": "all",
+    }
+    targets = {
+        "dynamic_world": "all",
+        "biome": constants.MODALITIES_FULL["biome"],
+    }
+
+    args = create_MMEearth_args(MMEARTH_DIR, modalities, targets)
+    dataset = MMEarthDataset(args, split=split, transform=None, return_tuple=True)
+
+    test_out = Path("test_out")
+    test_out.mkdir(exist_ok=True)
+    write_path = test_out / "mmearth.beton"
+
+    try:
+        convert_mmearth_to_beton(dataset, write_path, indices=[i for i in range(10)])
+        loader = get_mmearth_ffcv_loader(
+            write_path, args.modalities, num_workers=1, batch_size_per_device=5, is_train=False
+        )
+        batch = next(iter(loader))
+        # one entry per modality, in the order of the modalities
+        assert len(batch) == len(args.modalities)
+        s2, s1, aster, era5, dynamic_world, biome = batch
+        assert s2.shape == (5, 12, 128, 128)
+        assert s1.shape == (5, 8, 128, 128)
+        assert aster.shape == (5, 2, 128, 128)
+        assert era5.shape == (5, 12)
+        assert dynamic_world.shape == (5, 1, 128, 128)
+        assert biome.shape == (5,)
+    finally:
+        # cleanup
+        shutil.rmtree(test_out, ignore_errors=True)
@@ -1,12 +1,25 @@
+import pickle
 import shutil
 from pathlib import Path
 
+import h5py
 import numpy as np
 import pytest
+import torch
 
 from data import GeobenchDataset, get_mmearth_dataloaders
 from data import MMEarthDataset, create_MMEearth_args
-from data import constants, get_geobench_dataloaders
+from data import constants, get_geobench_dataloaders, get_num_samples
+from data.beton_cache import evict_cache, is_cached, mark_cached
+from data.beton_shards import ShardedLoader
+from data.label_remap import apply_label_lut, build_label_lut
+from data.mmearth_dataset import read_rows_and_bands, wrap_sentinel2_loader
+from data.chunk_sampler import ChunkAwareSampler
+from data.geobench_dataset import get_partition_indices, load_partition_indices
+from data.hdf5_handle import HDF5Handle
+from data.memmap_cache import export_memmap_cache
+from data.stream_shards import StreamShardDataset, export_stream_shards
+from tests.utils import remap_labels_loop
 
 
 @pytest.mark.parametrize("split", ["train", "val", "test"])
@@ -51,6 +64,256 @@ def test_mmearth_dataset(split, modalities, target_modalities):
     # no tests for val/test currently
 
 
+@pytest.mark.parametrize(
+    "modalities",
+    [constants.INP_MODALITIES, constants.RGB_MODALITIES],
+)
+def test_mmearth_get_batch(modalities):
+    args = create_MMEearth_args(
+        constants.MMEARTH_DIR, modalities, {"biome": constants.MODALITIES_FULL["biome"]}
+    )
+    dataset = MMEarthDataset(args, split="train", transform=None)
+
+    # unsorted, scattered and duplicated indices
+    idxs = [7, 0, 3, 3, len(dataset) - 1]
+    batch = dataset.get_batch(idxs)
+    for i, idx in enumerate(idxs):
+        sample = dataset[idx]
+        np.testing.assert_array_equal(batch["sentinel2"][i], sample["sentinel2"])
+        assert batch["biome"][i] == sample["biome"]
+        assert batch["id"][i] == sample["id"]
+
+
+@pytest.mark.parametrize("storage", ["float16", "uint16"])
+def test_sentinel2_storage(storage):
+    args = create_MMEearth_args(
+        constants.MMEARTH_DIR,
+        constants.INP_MODALITIES,
+        {"biome": constants.MODALITIES_FULL["biome"]},
+    )
+    dataset = MMEarthDataset(args, split="train", return_tuple=True)
+    compact = MMEarthDataset(
+        args, split="train", return_tuple=True, sentinel2_storage=storage
+    )
+
+    idxs = list(range(8))
+    expected = dataset.get_batch(idxs)[0]
+    batch = compact.get_batch(idxs)
+    # the normalizing loader wraps any iterable of batches
+    loader = wrap_sentinel2_loader(
+        [tuple(torch.from_numpy(np.asarray(v)) for v in batch[:-1])], args, storage
+    )
+    x, label = next(iter(loader))
+    assert x.dtype == torch.float32
+    np.testing.assert_allclose(
+        x.cpu().numpy(), expected, rtol=1e-3, atol=1e-2, equal_nan=True
+    )
+    np.testing.assert_array_equal(label.cpu().numpy(), batch[1])
+
+
+def test_stream_shards():
+    args = create_MMEearth_args(
+        constants.MMEARTH_DIR,
+        constants.INP_MODALITIES,
+        {"biome": constants.MODALITIES_FULL["biome"]},
+    )
+    dataset = MMEarthDataset(args, split="train")
+    indices = list(range(10))
+
+    test_out = Path("test_out")
+    test_out.mkdir(exist_ok=True)
+    try:
+        manifest = export_stream_shards(dataset, test_out, 4, indices=indices)
+        assert manifest["num_shards"] == 3
+        assert manifest["keys"] == ["sentinel2", "biome"]
+
+        # all samples in order without shuffling
+        samples = list(StreamShardDataset(test_out, shuffle=False))
+        assert len(samples) == len(indices)
+        for idx, (s2, biome) in zip(indices, samples):
+            np.testing.assert_array_equal(s2, dataset[idx]["sentinel2"])
+            assert biome == dataset[idx]["biome"]
+
+        # training drops the incomplete last shard and shuffles the samples of the others
+        stream = StreamShardDataset(test_out, shuffle=True, shuffle_buffer_size=3)
+        assert len(stream) == 8
+        biomes = [biome for _, biome in stream]
+        assert sorted(biomes) == sorted(dataset[idx]["biome"] for idx in indices[:8])
+
+        # with more ranks than shards, the shards are repeated so every rank gets the same number of samples
+        rank_shards = [stream._get_shards(0, rank, 4) for rank in range(4)]
+        assert all(len(shards) == 1 for shards in rank_shards)
+        assert {shard for shards in rank_shards for shard in shards} == {0, 1}
+
+        # without shuffling, the ranks read equally long ranges of all samples, padded with the first ones
+        stream = StreamShardDataset(test_out, shuffle=False)
+        rank_segments = [stream._get_segments(0, rank, 3) for rank in range(3)]
+        rank_samples = [
+            [shard_id * 4 + i for shard_id, start, stop in segments for i in range(start, stop)]
+            for segments in rank_segments
+        ]
+        assert all(len(samples) == 4 for samples in rank_samples)
+        assert sum(rank_samples, []) == list(range(10)) + [0, 1]
+    finally:
+        shutil.rmtree(test_out, ignore_errors=True)
+
+
+def test_memmap_cache():
+    args = create_MMEearth_args(
+        constants.MMEARTH_DIR,
+        constants.INP_MODALITIES,
+        {"biome": constants.MODALITIES_FULL["biome"]},
+    )
+    dataset = MMEarthDataset(args, split="val")
+
+    test_out = Path("test_out")
+    test_out.mkdir(exist_ok=True)
+    try:
+        export_memmap_cache(dataset, test_out, block_size=7)
+        cached = MMEarthDataset(args, split="val", memmap_dir=test_out)
+        assert len(cached) == len(dataset)
+        for idx in [0, 6, 7, len(dataset) - 1]:
+            sample, expected = cached[idx], dataset[idx]
+            np.testing.assert_array_equal(sample["sentinel2"], expected["sentinel2"])
+            assert sample["biome"] == expected["biome"]
+            assert sample["id"] == expected["id"]
+        batch = cached.get_batch([3, 1])
+        np.testing.assert_array_equal(batch["sentinel2"][1], dataset[1]["sentinel2"])
+    finally:
+        shutil.rmtree(test_out, ignore_errors=True)
+
+
+def test_read_rows_and_bands():
+    test_out = Path("test_out")
+    test_out.mkdir(exist_ok=True)
+    try:
+        data = np.random.default_rng(0).random((20, 6, 4, 4)).astype(np.float32)
+        with h5py.File(test_out / "data.h5", "w") as f:
+            f.create_dataset("sentinel2", data=data, chunks=(4, 2, 4, 4))
+        with h5py.File(test_out / "data.h5", "r") as f:
+            rows, bands = np.array([1, 2, 9, 17]), np.array([0, 3, 4])
+            np.testing.assert_array_equal(
+                read_rows_and_bands(f["sentinel2"], rows, bands), data[rows][:, bands]
+            )
+    finally:
+        shutil.rmtree(test_out, ignore_errors=True)
+
+
+def test_hdf5_handle():
+    test_out = Path("test_out")
+    test_out.mkdir(exist_ok=True)
+    try:
+        path = test_out / "data.h5"
+        with h5py.File(path, "w") as f:
+            f.create_dataset("sentinel2", data=np.ones((8, 2, 4, 4)), chunks=(4, 1, 4, 4))
+
+        handle = HDF5Handle(path, rdcc_nbytes=1024**2, rdcc_nslots=521)
+        assert not handle.is_open()
+        handle.log_chunk_layout(["sentinel2"])
+        assert handle.get()["sentinel2"].shape == (8, 2, 4, 4)
+        assert handle.get() is handle.get()
+
+        # the open file is not pickled, the copy opens its own handle
+        copy = pickle.loads(pickle.dumps(handle))
+        assert not copy.is_open()
+        np.testing.assert_array_equal(copy.get()["sentinel2"][0], 1)
+
+        handle.close()
+        copy.close()
+        assert not handle.is_open()
+    finally:
+        shutil.rmtree(test_out, ignore_errors=True)
+
+
+def test_chunk_aware_sampler():
+    rows = list(np.random.default_rng(0).permutation(1000))
+    sampler = ChunkAwareSampler(rows, chunk_rows=10, shuffle_buffer_size=20, seed=0)
+
+    epoch_0 = list(sampler)
+    # the order only depends on the epoch
+    assert list(sampler) == epoch_0
+    sampler.set_epoch(1)
+    epoch_1 = list(sampler)
+    # every sample once per epoch, in a new order every epoch
+    assert sorted(epoch_0) == list(range(len(rows)))
+    assert sorted(epoch_1) == list(range(len(rows)))
+    assert epoch_0 != epoch_1
+
+    # batches touch far fewer chunks than with a uniformly random order (about 18 chunks per 20 samples)
+    chunks_per_batch = [
+        len({rows[idx] // 10 for idx in epoch_0[i : i + 20]})
+        for i in range(0, len(rows), 20)
+    ]
+    assert np.mean(chunks_per_batch) < 10
+
+
+@pytest.mark.parametrize("num_replicas", [2, 3])
+def test_chunk_aware_sampler_ranks(num_replicas):
+    rows = list(np.random.default_rng(0).permutation(1000))
+    samplers = [
+        ChunkAwareSampler(
+            rows, chunk_rows=10, shuffle_buffer_size=20, num_replicas=num_replicas, rank=rank
+        )
+        for rank in range(num_replicas)
+    ]
+    for epoch in range(2):
+        for sampler in samplers:
+            sampler.set_epoch(epoch)
+        orders = [list(sampler) for sampler in samplers]
+
+        # same number of samples on every rank, all samples once (plus the padding)
+        num_samples = int(np.ceil(len(rows) / num_replicas))
+        assert all(
+            len(order) == len(sampler) == num_samples
+            for order, sampler in zip(orders, samplers)
+        )
+        samples = [idx for order in orders for idx in order]
+        assert sorted(set(samples)) == list(range(len(rows)))
+        assert len(samples) - len(set(samples)) == num_samples * num_replicas - len(rows)
+    assert samplers[1].rank == 1 and samplers[1].num_replicas == num_replicas
+
+
+@pytest.mark.parametrize("modality", ["dynamic_world", "esa_worldcover"])
+def test_label_lut(modality):
+    lut = build_label_lut(modality)
+
+    # all valid raw values must be remapped the same way as with the old loop
+    valid = constants.LABEL_REMAP[modality]["old"] + [constants.NO_DATA_VAL[modality]]
+    raw = np.array(valid, dtype=np.uint8)
+    np.testing.assert_array_equal(
+        apply_label_lut(raw, lut), remap_labels_loop(raw, modality)
+    )
+
+    # values outside the table are no data
+    raw = np.array([-1, 256, 1000], dtype=np.int64)
+    assert np.all(np.isnan(apply_label_lut(raw, lut)))
+
+
+def test_evict_cache():
+    test_out = Path("test_out")
+    test_out.mkdir(exist_ok=True)
+
+    try:
+        entries = [test_out / f"{i}.beton" for i in range(3)]
+        for i, entry in enumerate(entries):
+            entry.write_bytes(b"0" * 100)
+            mark_cached(entry, {"i": i})
+        # not a cache entry, must never be removed
+        (test_out / "other.beton").write_bytes(b"0" * 1000)
+        # mark the first entry as recently used
+        assert is_cached(entries[0])
+
+        evict_cache(test_out, max_bytes=250, keep=[entries[2]])
+
+        assert is_cached(entries[0])
+        assert not entries[1].exists()
+        assert is_cached(entries[2])
+        assert (test_out / "other.beton").exists()
+    finally:
+        # cleanup
+        shutil.rmtree(test_out, ignore_errors=True)
+
+
 @pytest.mark.parametrize(
     "modalities",
     [constants.INP_MODALITIES, constants.RGB_MODALITIES],
@@ -90,6 +353,67 @@ def test_mmearth_dataloader(modalities, target_modalities, no_ffcv):
         shutil.rmtree(test_out, ignore_errors=True)
 
 
+class _ShardLoader:
+    # the parts of an ffcv.Loader (without drop_last) used by the ShardedLoader
+    def __init__(self, indices: list[int], batch_size: int):
+        self.indices = indices
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return -(-len(self.indices) // self.batch_size)
+
+    def __iter__(self):
+        for start in range(0, len(self.indices), self.batch_size):
+            idx = torch.tensor(self.indices[start : start + self.batch_size])
+            yield idx, -idx
+
+
+def test_sharded_loader():
+    shards = [list(range(start, start + 7)) for start in range(0, 35, 7)]
+    loader = ShardedLoader(
+        [_ShardLoader(shard, 3) for shard in shards], shuffle=True, seed=0, batch_size=3, num_interleaved=2
+    )
+    batches = list(loader)
+    assert len(batches) == len(loader) == 35 // 3
+    assert all(len(b[0]) == 3 and torch.equal(b[1], -b[0]) for b in batches)
+    # the incomplete batches of the shards are merged, only the last 35 % 3 samples are dropped
+    samples = torch.cat([b[0] for b in batches]).tolist()
+    assert len(set(samples)) == len(samples) == 33
+    # the shards are interleaved
+    shard_order = [int(b[0][0]) // 7 for b in batches]
+    assert shard_order != sorted(shard_order)
+
+    loader = ShardedLoader([_ShardLoader(shard, 3) for shard in shards], shuffle=False)
+    assert torch.cat([b[0] for b in loader]).tolist() == list(range(35))
+
+
+@pytest.mark.parametrize("backend", ["ffcv", "stream"])
+def test_get_num_samples(backend):
+    test_out = Path("test_out")
+    test_out.mkdir(exist_ok=True)
+
+    try:
+        # 11 samples, so the last batch of 2 is incomplete
+        (loader,) = get_mmearth_dataloaders(
+            constants.MMEARTH_DIR,
+            test_out,
+            constants.RGB_MODALITIES,
+            {"biome": constants.MODALITIES_FULL["biome"]},
+            2,
+            2,
+            ["train"],
+            indices=[list(range(11))],
+            backend=backend,
+            samples_per_shard=4,
+            sequential=True,
+        )
+        assert get_num_samples(loader) == 11
+        assert sum(len(batch[0]) for batch in loader) == 11
+    finally:
+        # cleanup
+        shutil.rmtree(test_out, ignore_errors=True)
+
+
 @pytest.mark.parametrize("split", ["train", "val", "test"])
 @pytest.mark.parametrize(
     "dataset_name",
@@ -120,6 +444,31 @@ def test_geobench_dataset(split, dataset_name):
     ), f"Dataset '{dataset_name}' should have {expected} channels, found {n_channel}"
 
 
+@pytest.mark.parametrize("dataset_name", ["m-eurosat", "m-bigearthnet"])
+def test_geobench_partition_indices(dataset_name):
+    full = GeobenchDataset(dataset_name=dataset_name, split="train")
+    partition = GeobenchDataset(
+        dataset_name=dataset_name, split="train", partition="0.01x_train"
+    )
+    idx = get_partition_indices(full.dataset_dir, "0.01x_train", "train")
+
+    assert len(idx) == len(partition)
+    for i in [0, len(idx) - 1]:
+        np.testing.assert_array_equal(full[idx[i]][0], partition[i][0])
+
+    test_out = Path("test_out")
+    test_out.mkdir(exist_ok=True)
+    try:
+        # computed once, then read from the cached sidecar
+        for _ in range(2):
+            cached = load_partition_indices(
+                test_out, full.dataset_dir, dataset_name, "0.01x_train", "train"
+            )
+            np.testing.assert_array_equal(cached, idx)
+    finally:
+        shutil.rmtree(test_out, ignore_errors=True)
+
+
 @pytest.mark.parametrize(
     "dataset_name",
     [
@@ -154,6 +503,9 @@ def test_geobench_dataloader(dataset_name, no_ffcv):
         )
         for loader in loaders:
             for data in loader:
+                # input and label, the mean and std are attributes of the loader
+                assert len(data) == 2
+                assert loader.mean.shape == loader.std.shape == (data[0].shape[1],)
                 break
     finally:
         # cleanup
@@ -0,0 +1,31 @@
+import copy
+
+import pytest
+import torch
+from lightly.models.utils import update_momentum
+from torch import nn
+
+from methods.modules.ema import FusedEMA
+
+
+@pytest.mark.parametrize("every_k", [1, 3])
+def test_fused_ema(every_k):
+    torch.manual_seed(0)
+    student = nn.Sequential(nn.Linear(8, 16), nn.BatchNorm1d(16), nn.Linear(16, 4))
+    teacher = copy.deepcopy(student)
+    reference = copy.deepcopy(student)
+    for p in teacher.parameters():
+        p.data.normal_()
+    reference.load_state_dict(teacher.state_dict())
+    ema = FusedEMA([(student, teacher)], every_k=every_k)
+
+    # with a constant student, every k-th update equals k updates of lightly
+    for step in range(2 * every_k):
+        assert ema.update(0.9, step=step) == (step % every_k == 0)
+    for _ in range(2 * every_k):
+        update_momentum(student, reference, m=0.9)
+    for p, q in zip(teacher.parameters(), reference.parameters()):
+        assert torch.allclose(p, q, atol=1e-6)
+    # the buffers of the teacher are kept, as with update_momentum
+    for b, c in zip(teacher.buffers(), reference.buffers()):
+        assert torch.equal(b, c)
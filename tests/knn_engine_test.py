@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from eval.knn_engine import (
+    IVFPQIndex,
+    exact_topk,
+    knn_classify,
+    normalize,
+    recall_at_k,
+)
+from tests.utils import make_bank
+
+
+@pytest.mark.parametrize("block_size", [7, 1000, 65536])
+def test_exact_topk(block_size):
+    bank, _, queries, _ = make_bank(2000, 50, 32, 10)
+    sims, idx = exact_topk(bank, queries, 20, block_size=block_size)
+
+    full = normalize(queries) @ normalize(bank).T
+    expected = np.sort(full, axis=1)[:, ::-1][:, :20]
+    assert idx.shape == (50, 20)
+    assert np.allclose(sims, expected, atol=1e-5)
+    assert np.allclose(np.take_along_axis(full, idx, axis=1), sims, atol=1e-5)
+
+
+def test_ivfpq_recall():
+    bank, bank_labels, queries, query_labels = make_bank(5000, 100, 32, 10, noise=0.5)
+    _, exact_idx = exact_topk(bank, queries, 10)
+
+    index = IVFPQIndex.build(bank, nlist=16, m=8, nbits=6, num_iters=10)
+    _, approx_idx = index.search(queries, 10, nprobe=16, bank=bank, rerank=50)
+    # all lists are searched and the candidates are reranked exactly
+    full_recall = recall_at_k(approx_idx, exact_idx)
+    assert full_recall > 0.9
+
+    _, approx_idx = index.search(queries, 10, nprobe=4)
+    assert 0 < recall_at_k(approx_idx, exact_idx) <= full_recall
+    assert (approx_idx >= 0).all()
+
+    scores = knn_classify(bank, bank_labels, queries, 10, k=10, index=index, nprobe=4)
+    assert scores.shape == (100, 10)
+    # the synthetic classes are well separated
+    assert np.mean(scores.argmax(axis=1) == query_labels) > 0.9
@@ -1,3 +1,4 @@
+import copy
 import shutil
 from argparse import Namespace
 from pathlib import Path
@@ -5,9 +6,13 @@ from pathlib import Path
 import pytest
 import torch.cuda
 
-from data import constants
+from data import constants, get_mmearth_dataloaders
+from data import stream_shards
 from eval import geobench_clf_eval
+from eval.embedding_cache import encode_dataloader
 from main import main, METHODS
+from methods.modules import BYOL
+from methods.modules.base import per_view_batch_norm
 
 
 @pytest.fixture
@@ -100,7 +105,7 @@ def test_checkpointing_geobench(args, geobench_dataset: str):
 @pytest.mark.parametrize("last_backbone_channel", [None, 128])
 def test_methods(args, methods: str, target, last_backbone_channel):
     args.log_dir.mkdir(exist_ok=True)
-    if methods == "mae" and last_backbone_channel is not None:
+    if methods.startswith("mae") and last_backbone_channel is not None:
         return  # this is not supported so skip
     args.methods = [methods]
     args.target = target
@@ -113,3 +118,153 @@ def test_methods(args, methods: str, target, last_backbone_channel):
         shutil.rmtree(args.log_dir, ignore_errors=True)
 
 
+
+
+@pytest.mark.parametrize("geobench_dataset", ["m-eurosat", "m-bigearthnet"])
+def test_embedding_cache_geobench(args, geobench_dataset: str):
+    args.log_dir.mkdir(exist_ok=True)
+    args.methods = ["vicreg"]
+    args.backbone = "resnet18"
+    args.target = None
+    args.epochs = 0
+
+    try:
+        model = main(**vars(args), debug=True)
+
+        # the second run trains on the embeddings cached by the first one
+        for _ in range(2):
+            geobench_clf_eval(
+                model=model,
+                method="linear",
+                dataset_name=geobench_dataset,
+                partition="default",
+                log_dir=args.log_dir,
+                processed_dir=args.log_dir,
+                batch_size_per_device=args.batch_size_per_device,
+                num_workers=args.num_workers,
+                accelerator=args.accelerator,
+                devices=args.devices,
+                precision=args.precision,
+                no_ffcv=args.no_ffcv,
+                embedding_cache=True,
+                debug="long",
+            )
+        # one entry (and its key file) per split
+        assert len(list((args.log_dir / "embeddings").glob("embeddings_*.key.json"))) == 3
+
+    finally:
+        # cleanup
+        shutil.rmtree(args.log_dir, ignore_errors=True)
+
+
+def test_frozen_eval_feature_bank(args):
+    args.log_dir.mkdir(exist_ok=True)
+    args.methods = ["simclr"]
+    args.enable_finetune_eval = False
+    args.epochs = 0
+    # without --processed-dir, the feature bank is stored next to the data
+    cache_dir = args.data_dir / "embeddings"
+    existing = set(cache_dir.glob("embeddings_*"))
+
+    try:
+        main(**vars(args), embedding_cache=True, debug=True)
+        # linear and KNN evaluation share the entries of the train and val split
+        new_keys = set(cache_dir.glob("embeddings_*.key.json")) - existing
+        assert len(new_keys) == 2
+    finally:
+        # cleanup
+        shutil.rmtree(args.log_dir, ignore_errors=True)
+        for path in set(cache_dir.glob("embeddings_*")) - existing:
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                path.unlink()
+
+
+def test_encode_stream_loader_all_ranks(monkeypatch):
+    # rank zero encodes the feature bank alone while the process group (faked here) has two ranks
+    monkeypatch.setattr(stream_shards, "_get_rank_and_world_size", lambda: (0, 2))
+    test_out = Path("test_out")
+    test_out.mkdir(exist_ok=True)
+
+    try:
+        (loader,) = get_mmearth_dataloaders(
+            constants.MMEARTH_DIR,
+            test_out,
+            constants.RGB_MODALITIES,
+            {"biome": constants.MODALITIES_FULL["biome"]},
+            0,
+            2,
+            ["train"],
+            indices=[list(range(11))],
+            backend="stream",
+            samples_per_shard=4,
+            sequential=True,
+        )
+        features, labels = encode_dataloader(
+            torch.nn.AdaptiveAvgPool2d(1), loader, device=torch.device("cpu")
+        )
+        assert features.shape == (11, 1, 3)
+        assert len(labels) == 11
+        # a loader that is split over the ranks only has half of the samples
+        assert len(stream_shards.StreamShardDataset(loader.dataset.shard_dir, shuffle=False)) == 6
+    finally:
+        # cleanup
+        shutil.rmtree(test_out, ignore_errors=True)
+
+
+@pytest.mark.parametrize("methods", ["simclr", "byol"])
+def test_gradient_accumulation(args, methods: str):
+    args.log_dir.mkdir(exist_ok=True)
+    args.methods = [methods]
+    args.enable_finetune_eval = False
+
+    try:
+        model = main(**vars(args), accumulate_grad_batches=2, debug=True)
+        if methods == "simclr":
+            # the memory bank holds the negatives of both accumulated batches
+            assert model.hparams.memory_bank_size == 2 * args.batch_size_per_device
+    finally:
+        # cleanup
+        shutil.rmtree(args.log_dir, ignore_errors=True)
+
+
+def test_per_view_batch_norm():
+    torch.manual_seed(0)
+    separate = torch.nn.Sequential(torch.nn.Conv2d(3, 8, 3), torch.nn.BatchNorm2d(8))
+    batched = copy.deepcopy(separate)
+    views = [torch.randn(4, 3, 8, 8), torch.randn(4, 3, 8, 8) + 1]
+
+    expected = torch.cat([separate(view) for view in views])
+    with per_view_batch_norm([batched], num_views=2):
+        assert torch.allclose(batched(torch.cat(views)), expected, atol=1e-5)
+    # running statistics are updated once per view as well
+    assert torch.allclose(batched[1].running_mean, separate[1].running_mean)
+    assert torch.allclose(batched[1].running_var, separate[1].running_var)
+
+
+def test_byol_per_view_batch_norm():
+    torch.manual_seed(0)
+    model = BYOL(
+        backbone="resnet18",
+        batch_size_per_device=4,
+        in_channels=12,
+        num_classes=0,
+        has_online_classifier=False,
+        train_transform=None,
+    ).train()
+    separate = copy.deepcopy(model)
+    views = [torch.randn(4, 12, 32, 32), torch.randn(4, 12, 32, 32) + 1]
+    x = torch.cat(views)
+
+    with model.batch_norm_context():
+        teacher = model.forward_teacher(x)
+        _, student = model.forward_student(x)
+    assert torch.allclose(teacher, torch.cat([separate.forward_teacher(v) for v in views]), atol=1e-4)
+    assert torch.allclose(student, torch.cat([separate.forward_student(v)[1] for v in views]), atol=1e-4)
+
+    # outside of the training step (e.g. fine-tuning), the statistics of the whole batch are used again
+    for m in model.modules():
+        assert "forward" not in vars(m)
+    _, student = model.forward_student(x)
+    assert not torch.allclose(student, torch.cat([separate.forward_student(v)[1] for v in views]), atol=1e-4)
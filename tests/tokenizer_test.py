@@ -0,0 +1,70 @@
+import pytest
+import torch
+from lightly.models.utils import patchify
+
+from methods.modules import MAE
+from methods.modules.tokenizer import (
+    CHANNEL_GROUPS,
+    GroupedChannelPatchEmbed,
+    TokenizerConfig,
+    parse_backbone,
+)
+
+
+def test_parse_backbone():
+    assert parse_backbone("vit_base_patch16_224") == ("vit_base_patch16_224", None)
+    assert parse_backbone("vit_base_patch16_224:p28") == (
+        "vit_base_patch16_224",
+        TokenizerConfig(28, None),
+    )
+    assert parse_backbone("default:spectral_p16") == (
+        "default",
+        TokenizerConfig(16, "spectral"),
+    )
+    with pytest.raises(AssertionError):
+        parse_backbone("vit_base_patch16_224:rgb_p16")
+
+
+@pytest.mark.parametrize("groups", ["spectral", "band"])
+@pytest.mark.parametrize("patch_size", [8, 28])
+def test_grouped_channel_patch_embed(groups, patch_size):
+    channel_groups = CHANNEL_GROUPS[groups]
+    embed = GroupedChannelPatchEmbed(112, patch_size, 12, 32, channel_groups=channel_groups)
+    images = torch.randn(2, 12, 112, 112)
+
+    tokens = embed(images)
+    assert tokens.shape == (2, embed.num_patches, 32)
+    assert embed.num_patches == len(channel_groups) * (112 // patch_size) ** 2
+
+    # the tokens of a group only depend on its channels, in the order of its patches
+    patches = embed.patchify(images)
+    num_grid = (112 // patch_size) ** 2
+    for g, group in enumerate(channel_groups):
+        expected = patchify(images[:, group], patch_size)
+        assert torch.equal(patches[:, g * num_grid : (g + 1) * num_grid], expected)
+
+
+@pytest.mark.parametrize("tokenizer", ["spectral_p16", "band_p28", "p28"])
+@pytest.mark.parametrize("predict_ratio", [None, 0.5])
+def test_mae_tokenizer(tokenizer, predict_ratio):
+    model = MAE(
+        backbone=f"vit_small_patch16_224:{tokenizer}",
+        batch_size_per_device=2,
+        in_channels=12,
+        img_size=112,
+        num_classes=0,
+        has_online_classifier=False,
+        train_transform=None,
+        predict_ratio=predict_ratio,
+    )
+    patch_embed = model.backbone.vit.patch_embed
+    assert model.backbone.vit.pos_embed.shape[1] == model.sequence_length
+    assert model.decoder.decoder_pos_embed.shape[1] == model.sequence_length
+
+    loss, features = model.reconstruction_loss(torch.rand(2, 12, 112, 112))
+    loss.backward()
+    assert torch.isfinite(loss)
+    assert features.shape[1] == int(model.sequence_length * (1 - model.mask_ratio))
+    if isinstance(patch_embed, GroupedChannelPatchEmbed):
+        assert patch_embed.group_embed.grad is not None
+        assert model.decoder_group_embed.grad is not None
@@ -0,0 +1,51 @@
+"""Helpers shared by the tests and the benchmarks."""
+import numpy as np
+
+from data import constants
+
+
+def remap_labels_loop(data: np.ndarray, modality: str) -> np.ndarray:
+    """
+    Reference implementation of the label remapping with one `np.where` per class, as it was done in
+    `MMEarthDataset.__getitem__` before the lookup tables (`data.label_remap`).
+    """
+    if modality == "dynamic_world":
+        data = np.where(data == constants.NO_DATA_VAL[modality], np.nan, data)
+        old_values = [1, 2, 3, 4, 5, 6, 7, 8, 9, np.nan]
+        new_values = [0, 1, 2, 3, 4, 5, 6, 7, 8, np.nan]
+        for old, new in zip(old_values, new_values):
+            data = np.where(data == old, new, data)
+        # for any value greater than 8, we map them to nan
+        data = np.where(data > 8, np.nan, data)
+
+    if modality == "esa_worldcover":
+        old_values = [10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 100, 255]
+        new_values = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 255]
+        for old, new in zip(old_values, new_values):
+            data = np.where(data == old, new, data)
+        # for any value greater than 10, we map them to nan
+        data = np.where(data > 10, np.nan, data)
+
+    return data
+
+
+def make_bank(
+    num_samples: int,
+    num_queries: int,
+    dim: int,
+    num_classes: int,
+    noise: float = 2.0,
+    seed: int = 0,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Gaussian clusters, one per class, returns the bank, its labels, the queries and their labels."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(num_classes, dim)).astype(np.float32)
+    labels = rng.integers(num_classes, size=num_samples + num_queries)
+    features = centers[labels] + noise * rng.normal(size=(len(labels), dim)).astype(np.float32)
+    features = features.astype(np.float16)
+    return (
+        features[:num_samples],
+        labels[:num_samples],
+        features[num_samples:],
+        labels[num_samples:],
+    )